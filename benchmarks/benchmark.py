@@ -0,0 +1,338 @@
+"""
+End-to-end benchmark of backup and restore.
+
+For each workload, a synthetic backup folder is backed up (first backup),
+changed and backed up again (incremental backup), then the last version is
+restored from S3 (the local object store is emptied first), against an in-process S3 stand-in and a local anchor ledger, so
+that no network is needed. Results are appended to a JSON-lines file and
+compared with the previous run with the same parameters.
+
+Usage: python benchmarks/benchmark.py [--workloads small_files huge_files]
+           [--scale 0.1] [--workers 4] [--s3 local|moto]
+           [--compression none|zlib|zstd]
+"""
+import argparse
+import contextlib
+import filecmp
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.local_s3 import LocalS3User
+from benchmarks.workloads import WORKLOADS
+from modules.backup_program.backup_program import BackupProgram
+from modules.local_ledger.local_ledger import LocalLedger
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+BUCKET = "benchmark"
+PHASES = ("first_backup", "incremental_backup", "restore")
+
+
+def _read_proc_io():
+    """
+    :return: number of bytes this process caused to be written to storage,
+        or None if not available (not Linux)
+    """
+    try:
+        with open("/proc/self/io", "r") as f:
+            for line in f:
+                if line.startswith("write_bytes:"):
+                    return int(line.split(":")[1])
+    except OSError:
+        return None
+
+
+def _reset_peak_rss():
+    """
+    Reset the peak resident set size of this process (Linux only).
+    :return: True if it was reset
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb(was_reset):
+    if was_reset:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    # peak since the start of the process, in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _tree_size(paths):
+    return sum(os.path.getsize(path) for path in paths)
+
+
+def _list_files(folder):
+    return [os.path.join(root, file_name)
+            for root, _, files in os.walk(folder) for file_name in files]
+
+
+def _same_trees(a, b):
+    comparison = filecmp.dircmp(a, b)
+    if comparison.left_only or comparison.right_only or comparison.funny_files:
+        return False
+    _, mismatch, errors = filecmp.cmpfiles(a, b, comparison.common_files, shallow=False)
+    if mismatch or errors:
+        return False
+    return all(_same_trees(os.path.join(a, d), os.path.join(b, d))
+               for d in comparison.common_dirs)
+
+
+class MotoRequestCounter(object):
+    """
+    Count the S3 requests sent by a User to the moto mock of S3.
+    """
+
+    def __init__(self):
+        self.requests = Counter()
+        self.bytes_uploaded = None
+        self.bytes_downloaded = None
+
+    def attach(self, user):
+        # set_max_concurrency recreates the client, attach after it
+        user._client.meta.events.register("before-call.s3", self._count)
+
+    def _count(self, model, **kwargs):
+        self.requests[model.name] += 1
+
+
+def measure(function, counter, files, size, verbose):
+    """
+    Run one phase of a benchmark, and measure it.
+    :param function: function running the phase, returning True on success
+    :param counter: object with attributes requests (Counter), bytes_uploaded
+        and bytes_downloaded, updated by the S3 stand-in
+    :param files: number of files processed by the phase
+    :param size: number of bytes of the files processed by the phase
+    :return: dictionary of metrics
+    """
+    requests_before = Counter(counter.requests)
+    uploaded_before = counter.bytes_uploaded
+    downloaded_before = counter.bytes_downloaded
+    written_before = _read_proc_io()
+    was_reset = _reset_peak_rss()
+    start = time.perf_counter()
+    if verbose:
+        ok = function()
+    else:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            ok = function()
+    elapsed = time.perf_counter() - start
+    written_after = _read_proc_io()
+
+    requests = dict(Counter(counter.requests) - requests_before)
+    uploaded = None
+    if uploaded_before is not None:
+        uploaded = counter.bytes_uploaded - uploaded_before
+    downloaded = None
+    if downloaded_before is not None:
+        downloaded = counter.bytes_downloaded - downloaded_before
+    disk_bytes_written = None
+    if written_before is not None:
+        disk_bytes_written = written_after - written_before
+        if uploaded is not None:
+            # the local S3 stand-in writes the uploaded objects to disk too
+            disk_bytes_written = max(0, disk_bytes_written - uploaded)
+    return {
+        "ok": bool(ok),
+        "seconds": elapsed,
+        "files": files,
+        "bytes": size,
+        "files_per_s": files / elapsed if elapsed else None,
+        "mb_per_s": size / (1 << 20) / elapsed if elapsed else None,
+        "s3_requests": requests,
+        "s3_requests_total": sum(requests.values()),
+        "s3_bytes_uploaded": uploaded,
+        "s3_bytes_downloaded": downloaded,
+        "local_disk_bytes_written": disk_bytes_written,
+        "peak_rss_mb": _peak_rss_mb(was_reset),
+    }
+
+
+def run_workload(workload, args, work_dir, user, counter):
+    source_dir = os.path.join(work_dir, "source")
+    restore_dir = os.path.join(work_dir, "restore")
+    os.makedirs(source_dir)
+    workload.create(source_dir)
+
+    anchor = LocalLedger(os.path.join(work_dir, "ledger.jsonl"), args.anchor_latency)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        backup_program = BackupProgram(user, anchor,
+                                       prefix_path=os.path.join(work_dir, "prefix"))
+        backup_program.configure({
+            "backup_folder": source_dir,
+            "bucket": BUCKET,
+            "time_interval": 0,
+            "workers": args.workers,
+            "upload_concurrency": args.upload_concurrency,
+            "anchor": {"type": "local"},
+            "compression": {"algorithm": args.compression},
+        }, "benchmark")
+    if isinstance(counter, MotoRequestCounter):
+        counter.attach(user)
+
+    def backup():
+        committed_version = backup_program._version
+        backup_program.backup_once()
+        backup_program.drain_anchors()
+        return backup_program._version > committed_version
+
+    results = {}
+    all_files = _list_files(source_dir)
+    results["first_backup"] = measure(backup, counter,
+            len(all_files), _tree_size(all_files), args.verbose)
+
+    changed_files = sorted(set(workload.mutate(source_dir)))
+    results["incremental_backup"] = measure(backup, counter,
+            len(changed_files), _tree_size(changed_files), args.verbose)
+
+    all_files = _list_files(source_dir)
+    version = backup_program._version
+    # otherwise the restore reads the file objects kept locally, and does
+    # not download nor decrypt the packs
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        backup_program._evict_file_objects(0)
+
+    def restore():
+        return backup_program.restore_version(version, restore_dir) and _same_trees(
+                source_dir, os.path.join(restore_dir, "v{}".format(version), "data"))
+
+    results["restore"] = measure(restore, counter,
+            len(all_files), _tree_size(all_files), args.verbose)
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"],
+                cwd=BENCHMARK_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _load_previous_run(results_path, params):
+    previous = None
+    if os.path.isfile(results_path):
+        with open(results_path, "r") as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    if record["params"] == params:
+                        previous = record
+    return previous
+
+
+def _report(record, previous, threshold):
+    """
+    Print the results of a run, and the regressions of throughput with
+    regard to the previous run.
+    :return: list of regressions
+    """
+    regressions = []
+    print("{:<14} {:<19} {:>9} {:>9} {:>9} {:>8} {:>12} {:>9} {:>3}".format(
+            "workload", "phase", "seconds", "files/s", "MB/s", "S3 req",
+            "disk MB", "peak MB", "ok"))
+    for workload, phases in record["results"].items():
+        for phase in PHASES:
+            metrics = phases[phase]
+            disk = metrics["local_disk_bytes_written"]
+            print("{:<14} {:<19} {:>9.3f} {:>9.1f} {:>9.1f} {:>8} {:>12} {:>9.1f} {:>3}".format(
+                    workload, phase, metrics["seconds"], metrics["files_per_s"] or 0,
+                    metrics["mb_per_s"] or 0, metrics["s3_requests_total"],
+                    "-" if disk is None else "{:.1f}".format(disk / (1 << 20)),
+                    metrics["peak_rss_mb"], "yes" if metrics["ok"] else "NO"))
+            if previous is None:
+                continue
+            previous_metrics = previous["results"].get(workload, {}).get(phase)
+            if previous_metrics and previous_metrics["mb_per_s"] and metrics["mb_per_s"] \
+                    and metrics["mb_per_s"] < previous_metrics["mb_per_s"] * (1 - threshold):
+                regressions.append("{} {}: {:.1f} MB/s, was {:.1f} MB/s at {}".format(
+                        workload, phase, metrics["mb_per_s"],
+                        previous_metrics["mb_per_s"], previous["commit"]))
+    for regression in regressions:
+        print("REGRESSION", regression)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark backup and restore")
+    parser.add_argument("--workloads", nargs="+", choices=sorted(WORKLOADS),
+                        default=sorted(WORKLOADS))
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="multiply the sizes and numbers of files")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--upload-concurrency", type=int, default=10)
+    parser.add_argument("--anchor-latency", type=float, default=0,
+                        help="simulated latency of anchoring, in seconds")
+    parser.add_argument("--s3", choices=("local", "moto"), default="local",
+                        help="S3 stand-in: objects in a local folder, or moto")
+    parser.add_argument("--compression", choices=("none", "zlib", "zstd"), default="none",
+                        help="compression of chunks before encryption")
+    parser.add_argument("--results", default=os.path.join(BENCHMARK_DIR, "results.jsonl"),
+                        help="JSON-lines file the results are appended to")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="relative drop of MB/s reported as a regression")
+    parser.add_argument("--work-dir", default=None,
+                        help="folder of temporary files, removed at the end")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    params = {"scale": args.scale, "workers": args.workers,
+              "upload_concurrency": args.upload_concurrency,
+              "anchor_latency": args.anchor_latency, "s3": args.s3,
+              "compression": args.compression}
+    record = {"time": time.time(), "commit": _git_commit(), "params": params,
+              "results": {}}
+    if args.work_dir is not None:
+        os.makedirs(args.work_dir, exist_ok=True)
+    for name in args.workloads:
+        work_dir = tempfile.mkdtemp(prefix="cloudsec-{}-".format(name), dir=args.work_dir)
+        try:
+            if args.s3 == "moto":
+                # optional dependency, only needed for this stand-in
+                from moto import mock_aws
+                import boto3
+                from modules.user.user import User
+                os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+                os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+                os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+                with mock_aws():
+                    boto3.client("s3").create_bucket(Bucket=BUCKET)
+                    counter = MotoRequestCounter()
+                    record["results"][name] = run_workload(
+                            WORKLOADS[name](args.scale), args, work_dir, User(), counter)
+            else:
+                user = LocalS3User(os.path.join(work_dir, "s3"), BUCKET)
+                record["results"][name] = run_workload(
+                        WORKLOADS[name](args.scale), args, work_dir, user, user)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    previous = _load_previous_run(args.results, params)
+    regressions = _report(record, previous, args.threshold)
+    with open(args.results, "a") as f:
+        f.write(json.dumps(record) + "\n")
+    print("Results appended to", args.results)
+    if regressions or not all(metrics["ok"] for phases in record["results"].values()
+                              for metrics in phases.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
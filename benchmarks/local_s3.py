@@ -0,0 +1,151 @@
+import os
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from utils.utils import make_dirs
+
+
+class LocalS3User(object):
+    """
+    In-process stand-in of modules.user.User, storing the objects of a
+    bucket as files under a local folder and counting the requests an S3
+    bucket would have received.
+    """
+
+    def __init__(self, root_dir, bucket="benchmark", max_concurrency=10):
+        """
+        :param root_dir: folder holding one subfolder per bucket
+        :param bucket: name of the only bucket
+        :param max_concurrency: maximum number of requests in flight
+        """
+        self._root_dir = root_dir
+        self._bucket = bucket
+        self._max_concurrency = max_concurrency
+        self._multipart_threshold = None
+        self._part_size = None
+        self._lock = threading.Lock()
+        self.requests = Counter()
+        self.bytes_uploaded = 0
+        self.bytes_downloaded = 0
+        make_dirs(os.path.join(root_dir, bucket))
+
+    def _count(self, request, uploaded=0, downloaded=0):
+        with self._lock:
+            self.requests[request] += 1
+            self.bytes_uploaded += uploaded
+            self.bytes_downloaded += downloaded
+
+    def _path(self, bucket, object_name):
+        if bucket != self._bucket:
+            raise Exception("NoSuchBucket: {}".format(bucket))
+        return os.path.join(self._root_dir, bucket, object_name)
+
+    def get_list_bucket_name(self):
+        self._count("ListBuckets")
+        return [self._bucket]
+
+    def set_max_concurrency(self, max_concurrency):
+        self._max_concurrency = max_concurrency
+
+    def set_multipart_config(self, threshold, part_size, concurrency):
+        self._multipart_threshold = threshold
+        self._part_size = part_size
+
+    def _put_object(self, file_name, bucket, object_name):
+        with open(file_name, "rb") as f:
+            data = f.read()
+        path = self._path(bucket, object_name)
+        make_dirs(os.path.dirname(path))
+        with open(path, "wb") as f:
+            f.write(data)
+        if self._multipart_threshold is not None and len(data) >= self._multipart_threshold:
+            # requests of a multipart upload
+            self._count("CreateMultipartUpload")
+            for _ in range(0, len(data), self._part_size):
+                self._count("UploadPart")
+            self._count("CompleteMultipartUpload", uploaded=len(data))
+        else:
+            self._count("PutObject", uploaded=len(data))
+
+    def upload_files(self, file_and_object_names, bucket, max_retries=3):
+        with ThreadPoolExecutor(max_workers=self._max_concurrency) as pool:
+            for future in [pool.submit(self._put_object, file_name, bucket, object_name)
+                           for file_name, object_name in file_and_object_names]:
+                future.result()
+        return []
+
+    def _get_object(self, bucket, request, process):
+        if isinstance(request, tuple):
+            object_name, offset, length = request
+        else:
+            object_name, offset, length = request, 0, -1
+        with open(self._path(bucket, object_name), "rb") as f:
+            f.seek(offset)
+            data = f.read(length)
+        self._count("GetObject", downloaded=len(data))
+        if process is None:
+            return data
+        return process(request, data)
+
+    def download_objects(self, bucket, object_names, process=None, max_retries=3):
+        return self._download_concurrently(bucket, object_names, process)
+
+    def download_ranges(self, bucket, ranges, process=None, max_retries=3):
+        return self._download_concurrently(bucket, ranges, process)
+
+    def _download_concurrently(self, bucket, requests, process):
+        requests = iter(requests)
+        with ThreadPoolExecutor(max_workers=self._max_concurrency) as pool:
+            in_flight = {}
+            while True:
+                while len(in_flight) < 2 * self._max_concurrency:
+                    request = next(requests, None)
+                    if request is None:
+                        break
+                    in_flight[pool.submit(self._get_object, bucket, request,
+                                          process)] = request
+                if not in_flight:
+                    break
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield in_flight.pop(future), future.result()
+
+    def object_exists(self, bucket, object_name):
+        self._count("HeadObject")
+        return os.path.isfile(self._path(bucket, object_name))
+
+    def delete_objects(self, bucket, object_names):
+        for i in range(0, len(object_names), 1000):
+            for object_name in object_names[i:i + 1000]:
+                try:
+                    os.remove(self._path(bucket, object_name))
+                except FileNotFoundError:
+                    pass
+            self._count("DeleteObjects")
+        return []
+
+    def abort_multipart_uploads(self, bucket, keep_object_names=()):
+        # uploads never fail, so no multipart upload is left unfinished
+        self._count("ListMultipartUploads")
+        return 0
+
+    def download_folder(self, bucket_name, folder_prefix, out_dir):
+        bucket_dir = os.path.join(self._root_dir, bucket_name)
+        object_names = []
+        for root, _, files in os.walk(bucket_dir):
+            for file_name in files:
+                object_name = os.path.relpath(os.path.join(root, file_name), bucket_dir)
+                object_name = object_name.replace(os.sep, "/")
+                if object_name.startswith(folder_prefix):
+                    object_names.append(object_name)
+        self._count("ListObjectsV2")
+
+        def save(object_name, data):
+            file_name = os.path.join(out_dir, object_name)
+            make_dirs(os.path.dirname(file_name))
+            with open(file_name, "wb") as f:
+                f.write(data)
+
+        for _ in self.download_objects(bucket_name, object_names, save):
+            pass
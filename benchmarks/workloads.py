@@ -0,0 +1,115 @@
+import os
+import random
+
+from utils.utils import make_dirs
+
+KiB = 1 << 10
+MiB = 1 << 20
+
+
+def _random_bytes(rng, size):
+    if hasattr(rng, "randbytes"):
+        return rng.randbytes(size)
+    return rng.getrandbits(8 * size).to_bytes(size, "little") if size else b""
+
+
+def _write(path, data, mode="wb"):
+    make_dirs(os.path.dirname(path))
+    with open(path, mode) as f:
+        f.write(data)
+
+
+class Workload(object):
+    """
+    A synthetic backup folder, created by create() and changed by mutate()
+    between the first and the incremental backup. Sizes and counts are
+    multiplied by scale.
+    """
+    name = None
+
+    def __init__(self, scale=1.0, seed=0):
+        self._scale = scale
+        self._rng = random.Random(seed)
+
+    def _n(self, n):
+        return max(1, int(n * self._scale))
+
+    def create(self, folder):
+        raise NotImplementedError
+
+    def mutate(self, folder):
+        """
+        :return: list of paths of the files changed
+        """
+        raise NotImplementedError
+
+
+class SmallFiles(Workload):
+    """Many small files in nested folders; 5% of them are rewritten."""
+    name = "small_files"
+
+    def create(self, folder):
+        self._paths = []
+        for i in range(self._n(2000)):
+            path = os.path.join(folder, "d{}".format(i % 20), "e{}".format(i % 7),
+                                "f{}.txt".format(i))
+            _write(path, _random_bytes(self._rng, self._rng.randint(1 * KiB, 8 * KiB)))
+            self._paths.append(path)
+
+    def mutate(self, folder):
+        changed = self._rng.sample(self._paths, max(1, len(self._paths) // 20))
+        for path in changed:
+            _write(path, _random_bytes(self._rng, self._rng.randint(1 * KiB, 8 * KiB)))
+        return changed
+
+
+class HugeFiles(Workload):
+    """A few huge files; one of them is replaced."""
+    name = "huge_files"
+
+    def create(self, folder):
+        self._paths = [os.path.join(folder, "huge{}.bin".format(i)) for i in range(2)]
+        for path in self._paths:
+            _write(path, _random_bytes(self._rng, self._n(64) * MiB))
+
+    def mutate(self, folder):
+        _write(self._paths[0], _random_bytes(self._rng, self._n(64) * MiB))
+        return self._paths[:1]
+
+
+class AppendHeavy(Workload):
+    """Log-like files which all grow at their end."""
+    name = "append_heavy"
+
+    def create(self, folder):
+        self._paths = [os.path.join(folder, "logs", "log{}.txt".format(i))
+                       for i in range(self._n(20))]
+        for path in self._paths:
+            _write(path, _random_bytes(self._rng, 4 * MiB))
+
+    def mutate(self, folder):
+        for path in self._paths:
+            _write(path, _random_bytes(self._rng, 256 * KiB), "ab")
+        return self._paths
+
+
+class EditInMiddle(Workload):
+    """Large files with a small in-place edit in their middle."""
+    name = "edit_middle"
+
+    def create(self, folder):
+        self._paths = [os.path.join(folder, "db{}.bin".format(i))
+                       for i in range(self._n(4))]
+        for path in self._paths:
+            _write(path, _random_bytes(self._rng, 16 * MiB))
+
+    def mutate(self, folder):
+        for path in self._paths:
+            with open(path, "r+b") as f:
+                f.seek(os.path.getsize(path) // 2)
+                f.write(_random_bytes(self._rng, 4 * KiB))
+        return self._paths
+
+
+WORKLOADS = {workload.name: workload
+             for workload in (SmallFiles, HugeFiles, AppendHeavy, EditInMiddle)}
@@ -1,19 +1,56 @@
+import argparse
 import os
 import sys
 import time
 
 from modules.user.user import User
-from modules.eth.eth import Eth
 from modules.backup_program.backup_program import BackupProgram
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Cloudsec backup program")
+    parser.add_argument("--pending-anchors", action="store_true",
+                        help="list the versions which are not anchored yet")
+    parser.add_argument("--drain-anchors", action="store_true",
+                        help="anchor all pending versions, then exit")
+    parser.add_argument("--restore", type=int, metavar="VERSION",
+                        help="retrieve a version, then exit")
+    parser.add_argument("--to", metavar="DIR", default=".",
+                        help="folder the version is retrieved into, "
+                             "in subfolder v<VERSION>/data")
+    parser.add_argument("--path", nargs="+", metavar="PATTERN",
+                        help="only retrieve the files matching these paths or "
+                             "glob patterns, relative to the backup folder")
+    parser.add_argument("--gc", action="store_true",
+                        help="delete the versions not kept by the retention "
+                             "policy and the file objects they alone refer to, "
+                             "then exit")
+    args = parser.parse_args()
+    if args.path and args.restore is None:
+        parser.error("--path requires --restore")
+
     HOME_DIRECTORY = os.path.expanduser("~")
     user = User(os.path.join(HOME_DIRECTORY, ".aws", "credentials"))
-    eth = Eth(os.path.join(HOME_DIRECTORY, ".aws", "eth_credentials"))
-
-    backupProgram = BackupProgram(user, eth)
-    backupProgram.run()
+    # the anchor backend (eth by default) is selected in config.json
+    backupProgram = BackupProgram(user)
+    if args.pending_anchors:
+        backupProgram.list_pending_anchors()
+    elif args.drain_anchors:
+        print("Anchored {} version(s)".format(backupProgram.drain_anchors()))
+    elif args.restore is not None:
+        if not backupProgram.is_already_config():
+            print("Backup program is not configured")
+            sys.exit(1)
+        if not backupProgram.restore_version(args.restore, args.to, args.path):
+            sys.exit(1)
+    elif args.gc:
+        if not backupProgram.is_already_config():
+            print("Backup program is not configured")
+            sys.exit(1)
+        if backupProgram.collect_garbage() is None:
+            sys.exit(1)
+    else:
+        backupProgram.run()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,56 @@
+import os
+
+
+class Anchor(object):
+    """
+    Interface of the backends anchoring the Merkle roots of backup versions
+    somewhere they cannot be modified, e.g. the Ethereum blockchain.
+    """
+
+    def upload(self, root):
+        """
+        Anchor a root
+        :param root: hex string of the root
+        :return: id of the receipt of the upload, e.g. a transaction id
+        """
+        raise NotImplementedError
+
+    def retrieve(self, receipt_id):
+        """
+        Retrieve an anchored root
+        :param receipt_id: id returned by upload
+        :return: hex string of the root
+        """
+        raise NotImplementedError
+
+
+def create_anchor(anchor_config, prefix_path):
+    """
+    Create the anchor backend selected in the "anchor" section of the config
+    :param anchor_config: dictionary, with key "type" ("eth" or "local") and
+        the options of the backend, or None for the default backend (eth)
+    :param prefix_path: folder of the files of the backup program
+    :return: Anchor object
+    """
+    anchor_config = anchor_config or {}
+    anchor_type = anchor_config.get("type", "eth")
+    if anchor_type == "eth":
+        provider_url = anchor_config.get("provider_url")
+        if not provider_url:
+            raise Exception("The eth anchor needs the URL of an Ethereum node: set "
+                            "\"provider_url\" (and \"api_key\" if the URL does not "
+                            "contain it) in the anchor section of config.json")
+        if anchor_config.get("api_key"):
+            # e.g. https://sepolia.infura.io/v3/ followed by the key
+            provider_url = provider_url.rstrip("/") + "/" + anchor_config["api_key"]
+        # web3 is only needed by this backend
+        from modules.eth.eth import Eth
+        return Eth(os.path.expanduser(anchor_config.get(
+                "credential_path", os.path.join("~", ".aws", "eth_credentials"))),
+                provider_url)
+    if anchor_type == "local":
+        from modules.local_ledger.local_ledger import LocalLedger
+        return LocalLedger(
+                anchor_config.get("path", os.path.join(prefix_path, "ledger.jsonl")),
+                anchor_config.get("latency", 0))
+    raise Exception("Unknown anchor type: {}".format(anchor_type))
@@ -0,0 +1,108 @@
+import sqlite3
+import threading
+import time
+
+from modules.merkle_tree.merkle_tree import aggregate_roots
+from modules.object_db.object_db import ObjectDB
+from utils.metrics import inc, timer
+
+# attempts to record an anchored batch in ObjectDB, which can be locked by a
+# long transaction of the backup cycle beyond the busy timeout
+LEDGER_ATTEMPTS = 5
+
+class AnchorQueue(object):
+    """
+    Anchor the Merkle roots of committed versions in the background.
+    Versions are committed locally as pending in ObjectDB, and the roots of
+    all pending versions (at most max_batch_size at a time) are aggregated
+    under a single root which is uploaded in one transaction, so that slow
+    transactions do not slow down backups.
+    """
+
+    def __init__(self, object_db_path, anchor, max_batch_size=16):
+        """
+        :param object_db_path: path of the ObjectDB of the backup program
+        :param anchor: Anchor backend uploading the roots
+        :param max_batch_size: maximum number of versions per transaction
+        """
+        self._object_db_path = object_db_path
+        self._anchor = anchor
+        self._max_batch_size = max_batch_size
+        # ObjectDB connections are not shared between threads
+        self._object_db = None
+        self._lock = threading.Lock()
+        self._wake_up = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        # anchor what was left pending by a previous run
+        self.notify()
+
+    def notify(self):
+        """
+        Wake up the background thread after a version was committed.
+        """
+        self._wake_up.set()
+
+    def _run(self):
+        self._object_db = ObjectDB(self._object_db_path)
+        while not self._stop.is_set():
+            self._wake_up.wait()
+            self._wake_up.clear()
+            try:
+                while not self._stop.is_set() and self.anchor_pending(self._object_db):
+                    pass
+            except Exception as e:
+                print("Cannot anchor pending versions: ", e)
+        # close the connection in the thread which opened it
+        self._object_db = None
+
+    def anchor_pending(self, object_db):
+        """
+        Anchor one batch of pending versions.
+        :param object_db: ObjectDB opened in the calling thread
+        :return: number of versions anchored
+        """
+        with self._lock:
+            version_roots = object_db.queryPendingVersions()[:self._max_batch_size]
+            if not version_roots:
+                return 0
+            batch_root, proofs = aggregate_roots(version_roots)
+            with timer("anchor", op="upload"):
+                transaction_id = self._anchor.upload(batch_root)
+            inc("anchored_versions", len(version_roots))
+            # the batch is anchored: record it rather than anchoring it again
+            for attempt in range(LEDGER_ATTEMPTS):
+                try:
+                    object_db.setVersionsAnchored(transaction_id, proofs)
+                    break
+                except sqlite3.OperationalError as e:
+                    if attempt == LEDGER_ATTEMPTS - 1:
+                        raise Exception("Cannot record transaction {}: {}".format(
+                                transaction_id, e))
+                    time.sleep(attempt + 1)
+            print("Anchored versions {} in transaction {}".format(
+                    [version for version, _ in version_roots], transaction_id))
+            return len(version_roots)
+
+    def drain(self, object_db):
+        """
+        Anchor all pending versions in the calling thread.
+        :param object_db: ObjectDB opened in the calling thread
+        :return: number of versions anchored
+        """
+        count = 0
+        while True:
+            anchored = self.anchor_pending(object_db)
+            if not anchored:
+                return count
+            count += anchored
+
+    def stop(self):
+        self._stop.set()
+        self._wake_up.set()
+        if self._thread is not None:
+            self._thread.join()
@@ -1,31 +1,155 @@
+import bisect
+import fnmatch
 import getpass
+import hashlib
 import os
 import shutil
 import signal
 import time
+from contextlib import closing
+from concurrent.futures import ProcessPoolExecutor
 
+from modules.anchor.anchor import create_anchor
+from modules.anchor_queue.anchor_queue import AnchorQueue
+from modules.inotify_watcher.inotify_watcher import InotifyWatcher
+from modules.manifest.manifest import Manifest
+from modules.merkle_tree.merkle_tree import MerkleTree, verify_aggregate_proof
 from modules.metadata.metadata import Metadata
 from modules.object_db.object_db import ObjectDB
+from modules.pack.pack import DEFAULT_PACK_SIZE, DEFAULT_REPACK_THRESHOLD
+from modules.pack.pack import write_packs, coalesce_ranges
+from modules.restore_assembler.restore_assembler import RestoreAssembler
+from modules.retention.retention import RetentionPolicy
+from modules.user.user import DEFAULT_MULTIPART_THRESHOLD, DEFAULT_PART_SIZE
+from modules.user.user import DEFAULT_PART_CONCURRENCY
 from modules.stat_cache.stat_cache import StatCache
-from utils.crypto import sha256, setPassword, symKey, genSymKey, encryptFile, decryptFile
-from utils.utils import make_dirs, load_json, save_json
-from utils.utils import recursive_get_hash_list, get_hash_list_file_objects
+from utils.chunker import Chunker
+from utils.compressor import Compressor
+from utils.metrics import METRICS, inc, timer
+from utils.crypto import sha256, sha256Bytes, sha256File, setPassword, symKey, genSymKey, encryptData
+from utils.utils import make_dirs, load_json, save_json, iter_file_chunks
+from utils.utils import recursive_get_hash_list
 from utils.utils import replace_backslashes_with_forward_slashes
 
 HOME_DIRECTORY = os.path.expanduser("~")
 
+
+def _backup_file(filepath, stat_result, chunker, compressor, new_objects_dir,
+                 is_known):
+    """
+    Read a modified file once: split it into chunks, hash them and the
+    whole file, and compress and encrypt the chunks which are not in
+    ObjectDB yet into new file objects, with new data keys.
+    :param filepath: path of file
+    :param stat_result: result of os.stat of file before it is read
+    :param chunker: Chunker object deciding the chunk boundaries
+    :param compressor: Compressor object
+    :param new_objects_dir: folder where the new file objects are written,
+        under random names until they get a file id
+    :param is_known: function telling whether a chunk hash is in ObjectDB
+    :return: tuple (chunks, digest, new_objects), where chunks is a list of
+        tuples (offset, length, hash) of chunks of the file, digest is the
+        hex string of hash of the whole file and new_objects is a dictionary,
+        with key is the hash of a chunk and value is a tuple (data_key, path,
+        compressed_size, object_digest, object_size); or None if the file
+        was modified while it was read
+    """
+    chunks = []
+    new_objects = {}
+    file_hash = hashlib.sha256()
+    offset = 0
+    try:
+        for chunk, h in iter_file_chunks(filepath, chunker, file_hash):
+            chunks.append((offset, chunk.nbytes, h))
+            offset += chunk.nbytes
+            if h in new_objects or is_known(h):
+                continue
+            data_key = genSymKey()
+            file_object_path = os.path.join(new_objects_dir, os.urandom(16).hex())
+            with timer("compression"):
+                compression, payload = compressor.compress(chunk)
+            with timer("encryption"):
+                object_digest, object_size = encryptData(
+                        data_key, payload, file_object_path, compression)
+            new_objects[h] = (data_key, file_object_path, len(payload),
+                              object_digest.hex(), object_size)
+        # the file must not have changed while it was read
+        modified = offset != stat_result.st_size \
+                or os.stat(filepath).st_mtime_ns != stat_result.st_mtime_ns
+    except FileNotFoundError:
+        modified = True
+    if modified:
+        for _, file_object_path, _, _, _ in new_objects.values():
+            os.remove(file_object_path)
+        return None
+    return chunks, file_hash.hexdigest(), new_objects
+
+
+# ObjectDB of a worker process of the parallel backup mode, opened by the
+# first file it backs up
+_worker_object_db = None
+
+
+def _backup_file_in_worker(object_db_path, filepath, stat_result, chunker,
+                           compressor, new_objects_dir):
+    """
+    Worker of the parallel backup mode: _backup_file, looking chunks up in
+    a read-only connection to ObjectDB. Chunks encrypted for other files of
+    the version in progress are not visible to it, so they may be encrypted
+    again; the extra file objects are dropped by the backup process.
+    :param object_db_path: path of the ObjectDB of the backup program
+    :return: tuple (result, metrics), where result is the return value of
+        _backup_file and metrics the changes of the counters of the worker
+        (e.g. compression and encryption timers) while backing up the file,
+        to be added to the metrics of the backup process
+    """
+    global _worker_object_db
+    snapshot = METRICS.snapshot()
+    if _worker_object_db is None:
+        _worker_object_db = ObjectDB(object_db_path)
+    result = _backup_file(filepath, stat_result, chunker, compressor,
+                          new_objects_dir,
+                          lambda h: _worker_object_db.query(h)[0] is not None)
+    return result, METRICS.changes_since(snapshot)
+
+
 class BackupProgram(object):
 
-    def __init__(self, user, eth):
-        self._PREFIX_PATH = os.path.join(HOME_DIRECTORY, ".aws", ".backup_program")
+    def __init__(self, user, anchor=None, prefix_path=None):
+        """
+        :param user: User object accessing the S3 bucket
+        :param anchor: Anchor backend of version roots, or None to create
+            the backend selected in the config
+        :param prefix_path: folder of the local files of the backup program,
+            ~/.aws/.backup_program by default
+        """
+        self._PREFIX_PATH = prefix_path or os.path.join(HOME_DIRECTORY, ".aws", ".backup_program")
         self._CONFIG_FILEPATH = os.path.join(self._PREFIX_PATH, "config.json")
         self._VERSION_FILEPATH = os.path.join(self._PREFIX_PATH, "__version__.txt")
+        self._PENDING_UPLOADS_FILEPATH = os.path.join(self._PREFIX_PATH, "pending_uploads.json")
+        self._PENDING_DELETES_FILEPATH = os.path.join(self._PREFIX_PATH, "pending_deletes.json")
 
         self._user = user
-        self._eth = eth
+        self._anchor = anchor
+        self._anchor_config = None
         self._backup_folder = None
         self._bucket = None
         self._time_interval = 10
+        self._chunker = None
+        self._compressor = Compressor()
+        self._workers = 1
+        self._upload_concurrency = 10
+        self._multipart_threshold = DEFAULT_MULTIPART_THRESHOLD
+        self._multipart_part_size = DEFAULT_PART_SIZE
+        self._multipart_concurrency = DEFAULT_PART_CONCURRENCY
+        self._change_detection = "poll"
+        self._full_rescan_interval = 3600
+        self._snapshot_interval = 10
+        self._anchor_batch_size = 16
+        self._anchor_queue = None
+        self._metrics_dir = os.path.join(self._PREFIX_PATH, "metrics")
+        self._watcher = None
+        self._last_full_scan_time = None
         self._list_bucket_name = self._user.get_list_bucket_name()
         print("List bucket name of user: ", self._list_bucket_name)
         
@@ -39,9 +163,29 @@ class BackupProgram(object):
         self._stat_cache = None
         self._object_db_path = os.path.join(self._PREFIX_PATH, "objects.db")
         self._object_db = None
+        self._merkle_tree_path = os.path.join(self._PREFIX_PATH, "merkle.db")
+        self._merkle_tree = None
+        # manifest of the version in progress, and the metadata created
+        # (rather than copied from the previous version) for it
+        self._new_manifest = None
+        self._new_metadata = []
+        # full manifest of the last version loaded or backed up
+        self._manifest_cache = None
         self._metadata_dir = os.path.join(self._PREFIX_PATH, "metadata")
         self._file_objects_dir = os.path.join(self._PREFIX_PATH, "file_objects")
+        # file objects of the version in progress, until they get a file id
+        self._new_objects_dir = os.path.join(self._PREFIX_PATH, "new_objects")
         make_dirs(self._file_objects_dir)
+        # packs of new file objects, removed once uploaded
+        self._packs_dir = os.path.join(self._PREFIX_PATH, "packs")
+        self._pack_size = DEFAULT_PACK_SIZE
+        self._repack_threshold = DEFAULT_REPACK_THRESHOLD
+        # live file objects of the packs rewritten by garbage collection
+        self._repack_dir = os.path.join(self._PREFIX_PATH, "repack")
+        # maximum number of bytes of file objects kept locally, or None
+        self._local_cache_bytes = None
+        # versions kept by garbage collection, or None to keep all versions
+        self._retention = None
 
         self._control_key_salt_dir = os.path.join(self._PREFIX_PATH, "salt_file")
         self._control_key = None
@@ -65,11 +209,11 @@ class BackupProgram(object):
             return False
 
         print("Backup program is already config")
-        self._backup_folder = config["backup_folder"]
-        self._bucket = config["bucket"]
-        self._time_interval = config["time_interval"]
-        self._stat_cache = StatCache(self._stat_cache_dir, self._backup_folder)
-        self._object_db = ObjectDB(self._object_db_path)
+        self._load_config(config)
+        if self._needs_provider_url():
+            # configs saved before the Ethereum node was configurable
+            self._set_anchor()
+            self._save_config()
 
         self._set_salt()
         while True:
@@ -80,19 +224,103 @@ class BackupProgram(object):
         return True
 
 
+    def _load_config(self, config):
+        """
+        Apply a config, and open the local databases of the backup folder.
+        :param config: dictionary, as saved in config.json
+        """
+        self._backup_folder = config["backup_folder"]
+        self._bucket = config["bucket"]
+        self._time_interval = config["time_interval"]
+        self._chunker = Chunker.from_config(config.get("chunking"))
+        self._compressor = Compressor.from_config(config.get("compression"))
+        self._workers = config.get("workers", 1)
+        self._upload_concurrency = config.get("upload_concurrency", 10)
+        self._multipart_threshold = config.get("multipart_threshold",
+                                               DEFAULT_MULTIPART_THRESHOLD)
+        self._multipart_part_size = config.get("multipart_part_size", DEFAULT_PART_SIZE)
+        self._multipart_concurrency = config.get("multipart_concurrency",
+                                                 DEFAULT_PART_CONCURRENCY)
+        self._change_detection = config.get("change_detection", "poll")
+        self._full_rescan_interval = config.get("full_rescan_interval", 3600)
+        self._snapshot_interval = config.get("snapshot_interval", 10)
+        self._pack_size = config.get("pack_size", DEFAULT_PACK_SIZE)
+        self._repack_threshold = config.get("repack_threshold", DEFAULT_REPACK_THRESHOLD)
+        self._local_cache_bytes = config.get("local_cache_bytes")
+        self._retention = RetentionPolicy.from_config(config.get("retention"))
+        self._anchor_batch_size = config.get("anchor_batch_size", 16)
+        self._anchor_config = config.get("anchor")
+        self._metrics_dir = config.get("metrics_dir", self._metrics_dir)
+        self._user.set_max_concurrency(self._upload_concurrency)
+        self._user.set_multipart_config(self._multipart_threshold,
+                                        self._multipart_part_size,
+                                        self._multipart_concurrency)
+        self._stat_cache = StatCache(self._stat_cache_dir, self._backup_folder)
+        self._object_db = ObjectDB(self._object_db_path, self._chunker)
+        self._merkle_tree = MerkleTree(self._merkle_tree_path)
+        self._backfill_object_digests()
+        self._migrate_version_entries()
+
+
+    def configure(self, config, password):
+        """
+        Configure the backup program without prompting, e.g. for scripts
+        and benchmarks, and save the config.
+        :param config: dictionary, with at least keys backup_folder, bucket
+            and time_interval, and the optional keys of config.json
+        :param password: string, password deriving the control key
+        """
+        config = dict(config)
+        config["backup_folder"] = os.path.abspath(config["backup_folder"])
+        self._load_config(config)
+        self._set_salt()
+        self._control_key = setPassword(password.encode(), self._salt)
+        if not os.path.isfile(self._password_test_file_dir):
+            self._create_password_test_file()
+        elif not self._correct_password_entered():
+            raise Exception("Incorrect password")
+        self._save_config()
+
+
     def config(self):
         self._set_backup_folder()
         self._set_bucket()
         self._set_time_interval()
+        self._set_anchor()
         self._set_salt()
         self._set_control_key()
         self._create_password_test_file()
+        self._chunker = Chunker()
+        self._user.set_max_concurrency(self._upload_concurrency)
         self._stat_cache = StatCache(self._stat_cache_dir, self._backup_folder)
-        self._object_db = ObjectDB(self._object_db_path)
+        self._object_db = ObjectDB(self._object_db_path, self._chunker)
+        self._merkle_tree = MerkleTree(self._merkle_tree_path)
+        self._migrate_version_entries()
+        self._save_config()
+
+
+    def _save_config(self):
         config = {
             "backup_folder": self._backup_folder,
             "bucket": self._bucket,
             "time_interval": self._time_interval,
+            "chunking": self._chunker.to_config(),
+            "compression": self._compressor.to_config(),
+            "workers": self._workers,
+            "upload_concurrency": self._upload_concurrency,
+            "multipart_threshold": self._multipart_threshold,
+            "multipart_part_size": self._multipart_part_size,
+            "multipart_concurrency": self._multipart_concurrency,
+            "change_detection": self._change_detection,
+            "full_rescan_interval": self._full_rescan_interval,
+            "snapshot_interval": self._snapshot_interval,
+            "pack_size": self._pack_size,
+            "repack_threshold": self._repack_threshold,
+            "local_cache_bytes": self._local_cache_bytes,
+            "retention": self._retention.to_config() if self._retention else None,
+            "anchor_batch_size": self._anchor_batch_size,
+            "anchor": self._anchor_config or {"type": "eth"},
+            "metrics_dir": self._metrics_dir,
         }
         save_json(config, self._CONFIG_FILEPATH)
         print(config)
@@ -150,6 +378,32 @@ class BackupProgram(object):
                 print("Please input a valid integer number!")
         self._time_interval = time_interval
 
+    def _needs_provider_url(self):
+        """
+        :return: True if the roots of versions are anchored with Ethereum
+            (the default backend), but the config has no provider URL
+        """
+        anchor_config = self._anchor_config or {"type": "eth"}
+        return anchor_config.get("type", "eth") == "eth" \
+                and not anchor_config.get("provider_url")
+
+    def _set_anchor(self):
+        """
+        Method to set the Ethereum node the roots of versions are anchored
+        with, unless the config selects another anchor backend.
+        Provider URL is a string input from keyboard.
+        """
+        if not self._needs_provider_url():
+            return
+        anchor_config = self._anchor_config or {"type": "eth"}
+        print("4. Enter the URL of your Ethereum node, with its API key "
+              "(e.g. https://sepolia.infura.io/v3/<key>):")
+        provider_url = ""
+        while not provider_url:
+            print(">>> ", end="")
+            provider_url = input().strip()
+        self._anchor_config = dict(anchor_config, provider_url=provider_url)
+
     def _set_salt(self):
         """
 `       Set salt value by reading from file if file exists, or generating random value
@@ -210,14 +464,105 @@ class BackupProgram(object):
         return self._time_interval
     
 
+    def _start_watcher(self):
+        """
+        Start watching the backup folder with inotify if the change detection
+        mode is "inotify", falling back to polling if it is not available.
+        """
+        if self._change_detection != "inotify":
+            return
+        try:
+            self._watcher = InotifyWatcher(self._backup_folder)
+            print("Watching backup folder with inotify")
+        except Exception as e:
+            print("Cannot use inotify, polling backup folder instead: ", e)
+            self._watcher = None
+
+
+    def _get_anchor(self):
+        """
+        Create the anchor backend on first use, from the "anchor" section of
+        the config (eth by default).
+        :return: Anchor object
+        """
+        if self._anchor is None:
+            anchor_config = self._anchor_config
+            if anchor_config is None and os.path.isfile(self._CONFIG_FILEPATH):
+                anchor_config = load_json(self._CONFIG_FILEPATH).get("anchor")
+            self._anchor = create_anchor(anchor_config, self._PREFIX_PATH)
+        return self._anchor
+
+
+    def _start_anchor_queue(self):
+        """
+        Start anchoring committed versions in the background.
+        """
+        self._anchor_queue = AnchorQueue(self._object_db_path, self._get_anchor(),
+                                         self._anchor_batch_size)
+        self._anchor_queue.start()
+
+
+    def list_pending_anchors(self):
+        """
+        Print the versions which are committed but not anchored yet.
+        :return: list of tuples (version, root)
+        """
+        object_db = self._object_db or ObjectDB(self._object_db_path)
+        pending = object_db.queryPendingVersions()
+        print("{} version(s) pending anchor".format(len(pending)))
+        for version, root in pending:
+            print("version {}: {}".format(version, root))
+        return pending
+
+
+    def drain_anchors(self):
+        """
+        Anchor all pending versions now, in the calling thread.
+        :return: number of versions anchored
+        """
+        object_db = self._object_db or ObjectDB(self._object_db_path)
+        anchor_queue = self._anchor_queue or AnchorQueue(
+                self._object_db_path, self._get_anchor(), self._anchor_batch_size)
+        return anchor_queue.drain(object_db)
+
+
+    def _wait_for_next_cycle(self):
+        """
+        Sleep time interval seconds, or in inotify mode, until changes
+        in the backup folder have settled (at most time interval seconds).
+        """
+        if self._watcher is not None:
+            self._watcher.wait_for_changes(self.get_time_interval())
+        else:
+            time.sleep(self.get_time_interval())
+
+
     def is_backup_folder_modified(self):
         """
         Check whether backup folder is modified with regard to
         the previous version.
+        In inotify mode, only the paths changed since the previous check are
+        stat'ed, with a full rescan every full_rescan_interval seconds and
+        whenever inotify events may have been lost.
         :return: boolean, True if backup folder was modified, False otherwise.
         """
-        modified, list_modified_files, list_unmodified_files = \
-                self._stat_cache.is_backup_folder_modified()
+        full_rescan = True
+        if self._watcher is not None:
+            dirty_paths, need_full_rescan = self._watcher.take_dirty_paths()
+            full_rescan = need_full_rescan or self._last_full_scan_time is None \
+                    or time.monotonic() - self._last_full_scan_time \
+                        >= self._full_rescan_interval
+        if full_rescan:
+            self._last_full_scan_time = time.monotonic()
+            with timer("stat_scan", mode="full"):
+                modified, list_modified_files, list_unmodified_files = \
+                        self._stat_cache.is_backup_folder_modified()
+        else:
+            with timer("stat_scan", mode="inotify"):
+                modified, list_modified_files, list_unmodified_files = \
+                        self._stat_cache.check_paths(dirty_paths)
+        inc("files_modified", len(list_modified_files))
+        inc("files_unmodified", len(list_unmodified_files))
         if not modified:
             print("Backup folder is not modified.")
         else:
@@ -225,38 +570,504 @@ class BackupProgram(object):
         return modified, list_modified_files, list_unmodified_files
 
 
+    def _get_object_name(self, path):
+        """
+        Get the S3 object name of a local file object or metadata file.
+        :param path: path of the file, under self._PREFIX_PATH
+        :return: string, the object name
+        """
+        object_name = os.path.relpath(path, self._PREFIX_PATH)
+        return replace_backslashes_with_forward_slashes(object_name)
+
+
+    def _load_pending_uploads(self):
+        """
+        Load the packs (or file objects, before packs) which failed to be
+        uploaded in a previous version.
+        :return: list of paths of packs and file objects
+        """
+        if not os.path.isfile(self._PENDING_UPLOADS_FILEPATH):
+            return []
+        return [path for path in load_json(self._PENDING_UPLOADS_FILEPATH)
+                if os.path.isfile(path)]
+
+
+    def _save_pending_uploads(self, file_object_paths):
+        save_json(file_object_paths, self._PENDING_UPLOADS_FILEPATH)
+
+
+    def _abort_stale_uploads(self):
+        """
+        Abort the unfinished multipart uploads of the bucket, e.g. of packs
+        which were dropped or collected after their upload failed, except
+        the ones of the packs waiting to be uploaded again, which are resumed.
+        """
+        keep_object_names = [self._get_object_name(path)
+                             for path in self._load_pending_uploads()]
+        try:
+            aborted = self._user.abort_multipart_uploads(self._bucket, keep_object_names)
+        except Exception as e:
+            print("Cannot abort unfinished uploads: ", e)
+            return
+        if aborted:
+            print("Aborted {} unfinished upload(s)".format(aborted))
+
+
     def upload_new_version(self, new_file_object_paths):
         """
         Upload new version of backup if backup folder is modified.
+        New file objects are appended into packs, packs are uploaded
+        concurrently, then the manifest. Packs which could not be uploaded
+        are saved and retried with the next version.
         :param: new_file_object_paths: list of paths of new file_objects
-        :return: string, the path of new metadata
+        :return: string, the path of new manifest, or None if some objects
+            could not be uploaded, in which case the version must not be
+            committed
         """
-        for file_object_path in new_file_object_paths:
-            object_name = os.path.relpath(file_object_path, self._PREFIX_PATH)
-            object_name = replace_backslashes_with_forward_slashes(object_name)
-            self._user.upload_file(file_object_path, self._bucket, object_name)
+        with timer("pack"):
+            new_pack_paths = self._pack_file_objects(new_file_object_paths)
+        upload_paths = list(dict.fromkeys(
+                self._load_pending_uploads() + new_pack_paths))
+        # packs are recorded before they are uploaded, so that they are
+        # retried even if the program stops during the upload
+        self._save_pending_uploads(upload_paths)
+        failed = self._user.upload_files(
+                [(path, self._get_object_name(path)) for path in upload_paths],
+                self._bucket)
+        failed_paths = [file_name for file_name, _ in failed]
+        self._save_pending_uploads(failed_paths)
+        for path in set(upload_paths) - set(failed_paths):
+            if os.path.dirname(path) == self._packs_dir:
+                # file objects are kept in file_objects_dir
+                os.remove(path)
+        if failed:
+            return None
         
-        new_metadata_dir = os.path.join(
-                self._metadata_dir, "v{}".format(self._version))
-        make_dirs(new_metadata_dir)
-        self.upload_new_metadata(new_metadata_dir)
-        return new_metadata_dir
+        new_manifest_path = self._get_manifest_path(self._version)
+        if self._is_snapshot_version(self._version):
+            self._new_manifest.save(new_manifest_path)
+        else:
+            self._new_manifest.diff(
+                    self._load_manifest(self._version - 1)).save(new_manifest_path)
+        if not self.upload_new_metadata(new_manifest_path):
+            return None
+        return new_manifest_path
+
+
+    def _pack_file_objects(self, file_object_paths):
+        """
+        Append new file objects into packs of about pack_size bytes, and
+        record where each file object is in ObjectDB.
+        :param file_object_paths: list of paths of new file objects
+        :return: list of paths of the new packs
+        """
+        packs = write_packs(
+                [(int(os.path.basename(path)), path) for path in file_object_paths],
+                self._packs_dir, self._pack_size)
+        with self._object_db.transaction():
+            for pack_path, entries in packs:
+                self._object_db.insertPackEntries(
+                        self._get_object_name(pack_path), entries)
+        inc("packs", len(packs))
+        return [pack_path for pack_path, _ in packs]
+
+
+    def _evict_file_objects(self, max_bytes=None):
+        """
+        Remove the least recently used file objects of the local object store
+        until it holds at most local_cache_bytes bytes. Evicted file objects
+        are still in S3. File objects waiting to be uploaded alone (by older
+        versions) and file objects whose hash is not recorded are kept.
+        :param max_bytes: size to shrink the local object store to, instead
+            of local_cache_bytes
+        """
+        if max_bytes is None:
+            max_bytes = self._local_cache_bytes
+        if max_bytes is None:
+            return
+        local_size = self._object_db.queryLocalObjectsSize()
+        if local_size <= max_bytes:
+            return
+        pinned = set(int(os.path.basename(path)) for path in self._load_pending_uploads()
+                     if os.path.dirname(path) == self._file_objects_dir)
+        evicted = []
+        with closing(self._object_db.iterLeastRecentlyUsedObjects()) as candidates:
+            for file_id, size in candidates:
+                if local_size <= max_bytes:
+                    break
+                if file_id in pinned:
+                    continue
+                try:
+                    os.remove(os.path.join(self._file_objects_dir, str(file_id)))
+                except FileNotFoundError:
+                    pass
+                evicted.append(file_id)
+                local_size -= size
+        self._object_db.setObjectsEvicted(evicted)
+        inc("evicted_objects", len(evicted))
+
+
+    def _get_manifest_path(self, version):
+        return os.path.join(self._metadata_dir, "v{}.manifest".format(version))
+
+
+    def _has_local_manifest(self, version):
+        """
+        :return: True if the manifest of the version, or its directory of
+            per-file metadata, is on this machine
+        """
+        return os.path.isfile(self._get_manifest_path(version)) \
+                or os.path.isdir(os.path.join(self._metadata_dir, "v{}".format(version)))
+
+
+    def _migrate_version_entries(self):
+        """
+        Record the entries of the versions backed up before references to
+        file objects were counted in ObjectDB, once, from their local
+        manifests. If a version has no local manifest, its references are
+        unknown and garbage is never collected.
+        """
+        if self._object_db.isMigrated("version_entries"):
+            return
+        versions = range(1, self._version + 1)
+        if not all(self._has_local_manifest(version) for version in versions):
+            print("Some versions have no local manifest, "
+                  "garbage collection is disabled")
+            return
+        previous = Manifest(0)
+        with self._object_db.transaction():
+            for version in versions:
+                manifest = self._load_manifest(version)
+                delta = manifest.diff(previous)
+                self._object_db.recordVersionEntries(
+                        version, list(delta.entries.values()), delta.removed)
+                previous = manifest
+            self._object_db.setMigrated("version_entries")
+        if versions:
+            print("Recorded the references of {} version(s)".format(len(versions)))
+
+
+    def _list_versions(self):
+        """
+        :return: list of tuples (version, created) of the versions which were
+            not collected, where created is the time the version was backed
+            up, in seconds since the epoch
+        """
+        created = dict(self._object_db.queryVersions())
+        versions = []
+        for version in range(1, self._version + 1):
+            if not self._has_local_manifest(version):
+                continue
+            if created.get(version) is None:
+                # versions committed before their time was recorded
+                manifest_path = self._get_manifest_path(version)
+                if not os.path.isfile(manifest_path):
+                    manifest_path = os.path.join(self._metadata_dir, "v{}".format(version))
+                created[version] = os.path.getmtime(manifest_path)
+            versions.append((version, created[version]))
+        return versions
+
+
+    def collect_garbage(self, retention=None):
+        """
+        Delete the versions which are not kept by the retention policy, and
+        the file objects which are not referenced by the remaining versions,
+        from S3 and ObjectDB, and abort the multipart uploads which will not
+        be resumed. File objects are found with the reference
+        counts of ObjectDB, without reading the metadata of all versions.
+        Packs are deleted once none of their file objects is referenced, and
+        rewritten once collected file objects take most of them.
+        :param retention: RetentionPolicy, the one of the config by default
+        :return: number of versions collected, or None if garbage cannot be
+            collected
+        """
+        retention = retention or self._retention
+        if retention is None:
+            print("No retention policy is configured")
+            return None
+        if not self._object_db.isMigrated("version_entries"):
+            print("References of old versions are unknown, garbage is not collected")
+            return None
+        # finish the deletions of the previous collection
+        if not self._delete_collected_objects():
+            return None
+        self._abort_stale_uploads()
+        versions = self._list_versions()
+        if not versions:
+            return 0
+        keep = retention.select(versions)
+        collected = sorted(version for version, _ in versions if version not in keep)
+        survivors = sorted(keep)
+        if not collected:
+            return 0
+
+        # versions whose delta is based on a collected version are rewritten
+        # as snapshots, before anything is deleted
+        snapshots = []
+        for version in survivors:
+            manifest_path = self._get_manifest_path(version)
+            if os.path.isfile(manifest_path) and \
+                    Manifest.read(manifest_path).base_version in collected:
+                snapshots.append((version, self._load_manifest(version)))
+        for version, manifest in snapshots:
+            manifest.save(self._get_manifest_path(version))
+            if not self.upload_new_metadata(self._get_manifest_path(version)):
+                print("Cannot upload the snapshot of version {}, garbage is not "
+                      "collected".format(version))
+                return None
+
+        pinned = set()
+        pending_packs = []
+        for path in self._load_pending_uploads():
+            if os.path.dirname(path) == self._file_objects_dir:
+                pinned.add(int(os.path.basename(path)))
+            else:
+                pending_packs.append(self._get_object_name(path))
+        with self._object_db.transaction():
+            pinned.update(self._object_db.queryPackFileIds(pending_packs))
+            # entries whose versions were all collected
+            dead_entries = []
+            for entry_id, first_version, end_version in \
+                    self._object_db.queryEndedEntries(collected[0], collected[-1]):
+                i = bisect.bisect_left(survivors, first_version)
+                if i == len(survivors) or survivors[i] >= end_version:
+                    dead_entries.append(entry_id)
+            file_ids, dead_paths = self._object_db.deleteEntries(dead_entries)
+            # and file objects of versions which were never committed
+            file_ids = set(file_ids)
+            file_ids.update(self._object_db.queryUnreferencedObjects())
+            file_ids = sorted(file_ids - pinned)
+            packs, unpacked_file_ids = self._object_db.deleteObjects(file_ids)
+            empty_packs = self._object_db.queryEmptyPacks(sorted(packs))
+            self._object_db.deletePacks(empty_packs)
+            self._object_db.deleteVersions(collected)
+            # records of the files of the deleted entries may refer to deleted
+            # file objects (records of versions which were never committed
+            # are checked when they are reused, see _reuse_file_record)
+            deleted = set(file_ids)
+            self._object_db.deleteFileRecords([
+                    path for path, record_file_ids in
+                    self._object_db.queryFileRecordIds(sorted(dead_paths)).items()
+                    if not deleted.isdisjoint(record_file_ids)])
+        # trees of the collected versions, once they are not in ObjectDB
+        self._merkle_tree.delete_versions(collected, survivors)
+
+        object_names = []
+        paths = []
+        for version in collected:
+            manifest_path = self._get_manifest_path(version)
+            object_names.append(self._get_object_name(manifest_path))
+            paths.append(manifest_path)
+            legacy_metadata_dir = os.path.join(self._metadata_dir, "v{}".format(version))
+            if os.path.isdir(legacy_metadata_dir):
+                object_names += [self._get_object_name(path) for path in
+                                 self._list_metadata_paths(legacy_metadata_dir)]
+        object_names += empty_packs
+        object_names += ["file_objects/{}".format(file_id) for file_id in unpacked_file_ids]
+        paths += [os.path.join(self._file_objects_dir, str(file_id)) for file_id in file_ids]
+        # recorded before deleting, so that the deletions are retried by the
+        # next collection if the program stops
+        save_json({"objects": object_names, "paths": paths}, self._PENDING_DELETES_FILEPATH)
+        deleted = self._delete_collected_objects()
+        for version in collected:
+            shutil.rmtree(os.path.join(self._metadata_dir, "v{}".format(version)),
+                          ignore_errors=True)
+        self._manifest_cache = None
+        inc("gc_versions", len(collected))
+        inc("gc_objects", len(file_ids))
+        inc("gc_packs", len(empty_packs))
+        print("Collected {} version(s), {} file object(s) and {} pack(s)".format(
+                len(collected), len(file_ids), len(empty_packs)))
+        if deleted:
+            # the deletions of old packs would overwrite the failed ones
+            self._rewrite_sparse_packs(pending_packs)
+        return len(collected)
+
+
+    def _rewrite_sparse_packs(self, excluded_packs=()):
+        """
+        Rewrite the packs in which collected file objects take more than
+        repack_threshold of the size: their live file objects are downloaded
+        and appended into new packs, which are uploaded and recorded in
+        ObjectDB before the old packs are deleted. File ids do not change,
+        so manifests and file records still refer to the same file objects.
+        :param excluded_packs: S3 object names of the packs not uploaded yet
+        :return: list of S3 object names of the rewritten packs
+        """
+        packs = [pack for pack in self._object_db.querySparsePacks(self._repack_threshold)
+                 if pack not in excluded_packs]
+        if not packs:
+            return []
+        pack_entries = self._object_db.queryPackEntries(
+                sorted(self._object_db.queryPackFileIds(packs)))
+        digests = self._object_db.queryObjectDigests(list(pack_entries))
+        ranges = {}
+        for pack, offset, length, members in coalesce_ranges(
+                [(file_id, pack, offset, length)
+                 for file_id, (pack, offset, length) in pack_entries.items()]):
+            ranges[(pack, offset, length)] = members
+
+        def save_file_objects(request, data):
+            # runs in the download threads
+            with memoryview(data) as view:
+                for file_id, offset, length in ranges[request]:
+                    file_object = view[offset:offset + length]
+                    if file_id in digests and \
+                            sha256Bytes(file_object).hex() != digests[file_id][0]:
+                        raise Exception("File object {} is modified!".format(file_id))
+                    with open(os.path.join(self._repack_dir, str(file_id)), "wb") as f:
+                        f.write(file_object)
+
+        shutil.rmtree(self._repack_dir, ignore_errors=True)
+        make_dirs(self._repack_dir)
+        new_packs = []
+        try:
+            with timer("repack"):
+                for _ in self._user.download_ranges(
+                        self._bucket, list(ranges), save_file_objects):
+                    pass
+                # file objects keep their order in the old packs
+                new_packs = write_packs(
+                        [(file_id, os.path.join(self._repack_dir, str(file_id)))
+                         for file_id in sorted(pack_entries, key=pack_entries.get)],
+                        self._packs_dir, self._pack_size)
+                failed = self._user.upload_files(
+                        [(pack_path, self._get_object_name(pack_path))
+                         for pack_path, _ in new_packs], self._bucket)
+            if failed:
+                raise Exception("{} pack(s) are not uploaded".format(len(failed)))
+        except Exception as e:
+            print("Cannot rewrite packs: ", e)
+            self._user.delete_objects(self._bucket, [
+                    self._get_object_name(pack_path) for pack_path, _ in new_packs])
+            return []
+        finally:
+            shutil.rmtree(self._repack_dir, ignore_errors=True)
+            for pack_path, _ in new_packs:
+                os.remove(pack_path)
+        with self._object_db.transaction():
+            for pack_path, entries in new_packs:
+                self._object_db.insertPackEntries(
+                        self._get_object_name(pack_path), entries)
+            self._object_db.deletePacks(packs)
+        save_json({"objects": packs, "paths": []}, self._PENDING_DELETES_FILEPATH)
+        self._delete_collected_objects()
+        inc("gc_repacked_packs", len(packs))
+        inc("gc_repacked_bytes", sum(length for _, _, length in pack_entries.values()))
+        print("Rewrote {} pack(s) into {} pack(s)".format(len(packs), len(new_packs)))
+        return packs
+
+
+    def _delete_collected_objects(self):
+        """
+        Delete the S3 objects and local files of the last garbage collection.
+        Objects which could not be deleted are kept for the next collection.
+        :return: True if all objects were deleted
+        """
+        if not os.path.isfile(self._PENDING_DELETES_FILEPATH):
+            return True
+        pending = load_json(self._PENDING_DELETES_FILEPATH)
+        for path in pending["paths"]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        failed = self._user.delete_objects(self._bucket, pending["objects"])
+        if failed:
+            print("Cannot delete {} object(s), they are deleted by the next "
+                  "garbage collection".format(len(failed)))
+            save_json({"objects": failed, "paths": []}, self._PENDING_DELETES_FILEPATH)
+            return False
+        os.remove(self._PENDING_DELETES_FILEPATH)
+        return True
+
+
+    def _is_snapshot_version(self, version):
+        """
+        A version stores a full snapshot of its manifest every
+        snapshot_interval versions, and when the previous version has no
+        manifest, otherwise only a delta from the previous version.
+        """
+        return (version - 1) % self._snapshot_interval == 0 \
+                or not os.path.isfile(self._get_manifest_path(version - 1))
 
 
-    def upload_new_metadata(self, new_metadata_dir):
+    def _load_manifest(self, version):
         """
-        Upload new version of metadata.
-        :param: new_metadata_dir: directory of new metadata
-        :return:
+        Load the full manifest of a version backed up on this machine, from
+        the nearest snapshot and the deltas after it. Versions backed up
+        before manifests were introduced are read from their directory of
+        per-file metadata.
+        :param version: integer, version number
+        :return: Manifest of the version, empty if there is no such version
         """
-        for path in os.listdir(new_metadata_dir):
-            metadata_path = os.path.join(new_metadata_dir, path)
+        if self._manifest_cache is not None and self._manifest_cache.version == version:
+            return self._manifest_cache
+        deltas = []
+        manifest_version = version
+        while os.path.isfile(self._get_manifest_path(manifest_version)):
+            manifest = Manifest.read(self._get_manifest_path(manifest_version))
+            if manifest.is_snapshot():
+                break
+            deltas.append(manifest)
+            manifest_version = manifest.base_version
+        else:
+            if deltas:
+                raise Exception("Manifest of version {} is missing"
+                                .format(manifest_version))
+            manifest = Manifest(version)
+            legacy_metadata_dir = os.path.join(self._metadata_dir, "v{}".format(version))
+            if os.path.isdir(legacy_metadata_dir):
+                for _, metadata in self._list_metadata_of_version(legacy_metadata_dir):
+                    manifest.add(metadata)
+        for delta in reversed(deltas):
+            manifest = manifest.apply(delta)
+        self._manifest_cache = manifest
+        return manifest
+
+
+    def _list_metadata_paths(self, metadata_dir):
+        """
+        Recursively list the metadata files of a metadata directory.
+        :param metadata_dir: directory of metadata
+        :return: list of paths of metadata files
+        """
+        metadata_paths = []
+        for path in os.listdir(metadata_dir):
+            metadata_path = os.path.join(metadata_dir, path)
             if os.path.isfile(metadata_path):
-                object_name = os.path.relpath(metadata_path, self._PREFIX_PATH)
-                object_name = replace_backslashes_with_forward_slashes(object_name)
-                self._user.upload_file(metadata_path, self._bucket, object_name)
+                metadata_paths.append(metadata_path)
             else:
-                self.upload_new_metadata(metadata_path)
+                metadata_paths += self._list_metadata_paths(metadata_path)
+        return metadata_paths
+
+
+    def upload_new_metadata(self, new_manifest_path):
+        """
+        Upload the manifest of the new version, as a single object.
+        :param: new_manifest_path: path of the manifest of the new version
+        :return: True if the manifest was uploaded, False otherwise
+        """
+        failed = self._user.upload_files(
+                [(new_manifest_path, self._get_object_name(new_manifest_path))],
+                self._bucket)
+        return not failed
+
+
+    def _discard_uncommitted_version(self):
+        """
+        Drop the local manifest of the current version after its upload
+        failed, so that the changes are backed up again in the next cycle.
+        """
+        print("Version {} could not be uploaded and is not committed."
+                .format(self._version))
+        manifest_path = self._get_manifest_path(self._version)
+        if os.path.isfile(manifest_path):
+            os.remove(manifest_path)
+        self._version -= 1
+        if self._watcher is not None:
+            # the changes seen by inotify were consumed by this version
+            self._watcher.request_full_rescan()
 
 
     def encrypt_data_keys(self, data_keys):
@@ -293,7 +1104,7 @@ class BackupProgram(object):
         :param file_ids: list integer, ids of file objects 
             which are chunks of this file
         :param data_keys: list string, keys to encrypt/decrypt file objects
-        :return
+        :return: the new Metadata, added to the manifest of the new version
         """
 
         encrypted_data_keys = self.encrypt_data_keys(data_keys)
@@ -302,52 +1113,346 @@ class BackupProgram(object):
                 filepath, self._backup_folder)
         metadata = Metadata(relative_path_from_backup_root, file_ids, 
                 encrypted_data_keys, self._version)
-        path = os.path.join(self._metadata_dir, "v{}".format(self._version),
-                relative_path_from_backup_root + ".metadata")
-        make_dirs(os.path.dirname(path))
-        metadata.save(path)
-        return path
+        self._new_manifest.add(metadata)
+        self._new_metadata.append(metadata)
+        return metadata
+
+    def _get_hashes_of_file_objects(self, file_ids):
+        """
+        Get the hashes of the encrypted file objects of a file, as recorded
+        in ObjectDB when they were created. File objects without a recorded
+        hash are hashed from their local copy, and their hash is recorded.
+        :param file_ids: list of integers, ids of file objects
+        :return: list of SHA256 of file objects, in the order of file_ids
+        """
+        digests = self._object_db.queryObjectDigests(file_ids)
+        missing = [file_id for file_id in set(file_ids) if file_id not in digests]
+        if missing:
+            digests.update(self._hash_local_file_objects(missing))
+            for file_id in missing:
+                if file_id not in digests:
+                    raise Exception("File object {} is not found".format(file_id))
+        return [bytes.fromhex(digests[file_id][0]) for file_id in file_ids]
+
+    def _hash_local_file_objects(self, file_ids):
+        """
+        Hash local encrypted file objects, and record their hashes and sizes
+        in ObjectDB.
+        :param file_ids: list of integers, ids of file objects
+        :return: dictionary, with key is file_id and value is a tuple
+            (digest, size) of the file objects found locally
+        """
+        digests = {}
+        for file_id in file_ids:
+            file_object_path = os.path.join(self._file_objects_dir, str(file_id))
+            if not os.path.isfile(file_object_path):
+                continue
+            with timer("hashing"):
+                digests[file_id] = (sha256File(file_object_path).hex(),
+                                    os.path.getsize(file_object_path))
+        self._object_db.setObjectDigests(
+                [(file_id, digest, size) for file_id, (digest, size) in digests.items()])
+        return digests
 
+    def _backfill_object_digests(self):
+        """
+        Record the hashes of the file objects created before hashes were
+        recorded in ObjectDB, once, from their local copies.
+        """
+        file_ids = self._object_db.queryObjectsWithoutDigest()
+        if file_ids:
+            digests = self._hash_local_file_objects(file_ids)
+            print("Recorded the hashes of {} file objects".format(len(digests)))
 
-    def _copy_old_metadata_and_get_set_file_ids_if_unmodified(self, list_unmodified_files):
+    def _update_merkle_tree(self, removed_paths):
+        """
+        Update the Merkle tree with the files of the new version. Only the
+        files with new metadata in this version are hashed, unless the
+        previous version is not in the tree (e.g. it was backed up before
+        versions had Merkle roots), in which case all files are.
+        :param removed_paths: list of paths, relative to the backup folder,
+            of the files of the previous version which were removed
+        :return: hex string of the Merkle root of the new version
+        """
+        list_metadata = self._new_metadata
+        if self._version > 1 and \
+                self._merkle_tree.get_root(self._version - 1) is None:
+            list_metadata = self._new_manifest.list_metadata()
+
+        changes = {}
+        for metadata in list_metadata:
+            changes[metadata.filename] = MerkleTree.leaf_hash(
+                    metadata.filename, metadata.computeHash(),
+                    self._get_hashes_of_file_objects(metadata.file_ids))
+        for path in removed_paths:
+            changes[path] = None
+        return self._merkle_tree.update(self._version, changes)
+
+
+    def _get_file_record_if_same_size(self, filepath, stat_result):
+        """
+        Get the record of the content of a file when it was last backed up,
+        if the file still has the same size (so that it may be unchanged).
+        :param filepath: path of file
+        :param stat_result: result of os.stat of file
+        :return: tuple (inode, size, mtime_ns, digest, chunk_hashes, file_ids),
+            or None if there is no record or the size changed
+        """
+        record = self._object_db.queryFileRecord(
+                os.path.relpath(filepath, self._backup_folder))
+        if record is None or record[1] != stat_result.st_size:
+            return None
+        return record
+
+    def _save_file_record(self, filepath, stat_result, digest, chunk_hashes,
+                          file_ids):
+        """
+        Save the record of the content of a backed up file, so that it is
+        not chunked again if only its stat changes.
+        """
+        self._object_db.insertFileRecord(
+                os.path.relpath(filepath, self._backup_folder),
+                stat_result.st_ino, stat_result.st_size,
+                stat_result.st_mtime_ns, digest, chunk_hashes, file_ids)
+
+    def _reuse_file_record(self, filepath, stat_result, record):
+        """
+        Create new metadata of a modified file whose content did not change,
+        from the file ids of its record, without chunking it.
+        :return: list of ids of file objects of the file, or None if some of
+            them were collected (the record is of a version which was never
+            committed)
+        """
+        _, _, _, digest, chunk_hashes, file_ids = record
+        try:
+            data_keys = self._object_db.queryDataKeys(file_ids)
+        except KeyError:
+            return None
+        self._save_file_record(filepath, stat_result, digest, chunk_hashes,
+                               file_ids)
+        self._create_new_metadata_of_modified_file(filepath, file_ids, data_keys)
+        return file_ids
+
+    def _insert_new_objects(self, chunks, new_objects):
+        """
+        Find the file objects of the chunks of a file in ObjectDB with a
+        single lookup, and insert the chunks which are not there yet with
+        the data keys and file objects created by _backup_file.
+        :param chunks: list of tuples (offset, length, hash) of chunks of a
+            file, in order
+        :param new_objects: dictionary of the file objects encrypted for the
+            version in progress, see _pool_new_objects; the file objects
+            inserted are removed from it
+        :return: tuple (file_ids, data_keys, new_file_object_paths), where:
+            file_ids: list of ids of file objects of the chunks,
+            data_keys: list of keys to encrypt/decrypt the file objects,
+            new_file_object_paths: list of paths of the new file objects.
+        """
+        chunk_hashes = [h for _, _, h in chunks]
+        found = self._object_db.queryMany(chunk_hashes)
+        new_hashes = [h for h in dict.fromkeys(chunk_hashes) if h not in found]
+        if any(h not in new_objects for h in new_hashes):
+            raise Exception("A chunk was neither found in ObjectDB nor encrypted")
+        lengths = dict((h, length) for _, length, h in chunks)
+        new_rows = [(h, new_objects[h][0], lengths[h]) for h in new_hashes]
+        new_file_object_paths = []
+        digest_rows = []
+        for (h, data_key, _), file_id in zip(
+                new_rows, self._object_db.insertMany(new_rows)):
+            found[h] = (file_id, data_key)
+            _, path, compressed_size, object_digest, object_size = new_objects.pop(h)
+            file_object_path = os.path.join(self._file_objects_dir, str(file_id))
+            os.replace(path, file_object_path)
+            new_file_object_paths.append(file_object_path)
+            digest_rows.append((file_id, object_digest, object_size))
+            inc("compressed_bytes", compressed_size)
+        self._object_db.setObjectDigests(digest_rows)
+        inc("new_chunks", len(new_rows))
+        inc("encrypted_bytes", sum(lengths[h] for h in new_hashes))
+        file_ids = [found[h][0] for h in chunk_hashes]
+        data_keys = [found[h][1] for h in chunk_hashes]
+        return file_ids, data_keys, new_file_object_paths
+
+    @staticmethod
+    def _pool_new_objects(new_objects, result):
+        """
+        Add the file objects encrypted for a file by _backup_file to the
+        file objects of the version in progress. A chunk encrypted again
+        (by another worker) keeps the first file object.
+        :param new_objects: dictionary, with key is the hash of a chunk and
+            value is a tuple (data_key, path, compressed_size, object_digest,
+            object_size), as in the return value of _backup_file
+        :param result: return value of _backup_file
+        :return: tuple (chunks, digest) of result, or None if the file was
+            modified while it was read
+        """
+        if result is None:
+            return None
+        chunks, digest, file_new_objects = result
+        for h, new_object in file_new_objects.items():
+            if h in new_objects:
+                os.remove(new_object[1])
+            else:
+                new_objects[h] = new_object
+        return chunks, digest
+
+    def _add_backed_up_file(self, filepath, stat_result, record, result,
+                            new_objects):
+        """
+        Record a file read by _backup_file in ObjectDB and create its new
+        metadata. A file whose content did not change (only its stat did)
+        reuses the file ids of its record. A file which was modified while
+        it was read keeps its previous metadata, and is backed up again by
+        the next version.
+        :param filepath: path of modified file
+        :param stat_result: result of os.stat of file before it was read
+        :param record: record of the file if it has the same size, or None
+        :param result: return value of _pool_new_objects
+        :param new_objects: dictionary of the file objects encrypted for the
+            version in progress, see _pool_new_objects
+        :return: list of paths of the new file objects of the file
+        """
+        if result is None:
+            print("File {} was modified while it was backed up, it is backed up "
+                  "by the next version".format(filepath))
+            inc("files_skipped")
+            old_metadata = self._load_manifest(self._version - 1).get(
+                    os.path.relpath(filepath, self._backup_folder))
+            if old_metadata is not None:
+                self._new_manifest.add(old_metadata)
+            return []
+        chunks, digest = result
+        inc("chunked_bytes", sum(length for _, length, _ in chunks))
+        inc("chunks", len(chunks))
+        if record is not None and record[3] == digest:
+            if self._reuse_file_record(filepath, stat_result, record) is not None:
+                inc("files_reused")
+                return []
+
+        chunk_hashes = [h for _, _, h in chunks]
+        file_ids, data_keys, new_file_object_paths = \
+                self._insert_new_objects(chunks, new_objects)
+        self._create_new_metadata_of_modified_file(
+            filepath, file_ids, data_keys)
+        self._save_file_record(filepath, stat_result, digest,
+                               chunk_hashes, file_ids)
+        return new_file_object_paths
+
+    def _add_backed_up_files(self, backed_up, new_objects):
+        """
+        Record the files read by _backup_file in ObjectDB, and create their
+        new metadata. All changes of ObjectDB for the version are committed
+        in a single transaction, which only lasts while the files are
+        recorded, so that the anchor thread is not locked out of ObjectDB
+        while files are read and encrypted.
+        :param backed_up: list of tuples (filepath, stat_result, record,
+            result), see _add_backed_up_file
+        :param new_objects: dictionary of the file objects encrypted for the
+            version in progress, see _pool_new_objects
+        :return: list of paths of new file objects
+        """
+        new_file_object_paths = []
+        with self._object_db.transaction():
+            for filepath, stat_result, record, result in backed_up:
+                new_file_object_paths += self._add_backed_up_file(
+                        filepath, stat_result, record, result, new_objects)
+            self._object_db.touchObjects(
+                    [int(os.path.basename(path)) for path in new_file_object_paths],
+                    time.time_ns())
+        # chunks found in ObjectDB after they were encrypted, and chunks of
+        # files whose content did not change
+        for _, path, _, _, _ in new_objects.values():
+            os.remove(path)
+        return new_file_object_paths
+
+    def _backup_modified_files(self, list_modified_files):
+        """
+        Chunk, deduplicate and encrypt modified files, reading each of them
+        once, and create their new metadata. Files whose content did not
+        change (only their stat did) reuse the file ids of their record.
+        :param list_modified_files: list of strings, each string is
+            a path of a modified file
+        :return: list of paths of new file objects
+        """
+        new_objects = {}
+        backed_up = []
+        # file objects left by a cycle which stopped
+        shutil.rmtree(self._new_objects_dir, ignore_errors=True)
+        make_dirs(self._new_objects_dir)
+        for filepath in list_modified_files:
+            print(filepath)
+            stat_result = os.stat(filepath)
+            record = self._get_file_record_if_same_size(filepath, stat_result)
+            with timer("chunking"):
+                result = _backup_file(filepath, stat_result, self._chunker,
+                        self._compressor, self._new_objects_dir,
+                        lambda h: h in new_objects
+                                  or self._object_db.query(h)[0] is not None)
+            backed_up.append((filepath, stat_result, record,
+                              self._pool_new_objects(new_objects, result)))
+        return self._add_backed_up_files(backed_up, new_objects)
+
+    def _backup_modified_files_parallel(self, list_modified_files):
+        """
+        Same as _backup_modified_files, but files are read, hashed and
+        encrypted by a pool of self._workers processes, whose timers are
+        added to the metrics of this process (so compression and encryption
+        seconds are summed over the workers). Queries and inserts
+        in ObjectDB and metadata creation are still done in this process,
+        in the order of list_modified_files, so file ids and the order of
+        Metadata.file_ids are the same as in sequential mode.
+        :param list_modified_files: list of strings, each string is
+            a path of a modified file
+        :return: list of paths of new file objects
         """
-        Copy metadata of old version to current version
+        new_objects = {}
+        backed_up = []
+        # file objects left by a cycle which stopped
+        shutil.rmtree(self._new_objects_dir, ignore_errors=True)
+        make_dirs(self._new_objects_dir)
+        stat_results = [os.stat(filepath) for filepath in list_modified_files]
+        records = [self._get_file_record_if_same_size(filepath, stat_result)
+                   for filepath, stat_result in zip(list_modified_files, stat_results)]
+        with ProcessPoolExecutor(max_workers=self._workers) as pool:
+            futures = [pool.submit(_backup_file_in_worker, self._object_db_path,
+                                   filepath, stat_result, self._chunker,
+                                   self._compressor, self._new_objects_dir)
+                       for filepath, stat_result in zip(list_modified_files, stat_results)]
+            for filepath, stat_result, record, future in zip(
+                    list_modified_files, stat_results, records, futures):
+                print(filepath)
+                # time spent waiting for the workers
+                with timer("chunking"):
+                    result, worker_metrics = future.result()
+                METRICS.add_changes(worker_metrics)
+                backed_up.append((filepath, stat_result, record,
+                                  self._pool_new_objects(new_objects, result)))
+        return self._add_backed_up_files(backed_up, new_objects)
+
+    def _copy_old_metadata_of_unmodified_files(self, list_unmodified_files):
+        """
+        Copy metadata of old version to the manifest of current version
         :param list_unmodified_files: list of strings, each string is
             a path of an unmodified file
-        :return: set of integers, containing file ids of unmodified files
         """
-        set_file_ids = set()
+        old_manifest = self._load_manifest(self._version - 1)
         for filepath in list_unmodified_files:
             relative_path_from_backup_root = os.path.relpath(
                     filepath, self._backup_folder)
-            new_version_path = os.path.join(
-                    self._metadata_dir, "v{}".format(self._version),
-                relative_path_from_backup_root + ".metadata")
-            old_version_path = os.path.join(
-                self._metadata_dir, "v{}".format(self._version - 1),
-                relative_path_from_backup_root + ".metadata")
-            make_dirs(os.path.dirname(new_version_path))
-            if os.path.isfile(old_version_path):
+            old_metadata = old_manifest.get(relative_path_from_backup_root)
+            if old_metadata is not None:
                 # file already exists
-                shutil.copy(old_version_path, new_version_path)
-                file_ids = Metadata.read(new_version_path).file_ids
-                for file_id in file_ids:
-                    set_file_ids.add(file_id)
+                self._new_manifest.add(old_metadata)
             else:
                 # deal with duplicated file: create new metadata for them
-                chunk_paths_and_hashes = \
-                        self._object_db.get_chunk_paths_and_hashes(filepath)
-                file_ids = []
-                data_keys = []
-                for chunk_path, h in chunk_paths_and_hashes.items():
-                    file_id, data_key = self._object_db.query(h)
-                    file_ids.append(file_id)
-                    data_keys.append(data_key)
+                chunk_hashes = [h for _, h in
+                                self._object_db.get_chunks_and_hashes(filepath)]
+                found = self._object_db.queryMany(chunk_hashes)
+                file_ids = [found.get(h, (None, None))[0] for h in chunk_hashes]
+                data_keys = [found.get(h, (None, None))[1] for h in chunk_hashes]
                 self._create_new_metadata_of_modified_file(
                     filepath, file_ids, data_keys)
 
-        return set_file_ids
-
     def flush_version_to_file(self):
         with open(self._VERSION_FILEPATH, "w") as f:
             f.write(str(self._version))
@@ -407,44 +1512,78 @@ class BackupProgram(object):
         return set_file_object_ids
 
 
-    def _retrieve_backup_data_from_file_objects_and_metadata(self,
-            encrypted_file_objects_dir, metadata_dir, backup_data_dir,
-            original_metadata_dir):
+    def _list_metadata_of_version(self, metadata_dir):
         """
-        Decrypt data keys by control key, then decrypt file objects by data
-        key and join these file objects
-        :param encrypted_file_objects_dir: string, path of directory containing
-            encrypted file objects downloaded from S3
-        :param metadata_dir: string, path of metadata_dir
-        :param backup_data_dir: string, path of folder containing retrieved backup
-            data
-        :param original_metadata_dir: metadata dir in the first call
-            (not recursive)
-        :return
+        Read the metadata of all files of a downloaded version.
+        :param metadata_dir: string, path of metadata dir of the version
+        :return: list of tuples (path, metadata), where path is the path of
+            the backed up file relative to the backup folder
         """
-        for metadata_path in os.listdir(metadata_dir):
-            metadata_path = os.path.join(metadata_dir, metadata_path)
-            if os.path.isfile(metadata_path):
-                backup_file_path_rel = os.path.relpath(
-                        metadata_path, original_metadata_dir)
-                backup_file_path_rel = backup_file_path_rel[
-                        :backup_file_path_rel.find(".metadata")]
-                metadata = Metadata.read(metadata_path)
-                data_keys = self.decrypt_data_keys(metadata.encrypted_data_keys)
-                backup_file_path = os.path.join(
-                        backup_data_dir, backup_file_path_rel)
-                make_dirs(os.path.dirname(backup_file_path))
-                with open(backup_file_path, "wb") as f:
-                    for file_id, data_key in \
-                            zip(metadata.file_ids, data_keys):
-                        encrypted_file_object_path = os.path.join(
-                                encrypted_file_objects_dir, str(file_id))
-                        chunk = decryptFile(data_key, encrypted_file_object_path)
-                        f.write(chunk)
-            else:
-                self._retrieve_backup_data_from_file_objects_and_metadata(
-                    encrypted_file_objects_dir, metadata_path, backup_data_dir,
-                    original_metadata_dir)
+        list_metadata = []
+        for metadata_path in self._list_metadata_paths(metadata_dir):
+            backup_file_path_rel = os.path.relpath(metadata_path, metadata_dir)
+            backup_file_path_rel = backup_file_path_rel[
+                    :backup_file_path_rel.rfind(".metadata")]
+            list_metadata.append((backup_file_path_rel, Metadata.read(metadata_path)))
+        return list_metadata
+
+    def _download_metadata_of_version(self, version, backup_dir):
+        """
+        Download the manifest of a version, with the nearest snapshot and
+        the deltas between them, or the per-file metadata of a version
+        backed up before manifests were introduced.
+        :param version: integer, version number
+        :param backup_dir: string, folder into which metadata are downloaded
+        :return: list of tuples (path, metadata), as returned by
+            _list_metadata_of_version, or None if the version has no
+            metadata on S3
+        """
+        manifest_object_name = self._get_object_name(
+                self._get_manifest_path(version))
+        if not self._user.object_exists(self._bucket, manifest_object_name):
+            self._user.download_folder(self._bucket,
+                    "metadata/v{}/".format(version), backup_dir)
+            metadata_dir = os.path.join(backup_dir, "metadata", "v{}".format(version))
+            if not os.path.isdir(metadata_dir) or not os.listdir(metadata_dir):
+                return None
+            return self._list_metadata_of_version(metadata_dir)
+
+        deltas = []
+        while True:
+            for _, data in self._user.download_objects(
+                    self._bucket, [manifest_object_name]):
+                manifest_path = os.path.join(backup_dir, manifest_object_name)
+                make_dirs(os.path.dirname(manifest_path))
+                with open(manifest_path, "wb") as f:
+                    f.write(data)
+                manifest = Manifest.from_bytes(data)
+            if manifest.is_snapshot():
+                break
+            deltas.append(manifest)
+            manifest_object_name = self._get_object_name(
+                    self._get_manifest_path(manifest.base_version))
+        for delta in reversed(deltas):
+            manifest = manifest.apply(delta)
+        return [(metadata.filename, metadata)
+                for metadata in manifest.list_metadata()]
+
+    def _create_restore_assembler(self, list_metadata, staging_data_dir,
+            hash_function=sha256Bytes, verify_file=None, local_objects_dir=None):
+        """
+        :param list_metadata: list of tuples (path, metadata) of the files
+            to retrieve, as returned by _list_metadata_of_version
+        :param staging_data_dir: string, path of folder into which files
+            are retrieved
+        :return: RestoreAssembler retrieving the files from their file
+            objects, see RestoreAssembler for the other parameters
+        """
+        data_keys = {}
+        for _, metadata in list_metadata:
+            data_keys.update(zip(metadata.file_ids,
+                    self.decrypt_data_keys(metadata.encrypted_data_keys)))
+        return RestoreAssembler(self._user, self._bucket, self._object_db,
+                list_metadata, data_keys, staging_data_dir, hash_function,
+                verify_file, local_objects_dir)
 
     def retrieve_backup(self):
         try:
@@ -474,50 +1613,259 @@ class BackupProgram(object):
         except Exception as e:
             print(f"Error: {e}")
 
+        self.restore_version(retrieve_version, backup_dir)
+
+    def restore_version(self, retrieve_version, backup_dir, patterns=None):
+        """
+        Retrieve a backup version without prompting, and verify it against
+        its anchored root. The timers and counters of the restore are
+        written to the metrics directory.
+        :param retrieve_version: integer, version number
+        :param backup_dir: string, folder where the files of the version are
+            written, into subfolder v<version>/data
+        :param patterns: optional list of paths or glob patterns, relative to
+            the backup folder, to retrieve only the matching files (see
+            _match_paths); only their file objects are downloaded
+        :return: True if the version (or the matching files) was retrieved
+            and verified
+        """
+        METRICS.start_cycle()
+        restored = None
+        try:
+            restored = self._restore_version(retrieve_version, backup_dir, patterns)
+            return restored
+        finally:
+            info = {"kind": "restore", "version": retrieve_version,
+                    "restored": restored}
+            if patterns:
+                info["patterns"] = list(patterns)
+            self._write_metrics(info)
+
+    @staticmethod
+    def _match_paths(list_metadata, patterns):
+        """
+        Select the files of a version matching path patterns. A pattern
+        matches a file if it is the path of the file or of one of its
+        folders, or a glob pattern (fnmatch, where * also matches /)
+        matching the path of the file.
+        :param list_metadata: list of tuples (path, metadata)
+        :param patterns: list of strings, paths relative to the backup folder
+            with forward slashes, or glob patterns
+        :return: list of tuples (path, metadata) of matching files
+        """
+        patterns = [replace_backslashes_with_forward_slashes(pattern).strip("/")
+                    for pattern in patterns]
+        matches = []
+        for path, metadata in list_metadata:
+            path = replace_backslashes_with_forward_slashes(path)
+            if any(path == pattern or path.startswith(pattern + "/")
+                   or fnmatch.fnmatchcase(path, pattern) for pattern in patterns):
+                matches.append((path, metadata))
+        return matches
+
+    def _restore_version(self, retrieve_version, backup_dir, patterns=None):
+        # Get id of transaction corresponding to this version on the anchor;
+        # versions which never existed or were collected have none
+        version_anchor = self._object_db.queryVersionAnchor(retrieve_version)
+        if version_anchor is None:
+            print("Version {} is not found!".format(retrieve_version))
+            return False
+
         # Download metadata
         backup_dir = os.path.join(backup_dir, "v{}".format(retrieve_version))
         metadata_dir = os.path.join(backup_dir, "metadata/v{}".format(retrieve_version))
-        # NOTE: comment 2 lines below for test
-        self._user.download_folder(self._bucket,
-                "metadata/v{}".format(retrieve_version), backup_dir)
-
-        # Download encrypted file objects
-        encrypted_file_objects_dir = os.path.join(backup_dir, ".tmp")
-        make_dirs(encrypted_file_objects_dir)
-        set_file_object_ids = self._get_file_object_ids_from_metadata(metadata_dir)
-        print(set_file_object_ids)
-        # NOTE: comment 4 lines below for test
-        for file_id in set_file_object_ids:
-            object_name = "file_objects/{}".format(file_id)
-            file_name = os.path.join(encrypted_file_objects_dir, str(file_id))
-            self._user.download_file(file_name, self._bucket, object_name)
-
-        # Compute hash of downloaded files and compare with hash of this version on eth
-        hashes_of_file_objects = get_hash_list_file_objects(
-                encrypted_file_objects_dir, set_file_object_ids)
-        hashes_of_metadata = recursive_get_hash_list(metadata_dir)
-        hashList = hashes_of_file_objects + hashes_of_metadata
-        allHashes = sha256(hashList).hex()
+        list_metadata = self._download_metadata_of_version(
+                retrieve_version, backup_dir)
+        if list_metadata is None:
+            print("Metadata of version {} is not found!".format(retrieve_version))
+            return False
+        if patterns:
+            list_metadata = self._match_paths(list_metadata, patterns)
+            print("{} file(s) of version {} match {}".format(
+                    len(list_metadata), retrieve_version, " ".join(patterns)))
+            if not list_metadata:
+                return False
+
+        txn_hash, anchored_root, proof = version_anchor
+        if not txn_hash:
+            print("Version {} is not anchored yet, it is only checked against "
+                  "the local Merkle tree".format(retrieve_version))
+            allHashesStoredOnEth = anchored_root
+        else:
+            print("txn_hash = ", txn_hash)
+            with timer("anchor", op="retrieve"):
+                allHashesStoredOnEth = self._get_anchor().retrieve(txn_hash)
+            print("hash store on anchor:          ", allHashesStoredOnEth)
+            if proof is not None:
+                # the root of the version was anchored with a batch of versions
+                if not verify_aggregate_proof(allHashesStoredOnEth,
+                        retrieve_version, anchored_root, proof):
+                    print("Root of version {} is not anchored!"
+                            .format(retrieve_version))
+                    return False
+                allHashesStoredOnEth = anchored_root
+        root = self._merkle_tree.get_root(retrieve_version)
+        if root is not None and root != allHashesStoredOnEth:
+            print("Merkle tree of version {} does not match the anchor!"
+                    .format(retrieve_version))
+            return False
+        if root is None and not os.path.isdir(metadata_dir):
+            # only versions with per-file metadata can be checked without
+            # the Merkle tree
+            print("Merkle tree of version {} is not found!".format(retrieve_version))
+            return False
+        if root is None and patterns:
+            # the hash of all hashes can only be checked with all files
+            print("Version {} has no Merkle tree, it can only be retrieved "
+                  "entirely".format(retrieve_version))
+            return False
+
+        def verify_file(metadata, object_hashes):
+            # check the inclusion proof of the file in the anchored root
+            leaf_hash = MerkleTree.leaf_hash(
+                    metadata.filename, metadata.computeHash(), object_hashes)
+            proof = self._merkle_tree.get_proof(retrieve_version, metadata.filename)
+            return MerkleTree.verify_proof(root, metadata.filename, leaf_hash, proof)
+
+        # Download, hash and decrypt file objects, and write files into a
+        # staging directory while they are downloaded
+        print("Retrieving your backup version...")
+        backup_data_dir = os.path.join(backup_dir, "data")
+        staging_data_dir = os.path.join(backup_dir, ".data.partial")
+        if root is None:
+            # version anchored before Merkle roots: hash of all hashes
+            assembler = self._create_restore_assembler(
+                    list_metadata, staging_data_dir, sha256)
+        else:
+            assembler = self._create_restore_assembler(
+                    list_metadata, staging_data_dir, sha256Bytes,
+                    verify_file, self._file_objects_dir)
+        try:
+            with timer("download"):
+                hashes_by_file_id = assembler.assemble()
+        except Exception as e:
+            assembler.discard()
+            print("Cannot retrieve backup at version {}: {}".format(
+                    retrieve_version, e))
+            return False
+
+        # Compare hash of downloaded files with hash of this version on the anchor
+        if patterns:
+            # each file was checked by verify_file against the anchored root
+            allHashes = root
+        elif root is None:
+            set_file_object_ids = self._get_file_object_ids_from_metadata(metadata_dir)
+            hashes_of_file_objects = [hashes_by_file_id[file_id]
+                                      for file_id in set_file_object_ids]
+            hashes_of_metadata = recursive_get_hash_list(metadata_dir)
+            hashList = hashes_of_file_objects + hashes_of_metadata
+            allHashes = sha256(hashList).hex()
+        else:
+            # also detects files missing from the downloaded version
+            allHashes = MerkleTree.compute_root({
+                    metadata.filename: MerkleTree.leaf_hash(
+                        metadata.filename, metadata.computeHash(),
+                        [hashes_by_file_id[file_id] for file_id in metadata.file_ids])
+                    for _, metadata in list_metadata})
         print("all hashes of retrieve backup: ", allHashes)
-        # Get id of transaction corresponding to this version on eth
-        version, txn_hash = self._object_db.queryHashVer(retrieve_version)
-        assert int(version) == retrieve_version
-        print("txn_hash = ", txn_hash)
-        allHashesStoredOnEth = self._eth.retrieve(txn_hash)[2:] #remove 0x prefix
-        print("hash store on eth:             ", allHashesStoredOnEth)
         if allHashes != allHashesStoredOnEth:
+            assembler.discard()
             print("Backup data on S3 bucket at version {} is modified!"
                     .format(retrieve_version))
+            return False
+        assembler.commit(backup_data_dir)
+        print("Successfully retrieve your backup at version {}".format(
+            retrieve_version))
+        return True
+
+    def _write_metrics(self, info):
+        """
+        Write the metrics of the cycle which just ended, see utils.metrics.
+        :param info: dictionary, description of the cycle
+        """
+        try:
+            METRICS.end_cycle(info,
+                    os.path.join(self._metrics_dir, "cycles.jsonl"),
+                    os.path.join(self._metrics_dir, "metrics.prom"))
+        except Exception as e:
+            print("Cannot write metrics: ", e)
+
+    def backup_once(self):
+        """
+        Run one backup cycle: if the backup folder was modified, back it up
+        as a new version and commit it. The timers and counters of the
+        cycle are written to the metrics directory.
+        :return: boolean, True if backup folder was modified, even if its
+            new version could not be uploaded
+        """
+        METRICS.start_cycle()
+        version = self._version
+        modified = None
+        try:
+            modified = self._backup_cycle()
+            return modified
+        finally:
+            self._write_metrics({"kind": "backup", "version": self._version,
+                                 "modified": modified,
+                                 "committed": self._version > version})
+
+    def _backup_cycle(self):
+        modified, list_modified_files, list_unmodified_files = \
+                self.is_backup_folder_modified()
+        print("modified: ", modified)
+        if not modified:
+            return False
+        self._version += 1
+        self._new_manifest = Manifest(self._version)
+        self._new_metadata = []
+        # update object_db and metadata of modified files
+        if self._workers > 1:
+            new_file_object_paths = \
+                    self._backup_modified_files_parallel(list_modified_files)
         else:
-            print("Retrieving your backup version...")
-            backup_data_dir = os.path.join(backup_dir, "data")
-            original_metadata_dir = metadata_dir
-            self._retrieve_backup_data_from_file_objects_and_metadata(
-                    encrypted_file_objects_dir, metadata_dir, backup_data_dir,
-                    original_metadata_dir)
-            print("Successfully retrieve your backup at version {}".format(
-                retrieve_version))
+            new_file_object_paths = \
+                    self._backup_modified_files(list_modified_files)
+
+        # update metadata of unmodified files
+        self._copy_old_metadata_of_unmodified_files(list_unmodified_files)
+        with timer("upload"):
+            new_manifest_path = self.upload_new_version(new_file_object_paths)
+        # new file objects are in packs now, they can be evicted
+        with timer("eviction"):
+            self._evict_file_objects()
+        if new_manifest_path is None:
+            self._discard_uncommitted_version()
+            return True
+        print("new_manifest_path = ", new_manifest_path)
+        previous_manifest = self._load_manifest(self._version - 1)
+        removed_paths = [path for path in previous_manifest.entries
+                         if self._new_manifest.get(path) is None]
+        self._manifest_cache = self._new_manifest
+        with timer("stat_cache_update"):
+            self._stat_cache.update_new_cache()
 
+        # Update the Merkle tree with the changed files, and commit
+        # the version; its root is anchored in the background
+        with timer("merkle"):
+            allHashes = self._update_merkle_tree(removed_paths)
+        print("merkle root of new version: ", allHashes)
+        with self._object_db.transaction():
+            # the file objects referenced by the new version
+            self._object_db.recordVersionEntries(
+                    self._version, self._new_metadata, removed_paths)
+            self._object_db.insertPendingVersion(self._version, allHashes,
+                                                 int(time.time()))
+
+        self.flush_version_to_file()
+        if self._anchor_queue is not None:
+            self._anchor_queue.notify()
+        if self._retention is not None:
+            with timer("gc"):
+                try:
+                    self.collect_garbage()
+                except Exception as e:
+                    print("Cannot collect garbage: ", e)
+        return True
 
     def run(self):
         """
@@ -526,70 +1874,15 @@ class BackupProgram(object):
         if not self.is_already_config():
             self.config()
 
+        self._abort_stale_uploads()
+        self._start_watcher()
+        self._start_anchor_queue()
         signal.signal(signal.SIGALRM, self.interrupt)
         while True:
             print("version: ", self._version)
-            modified, list_modified_files, list_unmodified_files = \
-                    self.is_backup_folder_modified()
-            print("modified: ", modified)
-            if modified:
-                self._version += 1
-                # update object_db and metadata of modified files
-                new_file_object_paths = []
-                set_file_object_ids = set()
-                for filepath in list_modified_files:
-                    print(filepath)
-                    chunk_paths_and_hashes = \
-                            self._object_db.get_chunk_paths_and_hashes(filepath)
-                    file_ids = []
-                    data_keys = []
-                    for chunk_path, h in chunk_paths_and_hashes.items():
-                        file_id, data_key = self._object_db.query(h)
-                        if file_id is None:
-                            data_key = genSymKey()
-                            #save the key
-                            file_id = self._object_db.insert(h, data_key)
-                            file_object_path = os.path.join(self._file_objects_dir,
-                                    str(file_id))
-                            #encrypt the chunk, and write it to file_object_path
-                            encryptFile(data_key, chunk_path, file_object_path)
-                            #test decryption
-                            # print(decryptFile(data_key, file_object_path, file_object_path))
-                            new_file_object_paths.append(file_object_path)
-
-                        file_ids.append(file_id)
-                        data_keys.append(data_key)
-                        set_file_object_ids.add(file_id)
-
-                    self._create_new_metadata_of_modified_file(
-                        filepath, file_ids, data_keys)
-
-                # update metadata of unmodified files
-                set_file_ids_of_unmodified_files = \
-                        self._copy_old_metadata_and_get_set_file_ids_if_unmodified( \
-                            list_unmodified_files)
-                new_metadata_dir = self.upload_new_version(new_file_object_paths)
-                print("new_metadata_dir = ", new_metadata_dir)
-                self._stat_cache.update_new_cache()
-
-                # Compute hash and upload to eth
-                for file_id in set_file_ids_of_unmodified_files:
-                    set_file_object_ids.add(file_id)
-                hashes_of_file_objects = get_hash_list_file_objects(
-                        self._file_objects_dir, set_file_object_ids)
-                hashes_of_metadata = recursive_get_hash_list(new_metadata_dir)
-                hashList = hashes_of_file_objects + hashes_of_metadata
-                #hash all hashes, and upload to eth
-                allHashes = sha256(hashList).hex()
-                print("all hashes of new version: ", allHashes)
-                transaction_id = self._eth.upload(allHashes)
-                # save transaction and version
-                self._object_db.insertHashVer(self._version, transaction_id)
-
-                self.flush_version_to_file()
-            else:
+            if not self.backup_once():
                 self.retrieve_backup()
-            time.sleep(self.get_time_interval())
+            self._wait_for_next_cycle()
 
     def __del__(self):
         self.flush_version_to_file()
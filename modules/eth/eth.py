@@ -3,11 +3,16 @@ import sys
 import time
 import math
 
-#API from infura
-infura_url = "https://ropsten.infura.io/v3/a51ee608e9e944edb0643b1b26a48eb1"
+from modules.anchor.anchor import Anchor
 
-class Eth(object):
-    def __init__(self, credential_path):
+class Eth(Anchor):
+    def __init__(self, credential_path, provider_url):
+        """
+        :param credential_path: file with the accounts and the private key
+        :param provider_url: URL of the HTTP endpoint of an Ethereum node,
+            e.g. an Infura endpoint with its API key
+        """
+        self._provider_url = provider_url
         #configure ethereum
         configureCount = 0
         with open(credential_path, "r") as f:
@@ -25,7 +30,16 @@ class Eth(object):
         if configureCount != 3:
             print("Invalid Ethereum configuration")
             sys.exit(-1)
-        self._w3 = Web3(Web3.HTTPProvider(infura_url))
+        self._w3 = None
+        self._transactionCount = None
+
+    def _connect(self):
+        """
+        Connect to eth on first use, so that the program can start offline
+        """
+        if self._w3 is not None:
+            return
+        self._w3 = Web3(Web3.HTTPProvider(self._provider_url))
         print("Connected to eth:", self._w3.isConnected())
         self._transactionCount = self._w3.eth.getTransactionCount(self._acc1)
 
@@ -35,6 +49,7 @@ class Eth(object):
         :param hashData: hex string of hash to upload
         :return: transaction id of the upload
         """
+        self._connect()
         while True:
             try:
                 myNonce = max(self._transactionCount, self._w3.eth.getTransactionCount(self._acc1))
@@ -70,10 +85,15 @@ class Eth(object):
         """
         Retrieve the stored data from the blockchain
         :param block_id: transaction id
-        :return: what was stored at the blockchain as input (the hash)
+        :return: what was stored at the blockchain as input (the hash),
+            as a hex string without 0x prefix
         """
+        self._connect()
         transaction = self._w3.eth.getTransaction(block_id)
         storedHash = transaction["input"]   #this is a string with 0x as the prefix
-        #TODO: compare this with the computed hash of a retrieved version
+        if not isinstance(storedHash, str):
+            storedHash = storedHash.hex()
         print("stored hash:", storedHash)
+        if storedHash.startswith("0x"):
+            storedHash = storedHash[2:]
         return storedHash
@@ -0,0 +1,202 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+# inotify flags, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM \
+        | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF \
+        | IN_MOVE_SELF | IN_ONLYDIR
+
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class InotifyWatcher(object):
+    """
+    Watch a backup folder recursively with Linux inotify, and keep the set
+    of paths changed since the last call to take_dirty_paths.
+    """
+
+    def __init__(self, backup_folder, debounce=2):
+        """
+        :param backup_folder: str, abs path of the folder to watch
+        :param debounce: seconds without any event after which a burst of
+            changes is considered finished
+        """
+        if not sys.platform.startswith("linux"):
+            raise Exception("inotify is only available on Linux")
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                                 use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self._backup_folder = backup_folder
+        self._debounce = debounce
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._dirty_paths = set()
+        self._need_full_rescan = False
+        self._last_event_time = 0
+        self._path_of_wd = {}
+        self._wd_of_path = {}
+
+        self._add_watches(backup_folder)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._read_events, daemon=True)
+        self._thread.start()
+
+    def _add_watch(self, path):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            # e.g. the directory was removed, or fs.inotify.max_user_watches
+            # is reached; let the next full rescan catch up
+            print("Cannot watch {}: {}".format(path, os.strerror(ctypes.get_errno())))
+            self._need_full_rescan = True
+            return
+        self._path_of_wd[wd] = path
+        self._wd_of_path[path] = wd
+
+    def _add_watches(self, path):
+        """
+        Watch a directory and all of its subdirectories.
+        :return: list of paths of files found in the directories
+        """
+        files = []
+        self._add_watch(path)
+        try:
+            entries = list(os.scandir(path))
+        except OSError:
+            return files
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                files += self._add_watches(entry.path)
+            else:
+                files.append(entry.path)
+        return files
+
+    def _remove_watches(self, path):
+        """
+        Stop watching a directory which was moved out or removed, and all of
+        its subdirectories.
+        """
+        prefix = path + os.sep
+        for watched_path in [p for p in self._wd_of_path
+                             if p == path or p.startswith(prefix)]:
+            wd = self._wd_of_path.pop(watched_path)
+            self._path_of_wd.pop(wd, None)
+            self._libc.inotify_rm_watch(self._fd, wd)
+
+    def _handle_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            # events were dropped by the kernel
+            self._need_full_rescan = True
+            return
+        if mask & IN_IGNORED:
+            path = self._path_of_wd.pop(wd, None)
+            if path is not None and self._wd_of_path.get(path) == wd:
+                del self._wd_of_path[path]
+            return
+        directory = self._path_of_wd.get(wd)
+        if directory is None:
+            return
+        if not name:
+            # event on the watched directory itself
+            self._dirty_paths.add(directory)
+            return
+        path = os.path.join(directory, name)
+        self._dirty_paths.add(path)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                # files may have been created before the watch is added
+                self._dirty_paths.update(self._add_watches(path))
+            elif mask & IN_MOVED_FROM:
+                self._remove_watches(path)
+
+    def _read_events(self):
+        while not self._stop.is_set():
+            readable, _, _ = select.select([self._fd], [], [], 0.5)
+            if not readable:
+                continue
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                continue
+            with self._lock:
+                offset = 0
+                while offset < len(data):
+                    wd, mask, _, name_len = EVENT_HEADER.unpack_from(data, offset)
+                    offset += EVENT_HEADER.size
+                    name = data[offset:offset + name_len].rstrip(b"\0")
+                    offset += name_len
+                    self._handle_event(wd, mask, os.fsdecode(name))
+                self._last_event_time = time.monotonic()
+                self._changed.notify_all()
+
+    def wait_for_changes(self, timeout):
+        """
+        Wait until some paths changed and no event was received for
+        debounce seconds, or until timeout.
+        :param timeout: maximum number of seconds to wait
+        :return: True if there are changes to back up, False on timeout
+        """
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while True:
+                now = time.monotonic()
+                if self._dirty_paths or self._need_full_rescan:
+                    quiet_until = self._last_event_time + self._debounce
+                    if now >= quiet_until:
+                        return True
+                    wait_until = min(quiet_until, deadline)
+                else:
+                    wait_until = deadline
+                if now >= deadline:
+                    return False
+                self._changed.wait(wait_until - now)
+
+    def take_dirty_paths(self):
+        """
+        Take the set of changed paths, and reset it.
+        :return: tuple (dirty_paths, need_full_rescan), where need_full_rescan
+            is True if some events may have been lost
+        """
+        with self._lock:
+            dirty_paths = self._dirty_paths
+            need_full_rescan = self._need_full_rescan
+            self._dirty_paths = set()
+            self._need_full_rescan = False
+        return dirty_paths, need_full_rescan
+
+    def request_full_rescan(self):
+        """
+        Make the next take_dirty_paths ask for a full rescan, e.g. because
+        the previous dirty paths could not be backed up.
+        """
+        with self._lock:
+            self._need_full_rescan = True
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        os.close(self._fd)
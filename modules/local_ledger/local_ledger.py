@@ -0,0 +1,77 @@
+import json
+import os
+import threading
+import time
+
+from modules.anchor.anchor import Anchor
+from utils.crypto import sha256Bytes
+
+
+def _entry_hash(previous_hash, index, root):
+    return sha256Bytes("{}:{}:{}".format(previous_hash, index, root)
+                       .encode("utf-8")).hex()
+
+
+class LocalLedger(Anchor):
+    """
+    Anchor backend keeping roots in a local append-only file, one JSON entry
+    per line, each entry chained to the previous one by its hash. It needs
+    no network, and can simulate the latency of a blockchain transaction,
+    e.g. to measure the throughput of backups offline.
+    """
+
+    def __init__(self, ledger_path, latency=0):
+        """
+        :param ledger_path: path of the ledger file
+        :param latency: seconds each upload waits before returning
+        """
+        self._ledger_path = ledger_path
+        self._latency = latency
+        self._lock = threading.Lock()
+        self._entries = []
+        self._index_of_hash = {}
+        if os.path.isfile(ledger_path):
+            with open(ledger_path, "r") as f:
+                for line in f:
+                    if line.strip():
+                        self._append_entry(json.loads(line))
+
+    def _append_entry(self, entry):
+        previous_hash = self._entries[-1]["hash"] if self._entries else ""
+        if entry["index"] != len(self._entries) or entry["prev"] != previous_hash \
+                or entry["hash"] != _entry_hash(previous_hash, entry["index"], entry["root"]):
+            raise Exception("Ledger {} is corrupted at entry {}".format(
+                    self._ledger_path, len(self._entries)))
+        self._index_of_hash[entry["hash"]] = len(self._entries)
+        self._entries.append(entry)
+
+    def upload(self, root):
+        """
+        Append a root to the ledger
+        :param root: hex string of the root
+        :return: hash of the new entry of the ledger
+        """
+        time.sleep(self._latency)
+        with self._lock:
+            index = len(self._entries)
+            previous_hash = self._entries[-1]["hash"] if self._entries else ""
+            entry = {"index": index, "prev": previous_hash, "root": root,
+                     "hash": _entry_hash(previous_hash, index, root),
+                     "time": time.time()}
+            with open(self._ledger_path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self._append_entry(entry)
+        return entry["hash"]
+
+    def retrieve(self, receipt_id):
+        """
+        :param receipt_id: hash of an entry of the ledger
+        :return: hex string of the root of the entry
+        """
+        with self._lock:
+            index = self._index_of_hash.get(receipt_id)
+            if index is None:
+                raise Exception("Entry {} is not in the ledger".format(receipt_id))
+            return self._entries[index]["root"]
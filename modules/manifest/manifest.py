@@ -0,0 +1,200 @@
+import os
+
+from modules.metadata.metadata import Metadata
+from utils.utils import make_dirs
+
+MAGIC = b"CSMF"
+FORMAT_VERSION = 2
+
+
+def _write_varint(out, n):
+    while True:
+        byte = n & 0x7f
+        n >>= 7
+        if n:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return
+
+
+def _read_varint(data, pos):
+    n = 0
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise Exception("Invalid manifest: truncated data")
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return n, pos
+        shift += 7
+
+
+def _write_bytes(out, data):
+    _write_varint(out, len(data))
+    out += data
+
+
+def _read_bytes(data, pos):
+    length, pos = _read_varint(data, pos)
+    if pos + length > len(data):
+        raise Exception("Invalid manifest: truncated data")
+    return bytes(data[pos:pos + length]), pos + length
+
+
+def _zigzag(n):
+    return n << 1 if n >= 0 else ((-n) << 1) - 1
+
+
+def _unzigzag(n):
+    return n >> 1 if not n & 1 else -((n + 1) >> 1)
+
+
+def _same_metadata(a, b):
+    return a.version == b.version and a.file_ids == b.file_ids \
+            and a.encrypted_data_keys == b.encrypted_data_keys
+
+
+class Manifest(object):
+    """
+    Metadata of all files of a backup version, packed in a single binary
+    object: entries sorted by path, file ids delta/varint-encoded, and the
+    data keys wrapped by the control key. Unlike pickled Metadata objects,
+    reading a manifest never instantiates arbitrary classes.
+    A manifest is either a full snapshot of a version, or a delta holding
+    only the entries added or changed since its base version and the paths
+    removed since then.
+    """
+
+    def __init__(self, version, entries=None, base_version=None, removed=None):
+        """
+        :param version: integer, version number of the backup
+        :param entries: dictionary, with key is path of file relative to
+            the backup folder and value is its Metadata
+        :param base_version: integer, version the delta applies to, or None
+            if the manifest is a full snapshot
+        :param removed: set of paths removed since base_version
+        """
+        self.version = version
+        self.entries = entries if entries is not None else {}
+        self.base_version = base_version
+        self.removed = removed if removed is not None else set()
+
+    def is_snapshot(self):
+        return self.base_version is None
+
+    def add(self, metadata):
+        self.entries[metadata.filename] = metadata
+
+    def get(self, path):
+        return self.entries.get(path)
+
+    def list_metadata(self):
+        """
+        :return: list of Metadata of all files, sorted by path
+        """
+        return [self.entries[path] for path in sorted(self.entries)]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def diff(self, base):
+        """
+        :param base: full Manifest of the base version
+        :return: delta Manifest which turns base into this manifest
+        """
+        delta = Manifest(self.version, base_version=base.version)
+        for path, metadata in self.entries.items():
+            base_metadata = base.get(path)
+            if base_metadata is None or not _same_metadata(metadata, base_metadata):
+                delta.add(metadata)
+        delta.removed = set(path for path in base.entries if path not in self.entries)
+        return delta
+
+    def apply(self, delta):
+        """
+        :param delta: delta Manifest whose base version is this manifest
+        :return: full Manifest of the version of delta
+        """
+        if delta.base_version != self.version:
+            raise Exception("Manifest of version {} is not based on version {}"
+                            .format(delta.version, self.version))
+        entries = dict(self.entries)
+        for path in delta.removed:
+            entries.pop(path, None)
+        entries.update(delta.entries)
+        return Manifest(delta.version, entries)
+
+    def to_bytes(self):
+        out = bytearray(MAGIC)
+        out.append(FORMAT_VERSION)
+        _write_varint(out, self.version)
+        # versions start at 1, so 0 means a full snapshot
+        _write_varint(out, self.base_version or 0)
+        _write_varint(out, len(self.entries))
+        for metadata in self.list_metadata():
+            _write_bytes(out, metadata.filename.encode("utf-8"))
+            _write_varint(out, metadata.version)
+            _write_varint(out, len(metadata.file_ids))
+            previous_file_id = 0
+            for file_id in metadata.file_ids:
+                _write_varint(out, _zigzag(file_id - previous_file_id))
+                previous_file_id = file_id
+            for encrypted_data_key in metadata.encrypted_data_keys:
+                _write_bytes(out, encrypted_data_key)
+        _write_varint(out, len(self.removed))
+        for path in sorted(self.removed):
+            _write_bytes(out, path.encode("utf-8"))
+        return bytes(out)
+
+    @staticmethod
+    def from_bytes(data):
+        if data[:len(MAGIC)] != MAGIC:
+            raise Exception("Invalid manifest: bad magic")
+        pos = len(MAGIC)
+        if pos >= len(data) or data[pos] != FORMAT_VERSION:
+            raise Exception("Invalid manifest: unsupported format version")
+        pos += 1
+        version, pos = _read_varint(data, pos)
+        base_version, pos = _read_varint(data, pos)
+        count, pos = _read_varint(data, pos)
+        if base_version >= version:
+            raise Exception("Invalid manifest: base version is not older")
+        manifest = Manifest(version, base_version=base_version or None)
+        for _ in range(count):
+            filename, pos = _read_bytes(data, pos)
+            file_version, pos = _read_varint(data, pos)
+            n_file_ids, pos = _read_varint(data, pos)
+            file_ids = []
+            file_id = 0
+            for _ in range(n_file_ids):
+                delta, pos = _read_varint(data, pos)
+                file_id += _unzigzag(delta)
+                file_ids.append(file_id)
+            encrypted_data_keys = []
+            for _ in range(n_file_ids):
+                encrypted_data_key, pos = _read_bytes(data, pos)
+                encrypted_data_keys.append(encrypted_data_key)
+            manifest.add(Metadata(filename.decode("utf-8"), file_ids,
+                                  encrypted_data_keys, file_version))
+        count, pos = _read_varint(data, pos)
+        for _ in range(count):
+            path, pos = _read_bytes(data, pos)
+            manifest.removed.add(path.decode("utf-8"))
+        if pos != len(data):
+            raise Exception("Invalid manifest: trailing data")
+        return manifest
+
+    def save(self, path):
+        make_dirs(os.path.dirname(path))
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(self.to_bytes())
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def read(path):
+        with open(path, "rb") as f:
+            return Manifest.from_bytes(f.read())
@@ -0,0 +1,339 @@
+import bisect
+
+from utils.crypto import sha256Bytes
+from utils.sqlite_utils import create_connection, create_table, create_index
+
+# the leaves are spread over 2^DEPTH buckets by the hash of their path
+DEPTH = 16
+
+
+def _hash(tag, *parts):
+    """
+    Hash a list of byte strings, prefixing each with its length so that
+    different lists never have the same encoding.
+    :param tag: bytes, domain separation of leaf/bucket/node hashes
+    :param parts: bytes
+    :return: hash as bytes
+    """
+    data = [tag]
+    for part in parts:
+        data.append(len(part).to_bytes(8, "big"))
+        data.append(part)
+    return sha256Bytes(b"".join(data))
+
+
+def _bucket_of_path(path):
+    digest = sha256Bytes(path.encode("utf-8"))
+    return int.from_bytes(digest[:4], "big") >> (32 - DEPTH)
+
+
+def _bucket_hash(entries):
+    """
+    :param entries: list of tuples (path, leaf_hash as bytes)
+    :return: hash of the bucket as bytes
+    """
+    parts = []
+    for path, leaf_hash in sorted(entries):
+        parts.append(path.encode("utf-8"))
+        parts.append(leaf_hash)
+    return _hash(b"bucket", *parts)
+
+
+def _node_hash(left, right):
+    return _hash(b"node", left, right)
+
+
+def _default_hashes():
+    # DEFAULT_HASHES[level] is the hash of an empty subtree at this level
+    default_hashes = [None] * (DEPTH + 1)
+    default_hashes[DEPTH] = _bucket_hash([])
+    for level in range(DEPTH - 1, -1, -1):
+        default_hashes[level] = _node_hash(default_hashes[level + 1],
+                                           default_hashes[level + 1])
+    return default_hashes
+
+
+DEFAULT_HASHES = _default_hashes()
+
+
+def _version_leaf_hash(version, root):
+    return _hash(b"version", str(version).encode("utf-8"), bytes.fromhex(root))
+
+
+def aggregate_roots(version_roots):
+    """
+    Aggregate the roots of several versions under a single root, so that
+    they can be anchored in one transaction.
+    :param version_roots: list of tuples (version, hex string of root)
+    :return: tuple (batch_root, proofs), where batch_root is the hex string
+        of the aggregated root and proofs a dictionary, with key is version
+        and value is the list of (side, hex string of sibling) from the
+        version to batch_root
+    """
+    level = [_version_leaf_hash(version, root) for version, root in version_roots]
+    positions = {version: i for i, (version, _) in enumerate(version_roots)}
+    proofs = {version: [] for version, _ in version_roots}
+    while len(level) > 1:
+        for version, i in positions.items():
+            sibling = i ^ 1
+            if sibling < len(level):
+                proofs[version].append(
+                        ("L" if sibling < i else "R", level[sibling].hex()))
+            positions[version] = i >> 1
+        # an odd node is promoted to the next level unchanged
+        level = [_node_hash(level[i], level[i + 1]) if i + 1 < len(level) else level[i]
+                 for i in range(0, len(level), 2)]
+    return level[0].hex(), proofs
+
+
+def verify_aggregate_proof(batch_root, version, root, proof):
+    """
+    Verify that the root of a version was aggregated under a batch root.
+    :param batch_root: hex string of the anchored batch root
+    :param version: integer, version number
+    :param root: hex string of the Merkle root of the version
+    :param proof: proof of the version returned by aggregate_roots
+    :return: True if the root of the version is under batch_root
+    """
+    node = _version_leaf_hash(version, root)
+    for side, sibling in proof:
+        if side == "L":
+            node = _node_hash(bytes.fromhex(sibling), node)
+        else:
+            node = _node_hash(node, bytes.fromhex(sibling))
+    return node.hex() == batch_root
+
+
+class MerkleTree(object):
+    """
+    Persistent Merkle tree over the files of each backup version.
+    Each leaf is a path with the hash of its metadata and of the encrypted
+    file objects of its chunks. Only the nodes on the way from changed
+    leaves to the root are written for a new version, older nodes are kept
+    so that inclusion proofs can be built for any version.
+    """
+
+    def __init__(self, merkle_db_path):
+        self._conn = create_connection(merkle_db_path)
+        self._c = self._conn.cursor()
+        self._c.execute("PRAGMA journal_mode=WAL")
+
+        sql_create_leaves_table = """ CREATE TABLE IF NOT EXISTS merkle_leaves (
+                                          path text NOT NULL,
+                                          version integer NOT NULL,
+                                          bucket integer NOT NULL,
+                                          leaf_hash text,
+                                          PRIMARY KEY (path, version)
+                                    ); """
+        sql_create_index_on_bucket = """ CREATE INDEX IF NOT EXISTS index_bucket
+                                        ON merkle_leaves(bucket, version); """
+        sql_create_nodes_table = """ CREATE TABLE IF NOT EXISTS merkle_nodes (
+                                         level integer NOT NULL,
+                                         idx integer NOT NULL,
+                                         version integer NOT NULL,
+                                         hash text NOT NULL,
+                                         PRIMARY KEY (level, idx, version)
+                                    ); """
+        sql_create_roots_table = """ CREATE TABLE IF NOT EXISTS merkle_roots (
+                                         version integer PRIMARY KEY,
+                                         root text NOT NULL
+                                    ); """
+        create_table(self._c, sql_create_leaves_table)
+        create_index(self._c, sql_create_index_on_bucket)
+        create_table(self._c, sql_create_nodes_table)
+        create_table(self._c, sql_create_roots_table)
+        # rows of a version, for delete_versions
+        create_index(self._c, """ CREATE INDEX IF NOT EXISTS index_leaves_version
+                                  ON merkle_leaves(version); """)
+        create_index(self._c, """ CREATE INDEX IF NOT EXISTS index_nodes_version
+                                  ON merkle_nodes(version); """)
+
+    @staticmethod
+    def leaf_hash(path, metadata_hash, object_hashes):
+        """
+        Compute the leaf of a file of a version.
+        :param path: path of file, relative to the backup folder
+        :param metadata_hash: bytes, hash of the metadata of the file
+        :param object_hashes: list of bytes, SHA256 of the encrypted file
+            objects of the chunks of the file, in order
+        :return: hex string of hash of the leaf
+        """
+        return _hash(b"leaf", path.encode("utf-8"), metadata_hash,
+                     *object_hashes).hex()
+
+    @staticmethod
+    def compute_root(leaves):
+        """
+        Compute the root of a whole tree in memory.
+        :param leaves: dictionary, with key is path and value is hex string
+            of leaf hash
+        :return: hex string of the root
+        """
+        buckets = {}
+        for path, leaf_hash in leaves.items():
+            buckets.setdefault(_bucket_of_path(path), []).append(
+                    (path, bytes.fromhex(leaf_hash)))
+        nodes = {bucket: _bucket_hash(entries) for bucket, entries in buckets.items()}
+        for level in range(DEPTH - 1, -1, -1):
+            parents = {}
+            for idx in set(i >> 1 for i in nodes):
+                parents[idx] = _node_hash(
+                        nodes.get(2 * idx, DEFAULT_HASHES[level + 1]),
+                        nodes.get(2 * idx + 1, DEFAULT_HASHES[level + 1]))
+            nodes = parents
+        return nodes.get(0, DEFAULT_HASHES[0]).hex()
+
+    @staticmethod
+    def verify_proof(root, path, leaf_hash, proof):
+        """
+        Verify that a leaf belongs to the tree of a version.
+        :param root: hex string of the root of the version
+        :param path: path of file, relative to the backup folder
+        :param leaf_hash: hex string of the leaf computed from the file
+        :param proof: proof returned by get_proof
+        :return: True if the leaf is in the tree, False otherwise
+        """
+        entries, siblings = proof
+        if [path, leaf_hash] not in [list(entry) for entry in entries]:
+            return False
+        node = _bucket_hash([(p, bytes.fromhex(h)) for p, h in entries])
+        idx = _bucket_of_path(path)
+        for sibling in siblings:
+            sibling = bytes.fromhex(sibling)
+            if idx & 1:
+                node = _node_hash(sibling, node)
+            else:
+                node = _node_hash(node, sibling)
+            idx >>= 1
+        return node.hex() == root
+
+    def get_root(self, version):
+        """
+        :param version: integer, version number
+        :return: hex string of the root of the version, or None if the
+            version is not in the tree
+        """
+        result = self._c.execute("SELECT root FROM merkle_roots WHERE version=?",
+                                 (version,)).fetchone()
+        return result[0] if result else None
+
+    def _get_bucket_entries(self, bucket, version):
+        return list(self._c.execute(
+                """ SELECT path, leaf_hash FROM merkle_leaves l
+                    WHERE bucket=? AND version = (
+                            SELECT MAX(version) FROM merkle_leaves
+                            WHERE path=l.path AND version<=?)
+                      AND leaf_hash IS NOT NULL """, (bucket, version)))
+
+    def _get_node(self, level, idx, version):
+        result = self._c.execute(
+                """ SELECT hash FROM merkle_nodes
+                    WHERE level=? AND idx=? AND version<=?
+                    ORDER BY version DESC LIMIT 1 """,
+                (level, idx, version)).fetchone()
+        return bytes.fromhex(result[0]) if result else DEFAULT_HASHES[level]
+
+    def update(self, version, changes):
+        """
+        Create the tree of a new version from the tree of the previous
+        version, updating only the paths from changed leaves to the root.
+        :param version: integer, the new version number, greater than the
+            versions already in the tree
+        :param changes: dictionary, with key is path and value is hex string
+            of the new leaf hash, or None if the file was removed
+        :return: hex string of the root of the new version
+        """
+        self._c.execute("BEGIN")
+        # drop what is left of an uncommitted attempt at this version
+        for table in ("merkle_leaves", "merkle_nodes", "merkle_roots"):
+            self._c.execute("DELETE FROM {} WHERE version>=?".format(table),
+                            (version,))
+        dirty = set()
+        for path, leaf_hash in changes.items():
+            bucket = _bucket_of_path(path)
+            self._c.execute("INSERT INTO merkle_leaves VALUES (?, ?, ?, ?)",
+                            (path, version, bucket, leaf_hash))
+            dirty.add(bucket)
+
+        nodes = {}
+        for bucket in dirty:
+            nodes[bucket] = _bucket_hash(
+                    [(path, bytes.fromhex(leaf_hash))
+                     for path, leaf_hash in self._get_bucket_entries(bucket, version)])
+        level = DEPTH
+        while True:
+            self._c.executemany("INSERT INTO merkle_nodes VALUES (?, ?, ?, ?)",
+                                [(level, idx, version, node.hex())
+                                 for idx, node in nodes.items()])
+            if level == 0:
+                break
+            parents = {}
+            for idx in set(i >> 1 for i in nodes):
+                left = nodes.get(2 * idx)
+                if left is None:
+                    left = self._get_node(level, 2 * idx, version)
+                right = nodes.get(2 * idx + 1)
+                if right is None:
+                    right = self._get_node(level, 2 * idx + 1, version)
+                parents[idx] = _node_hash(left, right)
+            nodes = parents
+            level -= 1
+
+        root = nodes[0].hex() if nodes else self._get_node(0, 0, version).hex()
+        self._c.execute("INSERT INTO merkle_roots VALUES (?, ?)", (version, root))
+        self._c.execute("COMMIT")
+        return root
+
+    def delete_versions(self, versions, kept_versions):
+        """
+        Delete the trees of collected versions. A leaf or node written by a
+        version is also part of the trees of the next versions, until the
+        next version which writes it, so it is only deleted if none of these
+        versions is kept.
+        :param versions: list of integers, the collected versions
+        :param kept_versions: sorted list of integers, the remaining versions
+        :return: number of leaves and nodes deleted
+        """
+        deleted = 0
+        self._c.execute("BEGIN")
+        for table, key in (("merkle_leaves", ("path",)),
+                           ("merkle_nodes", ("level", "idx"))):
+            match = " AND ".join("{}=?".format(column) for column in key)
+            for version in versions:
+                for row in self._c.execute(
+                        "SELECT {} FROM {} WHERE version=?".format(
+                            ", ".join(key), table), (version,)).fetchall():
+                    next_version, = self._c.execute(
+                            "SELECT MIN(version) FROM {} WHERE {} AND version>?"
+                            .format(table, match), row + (version,)).fetchone()
+                    i = bisect.bisect_left(kept_versions, version)
+                    if i == len(kept_versions) or (next_version is not None
+                            and kept_versions[i] >= next_version):
+                        self._c.execute("DELETE FROM {} WHERE {} AND version=?"
+                                        .format(table, match), row + (version,))
+                        deleted += 1
+        self._c.executemany("DELETE FROM merkle_roots WHERE version=?",
+                            [(version,) for version in versions])
+        self._c.execute("COMMIT")
+        return deleted
+
+    def get_proof(self, version, path):
+        """
+        Build the inclusion proof of a file of a version.
+        :param version: integer, version number
+        :param path: path of file, relative to the backup folder
+        :return: tuple (entries, siblings), where entries is the list of
+            (path, leaf hash) of the bucket of the file and siblings the
+            list of hex strings of sibling hashes from the bucket to the root
+        """
+        bucket = _bucket_of_path(path)
+        entries = self._get_bucket_entries(bucket, version)
+        siblings = []
+        idx = bucket
+        for level in range(DEPTH, 0, -1):
+            siblings.append(self._get_node(level, idx ^ 1, version).hex())
+            idx >>= 1
+        return entries, siblings
+
+    def __del__(self):
+        self._conn.close()
@@ -1,39 +1,81 @@
-import os
-import shutil
+import json
+from contextlib import contextmanager
 
-from utils.utils import split_file_and_get_hash, make_dirs
-from utils.sqlite_utils import create_connection, create_table, create_index
+from utils.metrics import timed
+from utils.utils import iter_file_chunks
+from utils.sqlite_utils import create_connection, create_table, create_index, set_pragmas
+from utils.sqlite_utils import add_column
+
+# maximum number of parameters of a statement in old versions of sqlite
+MAX_SQL_VARIABLES = 999
 
 
 class ObjectDB(object):
-    def __init__(self, object_db_path):
+    def __init__(self, object_db_path, chunker=None):
         self._object_db_path = object_db_path
+        self._chunker = chunker
         self._counter = 0
         self._conn = None
         self._c = None
-        self._tmp_dir = os.path.join(os.path.dirname(self._object_db_path), ".tmp")
-        make_dirs(self._tmp_dir)
 
         self._conn = create_connection(object_db_path)
         try:
             self._c = self._conn.cursor()
         except:
             print("Cannot create db connection!")
+        set_pragmas(self._c)
 
         sql_create_objects_table = """ CREATE TABLE IF NOT EXISTS objects (
                                            hash text NOT NULL,
                                            data_key text
                                     ); """     
-        sql_create_index_on_hash = """ CREATE UNIQUE INDEX index_hash 
+        sql_create_index_on_hash = """ CREATE UNIQUE INDEX IF NOT EXISTS index_hash 
                                         ON objects(hash); """
 
         sql_create_version_table = """ CREATE TABLE IF NOT EXISTS versions (
                                             version text NOT NULL,
                                             transaction_id text NOT NULL
                                     ); """
-        sql_create_index_on_version = """ CREATE UNIQUE INDEX ver_hash ON
+        sql_create_index_on_version = """ CREATE UNIQUE INDEX IF NOT EXISTS ver_hash ON
                                         versions(version); """
 
+        sql_create_files_table = """ CREATE TABLE IF NOT EXISTS files (
+                                        path text PRIMARY KEY,
+                                        inode integer NOT NULL,
+                                        size integer NOT NULL,
+                                        mtime_ns integer NOT NULL,
+                                        digest text NOT NULL,
+                                        chunk_hashes text NOT NULL,
+                                        file_ids text NOT NULL
+                                    ); """
+
+        sql_create_packs_table = """ CREATE TABLE IF NOT EXISTS packs (
+                                        file_id integer PRIMARY KEY,
+                                        pack text NOT NULL,
+                                        offset integer NOT NULL,
+                                        length integer NOT NULL
+                                    ); """
+
+        # size of each pack when it was written, so that the bytes of
+        # collected file objects in it are known
+        sql_create_pack_sizes_table = """ CREATE TABLE IF NOT EXISTS pack_sizes (
+                                        pack text PRIMARY KEY,
+                                        size integer NOT NULL
+                                    ); """
+
+        # metadata of a file in versions first_version to end_version - 1,
+        # or to the latest version if end_version is NULL
+        sql_create_entries_table = """ CREATE TABLE IF NOT EXISTS entries (
+                                        path text NOT NULL,
+                                        first_version integer NOT NULL,
+                                        end_version integer,
+                                        file_ids text NOT NULL
+                                    ); """
+
+        sql_create_migrations_table = """ CREATE TABLE IF NOT EXISTS migrations (
+                                        name text PRIMARY KEY
+                                    ); """
+
         # create projects table
         create_table(self._c, sql_create_objects_table)
         # create tasks table
@@ -41,8 +83,57 @@ class ObjectDB(object):
         #create version table (store transaction id)
         create_table(self._c, sql_create_version_table)
         create_index(self._c, sql_create_index_on_version)
+        # Merkle root of each version, and its inclusion proof in the root
+        # of the batch of versions anchored by transaction_id
+        add_column(self._c, "versions", "root", "text")
+        add_column(self._c, "versions", "proof", "text")
+        # SHA256 and size of the encrypted file object, so that versions are
+        # hashed without reading file objects; NULL for file objects created
+        # before they were recorded, until they are backfilled
+        add_column(self._c, "objects", "digest", "text")
+        add_column(self._c, "objects", "size", "integer")
+        # whether the file object is in the local object store, and when it
+        # was last written or read there, for LRU eviction
+        add_column(self._c, "objects", "local", "integer NOT NULL DEFAULT 1")
+        add_column(self._c, "objects", "last_used", "integer NOT NULL DEFAULT 0")
+        create_index(self._c, """ CREATE INDEX IF NOT EXISTS index_last_used
+                                  ON objects(local, last_used); """)
+        # number of entries referencing the file object, see recordVersionEntries
+        add_column(self._c, "objects", "refcount", "integer NOT NULL DEFAULT 0")
+        create_index(self._c, """ CREATE INDEX IF NOT EXISTS index_refcount
+                                  ON objects(refcount); """)
+        # length of the chunk before compression and encryption, so that
+        # restored chunks are written at their offset as they arrive; NULL
+        # for file objects created before it was recorded
+        add_column(self._c, "objects", "length", "integer")
+        # time the version was backed up, in seconds since the epoch
+        add_column(self._c, "versions", "created", "integer")
+        #create files table (content of files in the latest version)
+        create_table(self._c, sql_create_files_table)
+        #create packs table (location of file objects stored in packs)
+        create_table(self._c, sql_create_packs_table)
+        create_index(self._c, """ CREATE INDEX IF NOT EXISTS index_pack
+                                  ON packs(pack); """)
+        #create entries table (references of versions to file objects)
+        create_table(self._c, sql_create_entries_table)
+        create_index(self._c, """ CREATE INDEX IF NOT EXISTS index_entries_path
+                                  ON entries(path, end_version); """)
+        create_index(self._c, """ CREATE INDEX IF NOT EXISTS index_entries_end
+                                  ON entries(end_version); """)
+        create_index(self._c, """ CREATE INDEX IF NOT EXISTS index_entries_first
+                                  ON entries(first_version); """)
+        create_table(self._c, sql_create_migrations_table)
+        create_table(self._c, sql_create_pack_sizes_table)
+        if not self.isMigrated("pack_sizes"):
+            # packs written before their size was recorded; file objects
+            # collected at the end of a pack are not counted
+            with self.transaction():
+                self._c.execute("INSERT OR IGNORE INTO pack_sizes "
+                                "SELECT pack, MAX(offset + length) FROM packs GROUP BY pack")
+                self.setMigrated("pack_sizes")
 
 
+    @timed("objectdb", op="insert")
     def insert(self, hash_str, data_key=""):
         """ insert a row to table objects of db.
         :param hash_str: hash of a file
@@ -50,13 +141,14 @@ class ObjectDB(object):
         :return: an integer indicating the last id of row.
         """
         try:
-            self._c.execute("INSERT INTO objects values (?, ?)",
+            self._c.execute("INSERT INTO objects (hash, data_key) values (?, ?)",
                             (hash_str, data_key))
             return self._c.lastrowid
         except Exception as e:
             print(e)
 
 
+    @timed("objectdb", op="query")
     def query(self, hash_str):
         """ query a hash in the table.
         :param hash_str: hash of a file
@@ -72,6 +164,163 @@ class ObjectDB(object):
         else:
             return None, None
 
+    @timed("objectdb", op="queryMany")
+    def queryMany(self, hash_strs):
+        """ query many hashes in the table, with one statement per
+            MAX_SQL_VARIABLES hashes.
+        :param hash_strs: list of hashes of chunks
+        :return: dictionary, with key is hash and value is a tuple
+            (id, data_key) for the hashes found in the table.
+        """
+        results = {}
+        unique_hash_strs = list(set(hash_strs))
+        for i in range(0, len(unique_hash_strs), MAX_SQL_VARIABLES):
+            batch = unique_hash_strs[i:i + MAX_SQL_VARIABLES]
+            for rowid, hash_str, data_key in self._c.execute(
+                    "SELECT rowid, hash, data_key FROM objects WHERE hash IN ({})"
+                    .format(",".join("?" * len(batch))), batch):
+                results[hash_str] = (rowid, data_key)
+        return results
+
+    @timed("objectdb", op="insertMany")
+    def insertMany(self, rows):
+        """ insert many rows to table objects of db in a single transaction
+            (or in the current transaction if there is one).
+        :param rows: list of tuples (hash, data_key, length), where length
+            is the length of the chunk
+        :return: list of integers, ids of the inserted rows, in order.
+        """
+        with self.transaction():
+            rowids = []
+            for hash_str, data_key, length in rows:
+                self._c.execute("INSERT INTO objects (hash, data_key, length) "
+                                "values (?, ?, ?)", (hash_str, data_key, length))
+                rowids.append(self._c.lastrowid)
+            return rowids
+
+    @timed("objectdb", op="setObjectDigests")
+    def setObjectDigests(self, rows):
+        """ record the hash and size of encrypted file objects
+        :param rows: list of tuples (file_id, digest, size), where digest is
+            the hex string of SHA256 of the encrypted file object
+        """
+        with self.transaction():
+            self._c.executemany("UPDATE objects SET digest=?, size=? WHERE rowid=?",
+                                [(digest, size, file_id)
+                                 for file_id, digest, size in rows])
+
+    @timed("objectdb", op="queryObjectDigests")
+    def queryObjectDigests(self, file_ids):
+        """ query the hashes of many encrypted file objects, with one
+            statement per MAX_SQL_VARIABLES file objects
+        :param file_ids: list of integers, ids of file objects
+        :return: dictionary, with key is file_id and value is a tuple
+            (digest, size), for the file objects whose hash is recorded
+        """
+        results = {}
+        unique_file_ids = list(set(file_ids))
+        for i in range(0, len(unique_file_ids), MAX_SQL_VARIABLES):
+            batch = unique_file_ids[i:i + MAX_SQL_VARIABLES]
+            for file_id, digest, size in self._c.execute(
+                    "SELECT rowid, digest, size FROM objects WHERE digest IS NOT NULL "
+                    "AND rowid IN ({})".format(",".join("?" * len(batch))), batch):
+                results[file_id] = (digest, size)
+        return results
+
+    @timed("objectdb", op="queryChunkLengths")
+    def queryChunkLengths(self, file_ids):
+        """ query the lengths of the chunks of many file objects, with one
+            statement per MAX_SQL_VARIABLES file objects
+        :param file_ids: list of integers, ids of file objects
+        :return: dictionary, with key is file_id and value is the length of
+            its chunk, for the file objects whose length is recorded
+        """
+        results = {}
+        unique_file_ids = list(set(file_ids))
+        for i in range(0, len(unique_file_ids), MAX_SQL_VARIABLES):
+            batch = unique_file_ids[i:i + MAX_SQL_VARIABLES]
+            results.update(self._c.execute(
+                    "SELECT rowid, length FROM objects WHERE length IS NOT NULL "
+                    "AND rowid IN ({})".format(",".join("?" * len(batch))), batch))
+        return results
+
+    @timed("objectdb", op="touchObjects")
+    def touchObjects(self, file_ids, last_used):
+        """ record that file objects were written or read in the local
+            object store
+        :param file_ids: list of integers, ids of file objects
+        :param last_used: integer, time of use
+        """
+        with self.transaction():
+            self._c.executemany("UPDATE objects SET local=1, last_used=? WHERE rowid=?",
+                                [(last_used, file_id) for file_id in file_ids])
+
+    @timed("objectdb", op="queryLocalObjectsSize")
+    def queryLocalObjectsSize(self):
+        """ query the number of bytes of the file objects in the local
+            object store
+        :return: integer
+        """
+        return self._c.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM objects WHERE local=1").fetchone()[0]
+
+    def iterLeastRecentlyUsedObjects(self):
+        """ iterate over the file objects of the local object store which
+            can be evicted, least recently used first; file objects whose
+            hash is not recorded are never evicted
+        :return: generator of tuples (file_id, size)
+        """
+        cursor = self._conn.cursor()
+        try:
+            cursor.execute("SELECT rowid, size FROM objects WHERE local=1 "
+                           "AND digest IS NOT NULL ORDER BY last_used")
+            while True:
+                rows = cursor.fetchmany(MAX_SQL_VARIABLES)
+                if not rows:
+                    return
+                for row in rows:
+                    yield row
+        finally:
+            cursor.close()
+
+    @timed("objectdb", op="setObjectsEvicted")
+    def setObjectsEvicted(self, file_ids):
+        """ record that file objects were removed from the local object store
+        :param file_ids: list of integers, ids of file objects
+        """
+        with self.transaction():
+            self._c.executemany("UPDATE objects SET local=0 WHERE rowid=?",
+                                [(file_id,) for file_id in file_ids])
+
+    @timed("objectdb", op="queryObjectsWithoutDigest")
+    def queryObjectsWithoutDigest(self):
+        """ query the file objects whose hash is not recorded
+        :return: list of integers, ids of file objects
+        """
+        return [rowid for rowid, in self._c.execute(
+                "SELECT rowid FROM objects WHERE digest IS NULL")]
+
+    @contextmanager
+    def transaction(self):
+        """ group all statements in the context into a single transaction,
+            committed when the context exits, or rolled back on exception.
+            Nested contexts join the outer transaction. The write lock is
+            taken when the transaction begins (waiting for other connections
+            up to BUSY_TIMEOUT), since a deferred transaction which read
+            before another connection wrote cannot write anymore.
+        """
+        if self._conn.in_transaction:
+            yield
+            return
+        self._c.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except:
+            self._c.execute("ROLLBACK")
+            raise
+        self._c.execute("COMMIT")
+
+    @timed("objectdb", op="insertHashVer")
     def insertHashVer(self, version, transaction_id):
         """
         insert a version and transaction id into the table
@@ -80,34 +329,417 @@ class ObjectDB(object):
         :return: integer indicating the last id of the inserted row
         """
         try:
-            self._c.execute("INSERT INTO versions values (?, ?)",
+            self._c.execute("INSERT INTO versions (version, transaction_id) values (?, ?)",
                 (version, transaction_id,))
             return self._c.lastrowid
         except Exception as e:
             print(e)
 
+    @timed("objectdb", op="queryHashVer")
     def queryHashVer(self, version):
         """
         query for the transaction id using version number
         :param version: version of data to query
         :return: tuple (id, transaction id)
         """
-        result = list(self._c.execute("SELECT * FROM versions WHERE version=?",
-                    (version,)))
+        result = list(self._c.execute(
+                "SELECT version, transaction_id FROM versions WHERE version=?",
+                (version,)))
         if len(result) == 1:
             return result[0]
 
+    @timed("objectdb", op="insertPendingVersion")
+    def insertPendingVersion(self, version, root, created=None):
+        """
+        insert a committed version whose Merkle root is not anchored yet
+        :param version: version number
+        :param root: hex string of the Merkle root of the version
+        :param created: time the version was backed up, in seconds since
+            the epoch
+        """
+        self._c.execute("INSERT OR REPLACE INTO versions "
+                        "(version, transaction_id, root, proof, created) "
+                        "values (?, '', ?, NULL, ?)",
+                        (version, root, created))
+
+    @timed("objectdb", op="queryVersions")
+    def queryVersions(self):
+        """
+        query the committed versions
+        :return: list of tuples (version, created), in version order, where
+            created is None for versions committed before it was recorded
+        """
+        return sorted((int(version), created) for version, created in self._c.execute(
+                "SELECT version, created FROM versions"))
+
+    @timed("objectdb", op="deleteVersions")
+    def deleteVersions(self, versions):
+        """
+        delete versions, e.g. collected by the retention policy
+        :param versions: list of version numbers
+        """
+        with self.transaction():
+            self._c.executemany("DELETE FROM versions WHERE version=?",
+                                [(str(version),) for version in versions])
+
+    @timed("objectdb", op="queryPendingVersions")
+    def queryPendingVersions(self):
+        """
+        query the versions waiting to be anchored
+        :return: list of tuples (version, root), in version order
+        """
+        return [(int(version), root) for version, root in self._c.execute(
+                "SELECT version, root FROM versions WHERE transaction_id='' "
+                "ORDER BY CAST(version AS INTEGER)")]
+
+    @timed("objectdb", op="setVersionsAnchored")
+    def setVersionsAnchored(self, transaction_id, proofs):
+        """
+        record that a batch of versions was anchored in a transaction
+        :param transaction_id: id of the transaction with the batch root
+        :param proofs: dictionary, with key is version and value is the
+            proof of its root in the batch root
+        """
+        with self.transaction():
+            for version, proof in proofs.items():
+                self._c.execute(
+                        "UPDATE versions SET transaction_id=?, proof=? WHERE version=?",
+                        (transaction_id, json.dumps(proof), version))
+
+    @timed("objectdb", op="queryVersionAnchor")
+    def queryVersionAnchor(self, version):
+        """
+        query how a version is anchored
+        :param version: version number
+        :return: tuple (transaction_id, root, proof), where transaction_id
+            is empty if the version is not anchored yet, and root and proof
+            are None for versions anchored alone before batching;
+            or None if the version is not found
+        """
+        result = list(self._c.execute(
+                "SELECT transaction_id, root, proof FROM versions WHERE version=?",
+                (version,)))
+        if len(result) != 1:
+            return None
+        transaction_id, root, proof = result[0]
+        return transaction_id, root, json.loads(proof) if proof else None
+
+
+    @timed("objectdb", op="queryDataKeys")
+    def queryDataKeys(self, file_ids):
+        """
+        query the data keys of many file objects, with one statement per
+        MAX_SQL_VARIABLES file objects
+        :param file_ids: list of integers, ids of file objects
+        :return: list of data keys, in the order of file_ids
+        """
+        if not file_ids:
+            return []
+        unique_file_ids = list(set(file_ids))
+        data_key_of_file_id = {}
+        for i in range(0, len(unique_file_ids), MAX_SQL_VARIABLES):
+            batch = unique_file_ids[i:i + MAX_SQL_VARIABLES]
+            data_key_of_file_id.update(self._c.execute(
+                "SELECT rowid, data_key FROM objects WHERE rowid IN ({})".format(
+                    ",".join("?" * len(batch))),
+                batch))
+        return [data_key_of_file_id[file_id] for file_id in file_ids]
+
+    @timed("objectdb", op="insertPackEntries")
+    def insertPackEntries(self, pack, entries):
+        """
+        insert the locations of the file objects of a pack, moving the
+        file objects which were in another pack
+        :param pack: S3 object name of the pack
+        :param entries: list of tuples (file_id, offset, length)
+        """
+        with self.transaction():
+            self._c.executemany("INSERT OR REPLACE INTO packs values (?, ?, ?, ?)",
+                                [(file_id, pack, offset, length)
+                                 for file_id, offset, length in entries])
+            self._c.execute("INSERT OR REPLACE INTO pack_sizes values (?, ?)",
+                            (pack, max(offset + length for _, offset, length in entries)))
+
+    @timed("objectdb", op="queryPackEntries")
+    def queryPackEntries(self, file_ids):
+        """
+        query the locations of many file objects in packs, with one statement
+        per MAX_SQL_VARIABLES file objects
+        :param file_ids: list of integers, ids of file objects
+        :return: dictionary, with key is file_id and value is a tuple
+            (pack, offset, length), for the file objects stored in packs
+            (file objects uploaded before packs are stored alone)
+        """
+        results = {}
+        unique_file_ids = list(set(file_ids))
+        for i in range(0, len(unique_file_ids), MAX_SQL_VARIABLES):
+            batch = unique_file_ids[i:i + MAX_SQL_VARIABLES]
+            for file_id, pack, offset, length in self._c.execute(
+                    "SELECT file_id, pack, offset, length FROM packs "
+                    "WHERE file_id IN ({})".format(",".join("?" * len(batch))), batch):
+                results[file_id] = (pack, offset, length)
+        return results
+
+    @timed("objectdb", op="recordVersionEntries")
+    def recordVersionEntries(self, version, metadata_list, removed_paths):
+        """
+        record the changes of the metadata of a new version: the entries of
+        the changed and removed files end at this version, and the new
+        entries start at it. Each entry holds one reference to each of its
+        file objects, counted in objects.refcount, so that file objects no
+        longer referenced by any version are found without reading the
+        metadata of all versions. Entries recorded for this version before,
+        by a cycle which stopped before the version was committed, are
+        replaced.
+        :param version: version number
+        :param metadata_list: list of Metadata of the files added or changed
+            in the version
+        :param removed_paths: list of paths of the files removed in the version
+        """
+        with self.transaction():
+            self._c.executemany(
+                    "UPDATE objects SET refcount=refcount-1 WHERE rowid=?",
+                    [(file_id,) for file_ids, in self._c.execute(
+                        "SELECT file_ids FROM entries WHERE first_version >= ?",
+                        (version,)).fetchall()
+                     for file_id in set(json.loads(file_ids))])
+            self._c.execute("DELETE FROM entries WHERE first_version >= ?", (version,))
+            self._c.execute("UPDATE entries SET end_version=NULL WHERE end_version >= ?",
+                            (version,))
+            paths = [metadata.filename for metadata in metadata_list] + list(removed_paths)
+            self._c.executemany(
+                    "UPDATE entries SET end_version=? WHERE path=? AND end_version IS NULL",
+                    [(version, path) for path in paths])
+            self._c.executemany(
+                    "INSERT INTO entries (path, first_version, end_version, file_ids) "
+                    "values (?, ?, NULL, ?)",
+                    [(metadata.filename, version, json.dumps(metadata.file_ids))
+                     for metadata in metadata_list])
+            self._c.executemany(
+                    "UPDATE objects SET refcount=refcount+1 WHERE rowid=?",
+                    [(file_id,) for metadata in metadata_list
+                     for file_id in set(metadata.file_ids)])
+
+    @timed("objectdb", op="queryEndedEntries")
+    def queryEndedEntries(self, first_version, last_version):
+        """
+        query the entries which ended and overlap a range of versions
+        :param first_version: first version of the range
+        :param last_version: last version of the range
+        :return: list of tuples (entry_id, first_version, end_version)
+        """
+        return list(self._c.execute(
+                "SELECT rowid, first_version, end_version FROM entries "
+                "WHERE end_version > ? AND first_version <= ?",
+                (first_version, last_version)))
+
+    @timed("objectdb", op="deleteEntries")
+    def deleteEntries(self, entry_ids):
+        """
+        delete entries which are not part of any remaining version, and
+        release their references to file objects
+        :param entry_ids: list of integers, ids of entries
+        :return: tuple (file_ids, paths), where file_ids is the list of ids
+            of the file objects which are not referenced anymore, and paths
+            the set of paths of the deleted entries
+        """
+        unreferenced = set()
+        paths = set()
+        with self.transaction():
+            for i in range(0, len(entry_ids), MAX_SQL_VARIABLES):
+                batch = entry_ids[i:i + MAX_SQL_VARIABLES]
+                released = set()
+                for path, file_ids in self._c.execute(
+                        "SELECT path, file_ids FROM entries WHERE rowid IN ({})".format(
+                            ",".join("?" * len(batch))), batch).fetchall():
+                    paths.add(path)
+                    for file_id in set(json.loads(file_ids)):
+                        self._c.execute(
+                                "UPDATE objects SET refcount=refcount-1 WHERE rowid=?",
+                                (file_id,))
+                        released.add(file_id)
+                self._c.execute("DELETE FROM entries WHERE rowid IN ({})".format(
+                        ",".join("?" * len(batch))), batch)
+                unreferenced.update(released)
+            results = []
+            unreferenced = list(unreferenced)
+            for i in range(0, len(unreferenced), MAX_SQL_VARIABLES):
+                batch = unreferenced[i:i + MAX_SQL_VARIABLES]
+                results += [rowid for rowid, in self._c.execute(
+                        "SELECT rowid FROM objects WHERE refcount <= 0 AND rowid IN ({})"
+                        .format(",".join("?" * len(batch))), batch)]
+        return results, paths
+
+    @timed("objectdb", op="queryUnreferencedObjects")
+    def queryUnreferencedObjects(self):
+        """
+        query the file objects referenced by no entry, e.g. created for a
+        version which was never committed
+        :return: list of integers, ids of file objects
+        """
+        return [rowid for rowid, in self._c.execute(
+                "SELECT rowid FROM objects WHERE refcount <= 0")]
+
+    @timed("objectdb", op="deleteObjects")
+    def deleteObjects(self, file_ids):
+        """
+        delete file objects and their locations in packs
+        :param file_ids: list of integers, ids of file objects
+        :return: tuple (packs, unpacked_file_ids), where packs is the set of
+            the packs which held some of the file objects, and
+            unpacked_file_ids the list of the file objects stored alone
+        """
+        packs = set()
+        unpacked_file_ids = []
+        with self.transaction():
+            for i in range(0, len(file_ids), MAX_SQL_VARIABLES):
+                batch = file_ids[i:i + MAX_SQL_VARIABLES]
+                placeholders = ",".join("?" * len(batch))
+                packed = dict(self._c.execute(
+                        "SELECT file_id, pack FROM packs WHERE file_id IN ({})"
+                        .format(placeholders), batch).fetchall())
+                packs.update(packed.values())
+                unpacked_file_ids += [file_id for file_id in batch
+                                      if file_id not in packed]
+                self._c.execute("DELETE FROM packs WHERE file_id IN ({})"
+                                .format(placeholders), batch)
+                self._c.execute("DELETE FROM objects WHERE rowid IN ({})"
+                                .format(placeholders), batch)
+        return packs, unpacked_file_ids
+
+    @timed("objectdb", op="queryEmptyPacks")
+    def queryEmptyPacks(self, packs):
+        """
+        :param packs: list of S3 object names of packs
+        :return: list of the packs which hold no file object anymore
+        """
+        return [pack for pack in packs if self._c.execute(
+                "SELECT 1 FROM packs WHERE pack=? LIMIT 1", (pack,)).fetchone() is None]
+
+    @timed("objectdb", op="querySparsePacks")
+    def querySparsePacks(self, threshold):
+        """
+        :param threshold: ratio of the size of a pack
+        :return: list of the packs in which the file objects which were
+            deleted take more than threshold of the size of the pack, except
+            empty packs
+        """
+        return [pack for pack, in self._c.execute(
+                "SELECT pack_sizes.pack FROM pack_sizes JOIN packs "
+                "ON packs.pack = pack_sizes.pack GROUP BY pack_sizes.pack "
+                "HAVING pack_sizes.size - SUM(packs.length) > ? * pack_sizes.size",
+                (threshold,))]
+
+    @timed("objectdb", op="deletePacks")
+    def deletePacks(self, packs):
+        """
+        delete packs, once their file objects were deleted or moved to
+        other packs
+        :param packs: list of S3 object names of packs
+        """
+        with self.transaction():
+            for i in range(0, len(packs), MAX_SQL_VARIABLES):
+                batch = packs[i:i + MAX_SQL_VARIABLES]
+                placeholders = ",".join("?" * len(batch))
+                self._c.execute("DELETE FROM packs WHERE pack IN ({})"
+                                .format(placeholders), batch)
+                self._c.execute("DELETE FROM pack_sizes WHERE pack IN ({})"
+                                .format(placeholders), batch)
+
+    @timed("objectdb", op="queryPackFileIds")
+    def queryPackFileIds(self, packs):
+        """
+        :param packs: list of S3 object names of packs
+        :return: set of integers, ids of the file objects in the packs
+        """
+        file_ids = set()
+        for pack in packs:
+            file_ids.update(file_id for file_id, in self._c.execute(
+                    "SELECT file_id FROM packs WHERE pack=?", (pack,)))
+        return file_ids
+
+    def isMigrated(self, name):
+        """
+        :param name: name of a one-time migration of the database
+        :return: True if the migration was done
+        """
+        return self._c.execute("SELECT 1 FROM migrations WHERE name=?",
+                               (name,)).fetchone() is not None
+
+    def setMigrated(self, name):
+        self._c.execute("INSERT OR IGNORE INTO migrations values (?)", (name,))
+
+    @timed("objectdb", op="insertFileRecord")
+    def insertFileRecord(self, path, inode, size, mtime_ns, digest,
+                         chunk_hashes, file_ids):
+        """
+        insert or replace the record of the content of a backed up file
+        :param path: path of file, relative to the backup folder
+        :param inode: inode of file
+        :param size: size of file
+        :param mtime_ns: modification time of file, in nanoseconds
+        :param digest: hash of the whole content of file
+        :param chunk_hashes: list of hashes of chunks of file
+        :param file_ids: list of ids of file objects of chunks of file
+        """
+        try:
+            self._c.execute("INSERT OR REPLACE INTO files values (?, ?, ?, ?, ?, ?, ?)",
+                            (path, inode, size, mtime_ns, digest,
+                             json.dumps(chunk_hashes), json.dumps(file_ids)))
+        except Exception as e:
+            print(e)
+
+    @timed("objectdb", op="queryFileRecord")
+    def queryFileRecord(self, path):
+        """
+        query the record of the content of a backed up file
+        :param path: path of file, relative to the backup folder
+        :return: a tuple (inode, size, mtime_ns, digest, chunk_hashes, file_ids),
+            or None if the file was never backed up
+        """
+        result = list(self._c.execute(
+            "SELECT inode, size, mtime_ns, digest, chunk_hashes, file_ids "
+            "FROM files WHERE path=?", (path,)))
+        if len(result) != 1:
+            return None
+        inode, size, mtime_ns, digest, chunk_hashes, file_ids = result[0]
+        return inode, size, mtime_ns, digest, json.loads(chunk_hashes), json.loads(file_ids)
+
+    @timed("objectdb", op="queryFileRecordIds")
+    def queryFileRecordIds(self, paths):
+        """
+        query the file objects of the records of some files
+        :param paths: list of paths of files, relative to the backup folder
+        :return: dictionary, with key is path and value is the list of ids
+            of file objects of the file, for the files which have a record
+        """
+        results = {}
+        for path in paths:
+            row = self._c.execute("SELECT file_ids FROM files WHERE path=?",
+                                  (path,)).fetchone()
+            if row is not None:
+                results[path] = json.loads(row[0])
+        return results
+
+    @timed("objectdb", op="deleteFileRecords")
+    def deleteFileRecords(self, paths):
+        """
+        :param paths: list of paths of files, relative to the backup folder
+        """
+        with self.transaction():
+            self._c.executemany("DELETE FROM files WHERE path=?",
+                                [(path,) for path in paths])
 
-    def get_chunk_paths_and_hashes(self, filepath):
+    def get_chunks_and_hashes(self, filepath):
         """
-        Compute the hashes of chunks of a file.
+        Iterate over the content-defined chunks of a file and their hashes.
+        The file is read once with buffered reads, no chunk is written to disk.
         :param filepath: path of file
-        :return: dictionary, with key is path of chunk 
-            and value is string of hash of this chunk.
+        :return: generator of tuples (chunk, hash), where chunk is a
+            memoryview only valid until the next iteration
+            and hash is string of hash of this chunk.
         """
-        shutil.rmtree(self._tmp_dir)
-        make_dirs(self._tmp_dir)
-        return split_file_and_get_hash(filepath, self._tmp_dir)
+        return iter_file_chunks(filepath, self._chunker)
 
     
     def __del__(self):
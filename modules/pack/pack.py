@@ -0,0 +1,75 @@
+import os
+import shutil
+
+from utils.utils import make_dirs
+
+DEFAULT_PACK_SIZE = 64 * 1024 * 1024
+# packs in which collected file objects take more than this ratio of the
+# size are rewritten by the garbage collection
+DEFAULT_REPACK_THRESHOLD = 0.5
+# ranges of a pack closer than this are fetched with a single request,
+# downloading the bytes between them
+MAX_RANGE_GAP = 256 * 1024
+MAX_RANGE_SIZE = 16 * 1024 * 1024
+
+
+def write_packs(file_objects, packs_dir, pack_size=DEFAULT_PACK_SIZE):
+    """
+    Append file objects into pack files of about pack_size bytes, so that
+    many small file objects are uploaded and downloaded as one S3 object.
+    A file object is never split between two packs.
+    :param file_objects: list of tuples (file_id, path of file object)
+    :param packs_dir: folder in which pack files are written
+    :param pack_size: target size of a pack, in bytes
+    :return: list of tuples (pack_path, entries), where entries is a list
+        of tuples (file_id, offset, length) of the file objects in the pack
+    """
+    make_dirs(packs_dir)
+    packs = []
+    f = None
+    try:
+        for file_id, file_object_path in file_objects:
+            if f is None or f.tell() >= pack_size:
+                if f is not None:
+                    f.close()
+                # random names, so that packs of uncommitted versions
+                # never collide with uploaded packs
+                pack_path = os.path.join(packs_dir, os.urandom(16).hex())
+                f = open(pack_path, "wb")
+                packs.append((pack_path, []))
+            offset = f.tell()
+            with open(file_object_path, "rb") as file_object:
+                shutil.copyfileobj(file_object, f)
+            packs[-1][1].append((file_id, offset, f.tell() - offset))
+    finally:
+        if f is not None:
+            f.close()
+    return packs
+
+
+def coalesce_ranges(entries, max_gap=MAX_RANGE_GAP, max_size=MAX_RANGE_SIZE):
+    """
+    Group the file objects to download from packs into byte ranges, merging
+    file objects of the same pack which are close to each other.
+    :param entries: list of tuples (file_id, pack, offset, length)
+    :param max_gap: maximum number of unneeded bytes between two merged
+        file objects
+    :param max_size: maximum length of a merged range, unless a single file
+        object is longer
+    :return: list of tuples (pack, offset, length, members), where members
+        is a list of tuples (file_id, offset in the range, length)
+    """
+    ranges = []
+    for file_id, pack, offset, length in sorted(
+            entries, key=lambda entry: (entry[1], entry[2])):
+        if ranges:
+            range_pack, range_offset, range_length, members = ranges[-1]
+            gap = offset - (range_offset + range_length)
+            if range_pack == pack and 0 <= gap <= max_gap \
+                    and offset + length - range_offset <= max_size:
+                members.append((file_id, offset - range_offset, length))
+                ranges[-1] = (pack, range_offset, offset + length - range_offset,
+                              members)
+                continue
+        ranges.append((pack, offset, length, [(file_id, 0, length)]))
+    return ranges
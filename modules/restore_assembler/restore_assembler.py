@@ -0,0 +1,372 @@
+import itertools
+import os
+import shutil
+import time
+
+from modules.pack.pack import coalesce_ranges
+from utils.crypto import decryptData, sha256Bytes
+from utils.metrics import inc
+from utils.utils import make_dirs
+
+
+class _RestoredFile(object):
+    """
+    Progress of a file being restored: the chunks which did not arrive or
+    are not written yet, and the offsets of its chunks as far as the
+    lengths of the chunks before them are known.
+    """
+
+    def __init__(self, path, metadata):
+        self.path = path
+        self.metadata = metadata
+        # positions of the chunks which are not written yet, by file id
+        self.unwritten = {}
+        # ids of the file objects which did not arrive yet
+        self.missing = set()
+        # offsets of the first chunks of the file
+        self.offsets = [0]
+        # number of chunks whose offset was known at the last write
+        self.scanned = 0
+        self.created = False
+        self.done = False
+
+
+class RestoreAssembler(object):
+    """
+    Restore files from their file objects. File objects are read from the
+    local object store or downloaded from S3 (byte ranges of packs, or
+    whole objects), and hashed and decrypted in the download threads. Each
+    chunk is written at its offsets in the files as soon as these offsets
+    are known, and kept in memory only until then. Each file is verified
+    once all its chunks are written.
+    Files are written into a staging folder, which is moved into place by
+    commit once the whole restore is verified, or removed by discard.
+    """
+
+    def __init__(self, user, bucket, object_db, list_metadata, data_keys,
+                 staging_dir, hash_function=sha256Bytes, verify_file=None,
+                 local_objects_dir=None):
+        """
+        :param user: User object downloading from the S3 bucket
+        :param bucket: name of the S3 bucket
+        :param object_db: ObjectDB, with the pack entries, hashes and chunk
+            lengths of the file objects
+        :param list_metadata: list of tuples (path, metadata) of the files
+            to restore, where path is relative to the backup folder
+        :param data_keys: dictionary, with key is file_id and value is the
+            data key of the file object
+        :param staging_dir: folder into which files are written
+        :param hash_function: function hashing encrypted file objects
+        :param verify_file: optional function called with (metadata, hashes
+            of its file objects) once all chunks of a file are written,
+            returning False if the file is modified
+        :param local_objects_dir: optional folder of local file objects,
+            only used with verify_file
+        """
+        self._user = user
+        self._bucket = bucket
+        self._object_db = object_db
+        self._data_keys = data_keys
+        self._staging_dir = staging_dir
+        self._hash_function = hash_function
+        self._verify_file = verify_file
+        self._local_objects_dir = local_objects_dir
+        self._files = [_RestoredFile(os.path.join(staging_dir, path), metadata)
+                       for path, metadata in list_metadata]
+        # files of each file object
+        self._files_of = {}
+        for restored_file in self._files:
+            for file_id in dict.fromkeys(restored_file.metadata.file_ids):
+                self._files_of.setdefault(file_id, []).append(restored_file)
+        # lengths of chunks recorded in ObjectDB, and learnt when they arrive
+        self._recorded_lengths = {}
+        self._lengths = {}
+        # chunks waiting to be written at some of their offsets
+        self._chunks = {}
+        # number of positions of each chunk which are not written yet
+        self._remaining_writes = dict.fromkeys(self._files_of, 0)
+        # hashes of the encrypted file objects
+        self._hashes = {}
+        # file objects which were read locally, downloaded if a file fails
+        # verification
+        self._local_file_ids = set()
+        # file objects which are expected to arrive
+        self._pending = set()
+        # file objects to download again after the current downloads
+        self._to_refetch = set()
+        # file objects of each byte range of the current downloads
+        self._ranges = {}
+
+    def assemble(self):
+        """
+        Restore all files into the staging folder.
+        :return: dictionary, with key is file_id and value is hash of the
+            encrypted file object downloaded from S3 (or read locally)
+        """
+        shutil.rmtree(self._staging_dir, ignore_errors=True)
+        make_dirs(self._staging_dir)
+        self._recorded_lengths = self._object_db.queryChunkLengths(list(self._files_of))
+        self._lengths = dict(self._recorded_lengths)
+        self._pending = set(self._files_of)
+        for restored_file in self._files:
+            self._reset(restored_file)
+        for restored_file in self._files:
+            if not restored_file.missing:
+                # empty file
+                self._finish(restored_file)
+
+        if self._verify_file is not None and self._local_objects_dir is not None:
+            to_download = self._read_local_objects()
+        else:
+            to_download = set(self._files_of)
+        while to_download:
+            self._to_refetch = set()
+            self._fetch(sorted(to_download))
+            # local file objects of files which failed verification
+            to_download = self._to_refetch
+        for restored_file in self._files:
+            if not restored_file.done:
+                raise Exception("File {} is not retrieved!".format(
+                        restored_file.metadata.filename))
+        return self._hashes
+
+    def commit(self, data_dir):
+        """
+        Move the restored files into place.
+        :param data_dir: folder of the restored files, replaced if it exists
+        """
+        shutil.rmtree(data_dir, ignore_errors=True)
+        os.rename(self._staging_dir, data_dir)
+
+    def discard(self):
+        """
+        Remove the files restored into the staging folder.
+        """
+        shutil.rmtree(self._staging_dir, ignore_errors=True)
+
+    def _read_local_objects(self):
+        """
+        Read the file objects found in the local object store, except those
+        whose hash or chunk length differs from the one recorded in ObjectDB.
+        :return: set of ids of the file objects to download
+        """
+        to_download = set()
+        recorded_digests = self._object_db.queryObjectDigests(list(self._files_of))
+        for file_id in self._files_of:
+            file_object_path = os.path.join(self._local_objects_dir, str(file_id))
+            if not os.path.isfile(file_object_path):
+                to_download.add(file_id)
+                continue
+            with open(file_object_path, "rb") as f:
+                data = f.read()
+            try:
+                _, object_hash, chunk = self._decrypt(file_id, data)
+            except Exception:
+                object_hash = None
+            if object_hash is None or (file_id in recorded_digests and
+                    object_hash.hex() != recorded_digests[file_id][0]) or (
+                    file_id in self._recorded_lengths and
+                    len(chunk) != self._recorded_lengths[file_id]):
+                # corrupt local file object
+                inc("local_objects_refetched")
+                to_download.add(file_id)
+                continue
+            inc("local_objects")
+            self._local_file_ids.add(file_id)
+            self._deliver(file_id, object_hash, chunk)
+        # for the LRU eviction of the local object store
+        self._object_db.touchObjects(sorted(self._local_file_ids), time.time_ns())
+        return to_download | self._to_refetch
+
+    def _plan_ranges(self, file_ids):
+        """
+        Plan the requests downloading file objects: file objects in packs
+        are downloaded with one range request per group of neighbouring file
+        objects, the others alone.
+        :param file_ids: list of ids of file objects
+        :return: tuple (ranges, object_names), where ranges is a dictionary,
+            with key is a tuple (pack, offset, length) and value is the list
+            of tuples (file_id, offset in the range, length) of the file
+            objects of the range, and object_names the list of S3 object
+            names of the file objects which are not in packs
+        """
+        pack_entries = self._object_db.queryPackEntries(file_ids)
+        ranges = {}
+        for pack, offset, length, members in coalesce_ranges(
+                [(file_id, pack, offset, length)
+                 for file_id, (pack, offset, length) in pack_entries.items()]):
+            ranges[(pack, offset, length)] = members
+        inc("pack_ranges", len(ranges))
+        object_names = ["file_objects/{}".format(file_id) for file_id in file_ids
+                        if file_id not in pack_entries]
+        return ranges, object_names
+
+    def _fetch(self, file_ids):
+        """
+        Download file objects concurrently, and deliver each of them as soon
+        as it is hashed and decrypted.
+        :param file_ids: list of ids of file objects
+        """
+        self._ranges, object_names = self._plan_ranges(file_ids)
+        downloads = itertools.chain(
+                self._user.download_ranges(
+                        self._bucket, list(self._ranges), self._decrypt_range),
+                self._user.download_objects(
+                        self._bucket, object_names, self._decrypt_object))
+        for _, results in downloads:
+            for file_id, object_hash, chunk in results:
+                self._deliver(file_id, object_hash, chunk)
+
+    def _decrypt(self, file_id, data):
+        """
+        Hash and decrypt a file object, in a download thread.
+        :return: tuple (file_id, hash of the encrypted file object, chunk)
+        """
+        try:
+            chunk = decryptData(self._data_keys[file_id], data)
+        except Exception:
+            raise Exception("File object {} is modified!".format(file_id))
+        return file_id, self._hash_function(data), chunk
+
+    def _decrypt_object(self, object_name, data):
+        return [self._decrypt(int(object_name.rsplit("/", 1)[1]), data)]
+
+    def _decrypt_range(self, request, data):
+        with memoryview(data) as view:
+            return [self._decrypt(file_id, view[offset:offset + length])
+                    for file_id, offset, length in self._ranges[request]]
+
+    def _deliver(self, file_id, object_hash, chunk):
+        """
+        Write a chunk which arrived into the files waiting for it, and
+        finish the files which have all their chunks.
+        """
+        if self._lengths.setdefault(file_id, len(chunk)) != len(chunk):
+            if file_id in self._recorded_lengths:
+                raise Exception("File object {} is modified!".format(file_id))
+            # the chunks after it were written at offsets computed with the
+            # length of a corrupt local file object
+            self._lengths[file_id] = len(chunk)
+            self._chunks.pop(file_id, None)
+            for restored_file in self._files_of[file_id]:
+                if not restored_file.done:
+                    self._reset(restored_file)
+        self._pending.discard(file_id)
+        self._hashes[file_id] = object_hash
+        self._chunks[file_id] = chunk
+        waiting = [restored_file for restored_file in self._files_of[file_id]
+                   if not restored_file.done and file_id in restored_file.missing]
+        for restored_file in waiting:
+            restored_file.missing.discard(file_id)
+            self._write_at_offsets(restored_file, file_id)
+        if self._remaining_writes[file_id] == 0:
+            self._chunks.pop(file_id, None)
+        for restored_file in waiting:
+            if not restored_file.missing:
+                self._finish(restored_file)
+
+    def _write_at_offsets(self, restored_file, file_id=None):
+        """
+        Write the chunks of a file whose offsets are known: the chunk of
+        file_id, which just arrived, and the chunks in memory whose offsets
+        are known thanks to the lengths of the chunks before them. Chunks
+        written at all their offsets are dropped.
+        """
+        file_ids = restored_file.metadata.file_ids
+        offsets = restored_file.offsets
+        while len(offsets) < len(file_ids) and file_ids[len(offsets) - 1] in self._lengths:
+            offsets.append(offsets[-1] + self._lengths[file_ids[len(offsets) - 1]])
+        candidates = set(file_ids[restored_file.scanned:len(offsets)])
+        restored_file.scanned = len(offsets)
+        if file_id is not None:
+            candidates.add(file_id)
+        writes = []
+        for other in candidates:
+            positions = restored_file.unwritten.get(other)
+            if not positions or other not in self._chunks:
+                continue
+            # positions are in increasing order
+            ready = [i for i in positions if i < len(offsets)]
+            writes += [(offsets[i], self._chunks[other]) for i in ready]
+            restored_file.unwritten[other] = positions[len(ready):]
+            self._remaining_writes[other] -= len(ready)
+            if self._remaining_writes[other] == 0:
+                del self._chunks[other]
+        if writes:
+            self._write(restored_file, writes)
+
+    def _write(self, restored_file, writes):
+        """
+        :param writes: list of tuples (offset, chunk)
+        """
+        if not restored_file.created:
+            restored_file.created = True
+            make_dirs(os.path.dirname(restored_file.path))
+            open(restored_file.path, "wb").close()
+        if not writes:
+            return
+        with open(restored_file.path, "r+b") as f:
+            for offset, chunk in sorted(writes, key=lambda write: write[0]):
+                f.seek(offset)
+                f.write(chunk)
+
+    def _reset(self, restored_file):
+        """
+        Write a file from its beginning: its chunks in memory are written
+        again, and the others are downloaded again unless they are expected
+        to arrive.
+        """
+        for file_id, positions in restored_file.unwritten.items():
+            self._remaining_writes[file_id] -= len(positions)
+        restored_file.unwritten = {}
+        for i, file_id in enumerate(restored_file.metadata.file_ids):
+            restored_file.unwritten.setdefault(file_id, []).append(i)
+        for file_id, positions in restored_file.unwritten.items():
+            self._remaining_writes[file_id] += len(positions)
+        restored_file.offsets = [0]
+        restored_file.scanned = 0
+        restored_file.created = False
+        restored_file.missing = set(file_id for file_id in restored_file.unwritten
+                                    if file_id not in self._chunks)
+        for file_id in restored_file.missing:
+            if file_id not in self._pending:
+                self._pending.add(file_id)
+                self._to_refetch.add(file_id)
+        self._write_at_offsets(restored_file)
+
+    def _refetch(self, file_ids):
+        """
+        Download file objects which were read locally again, and write the
+        files which are not finished and contain them again.
+        """
+        for file_id in file_ids:
+            self._local_file_ids.discard(file_id)
+            self._chunks.pop(file_id, None)
+            self._pending.add(file_id)
+            self._to_refetch.add(file_id)
+        restored_files = []
+        for file_id in file_ids:
+            for restored_file in self._files_of[file_id]:
+                if not restored_file.done and restored_file not in restored_files:
+                    restored_files.append(restored_file)
+        for restored_file in restored_files:
+            self._reset(restored_file)
+
+    def _finish(self, restored_file):
+        """
+        Verify a file once all its chunks are written. If it is modified and
+        some of its file objects were read locally, they are downloaded from
+        S3 and the file is written again.
+        """
+        metadata = restored_file.metadata
+        if self._verify_file is not None and not self._verify_file(
+                metadata, [self._hashes[file_id] for file_id in metadata.file_ids]):
+            suspects = self._local_file_ids.intersection(metadata.file_ids)
+            if not suspects:
+                raise Exception("File {} is modified!".format(metadata.filename))
+            inc("local_objects_refetched", len(suspects))
+            self._refetch(sorted(suspects))
+            return
+        # creates empty files
+        self._write(restored_file, [])
+        restored_file.done = True
@@ -0,0 +1,82 @@
+import time
+
+PERIODS = ("hourly", "daily", "weekly")
+
+
+def _period_of(period, timestamp):
+    """
+    :param period: one of PERIODS
+    :param timestamp: seconds since the epoch
+    :return: hashable key, equal for timestamps in the same hour, day or
+        week (in local time)
+    """
+    t = time.localtime(timestamp)
+    if period == "hourly":
+        return t.tm_year, t.tm_yday, t.tm_hour
+    if period == "daily":
+        return t.tm_year, t.tm_yday
+    year, week, _ = time.strftime("%G %V %u", t).split()
+    return int(year), int(week)
+
+
+class RetentionPolicy(object):
+    """
+    Which versions are kept when old versions are collected: the last
+    keep_last versions, and the latest version of each of the last
+    keep_hourly hours, keep_daily days and keep_weekly weeks which have
+    versions. The latest version is always kept.
+    """
+
+    def __init__(self, keep_last=1, keep_hourly=0, keep_daily=0, keep_weekly=0):
+        self.keep_last = int(keep_last)
+        self.keep_hourly = int(keep_hourly)
+        self.keep_daily = int(keep_daily)
+        self.keep_weekly = int(keep_weekly)
+        if min(self.keep_last, self.keep_hourly, self.keep_daily, self.keep_weekly) < 0:
+            raise Exception("numbers of versions to keep must not be negative")
+
+    @staticmethod
+    def from_config(config):
+        """
+        Create a retention policy from the "retention" section of config.json
+        :param config: dictionary with keys keep_last, keep_hourly,
+            keep_daily and keep_weekly, or None to keep all versions
+        :return: RetentionPolicy object, or None if all versions are kept
+        """
+        if not config:
+            return None
+        return RetentionPolicy(config.get("keep_last", 1),
+                               config.get("keep_hourly", 0),
+                               config.get("keep_daily", 0),
+                               config.get("keep_weekly", 0))
+
+    def to_config(self):
+        return {
+            "keep_last": self.keep_last,
+            "keep_hourly": self.keep_hourly,
+            "keep_daily": self.keep_daily,
+            "keep_weekly": self.keep_weekly,
+        }
+
+    def select(self, versions):
+        """
+        Select the versions to keep.
+        :param versions: list of tuples (version, timestamp), where
+            timestamp is the time the version was backed up, in seconds
+            since the epoch
+        :return: set of the version numbers to keep
+        """
+        newest_first = sorted(versions, reverse=True)
+        keep = set(version for version, _ in newest_first[:max(self.keep_last, 1)])
+        for period, count in zip(PERIODS, (self.keep_hourly, self.keep_daily,
+                                           self.keep_weekly)):
+            seen = set()
+            for version, timestamp in newest_first:
+                if len(seen) == count:
+                    break
+                key = _period_of(period, timestamp)
+                if key not in seen:
+                    # the latest version of the period
+                    seen.add(key)
+                    keep.add(version)
+        return keep
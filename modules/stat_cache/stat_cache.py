@@ -1,29 +1,53 @@
 import os
 import shutil
 
-from modules.metadata.metadata import Metadata
-from utils.utils import make_dirs, cache_data, restore_data
+from utils.utils import make_dirs
+from utils.sqlite_utils import create_connection, create_table
 
 class StatCache(object):
 
 	def __init__(self, stat_cache_dir, backup_folder):
 		self._stat_cache_dir = stat_cache_dir  # str, abs path
 		self._backup_folder = backup_folder  # str, abs path
-
-		# latest file backup
-		self._latest_stat_cache_dir = os.path.join(stat_cache_dir, "latest")
-		make_dirs(self._latest_stat_cache_dir)
-
-		# newest file backup; compared to latest
-		self._new_stat_cache_dir = os.path.join(stat_cache_dir, "new")
-		make_dirs(self._new_stat_cache_dir)
-
-		# root stat file
-		self._root_stat = os.path.join(self._latest_stat_cache_dir,
-			os.path.basename(self._backup_folder) + ".dir")
+		make_dirs(stat_cache_dir)
+
+		# stat caches used to be a tree of pickled os.stat_result, one file
+		# per path; they are not compatible with the sqlite cache
+		for old_cache_dir in ("latest", "new"):
+			shutil.rmtree(os.path.join(stat_cache_dir, old_cache_dir),
+				ignore_errors=True)
+
+		# both caches are stored in a single sqlite database, in table
+		# "latest" (latest file backup) and "new" (newest file backup;
+		# compared to latest), keyed by path relative to the backup folder
+		self._conn = create_connection(os.path.join(stat_cache_dir, "stat_cache.db"))
+		self._c = self._conn.cursor()
+		self._c.execute("PRAGMA journal_mode=WAL")
+		for table in ("latest", "new"):
+			create_table(self._c, self._sql_create_table(table))
+
+		# root stat entry
+		self._root_path = self.getLocalPath(self._backup_folder)
+		# stat rows of the scan in progress, written to table "new"
+		self._new_rows = []
+		# changes found by the last check_paths, written into table "latest"
+		# in place by update_new_cache, or None if table "new" holds the
+		# last full scan
+		self._pending_changes = ([], [])
 
 		self.initialized = True
 
+	@staticmethod
+	def _sql_create_table(table):
+		return """ CREATE TABLE IF NOT EXISTS {} (
+						path text PRIMARY KEY,
+						is_dir integer NOT NULL,
+						size integer NOT NULL,
+						mtime_ns integer NOT NULL,
+						ctime_ns integer NOT NULL,
+						inode integer NOT NULL
+				); """.format(table)
+
 
 	def getLocalPath(self, path):
 		# return str(path.path).replace(self._backup_folder, "")[1:]	#drop the leading slash
@@ -33,44 +57,33 @@ class StatCache(object):
 			return os.path.basename(self._backup_folder)
 		return os.path.join(os.path.basename(self._backup_folder), localPath)
 
-	def getSuffix(self, path):
-		#directory stat files have the following name: <directory_name>.dir
-		#file stat files have the following name: <file_name>.file
-		if os.path.isdir(path):	#is a dir
-			suffix = ".dir"
-		else:				#is a file
-			suffix = ".file"
-		return suffix
+	def _get_latest_stat(self, localPath):
+		# return (size, mtime_ns, ctime_ns, inode) of the latest backup, or None
+		self._c.execute("SELECT size, mtime_ns, ctime_ns, inode FROM latest WHERE path=?",
+			(localPath,))
+		return self._c.fetchone()
 
 	def _recursive_file_check(self, path, list_modified_files, list_unmodified_files):
 		modified = False
 
 		localPath = self.getLocalPath(path)
-		suffix = self.getSuffix(path)
-
-		newStatPath = os.path.join(self._new_stat_cache_dir, localPath + suffix)
-		latestStatPath = os.path.join(self._latest_stat_cache_dir, localPath + suffix)
+		isDir = os.path.isdir(path)
 
-		# print(os.path.basename(latestStatPath))
+		#stat and record in the new cache
+		statResult = os.stat(path)
+		self._new_rows.append((localPath, isDir, statResult.st_size,
+			statResult.st_mtime_ns, statResult.st_ctime_ns, statResult.st_ino))
 
-		if not os.path.isfile(latestStatPath):
-			#stat file does not exist for path, so it must be new
-			# print("DNE")
+		latestStat = self._get_latest_stat(localPath)
+		if latestStat is None:
+			#stat entry does not exist for path, so it must be new
+			modified = True
+		#compare to existing stat entry
+		elif statResult.st_ctime_ns != latestStat[2] \
+				or statResult.st_mtime_ns != latestStat[1]:
 			modified = True
-		#stat and write
-		statResult = os.stat(path)
-		cache_data(statResult, newStatPath)
-		#compare to existing stat file, if it exists (not modified yet)
-		if not modified:
-			latestStatResult = restore_data(latestStatPath)
-			if statResult.st_ctime != latestStatResult.st_ctime \
-					or statResult.st_mtime != latestStatResult.st_mtime:
-				# print("DIFF TIME")
-				# print(statResult.st_ctime)
-				# print(latestStatResult)
-				modified = True
 
-		if os.path.isfile(path):
+		if not isDir:
 			if modified:
 				list_modified_files.append(path)
 			else:
@@ -90,15 +103,86 @@ class StatCache(object):
 	def recursive_file_check(self, path):
 		list_modified_files = []
 		list_unmodified_files = []
+		self._new_rows = []
 		modified = self._recursive_file_check(
 				path, list_modified_files, list_unmodified_files)
+		# write the whole new cache in a single transaction
+		self._c.execute("BEGIN")
+		self._c.execute("DELETE FROM new")
+		self._c.executemany("INSERT INTO new VALUES (?, ?, ?, ?, ?, ?)", self._new_rows)
+		self._c.execute("COMMIT")
+		self._new_rows = []
+		self._pending_changes = None
+		return modified, list_modified_files, list_unmodified_files
+
+	def _get_abs_path(self, localPath):
+		return os.path.join(os.path.dirname(self._backup_folder), localPath)
+
+	def check_paths(self, dirty_paths):
+		# check only the paths reported as changed (e.g. by inotify) and
+		# their parent directories; all other files are unmodified. Nothing
+		# is written until update_new_cache, which only writes the rows of
+		# the checked paths, and unmodified files are only listed if some
+		# file was modified.
+		self._pending_changes = ([], [])
+		if not dirty_paths:
+			return False, [], []
+		backupFolderPrefix = self._backup_folder + os.sep
+		paths = set()
+		for path in dirty_paths:
+			path = os.path.abspath(path)
+			while path == self._backup_folder or path.startswith(backupFolderPrefix):
+				paths.add(path)
+				path = os.path.dirname(path)
+
+		modified = False
+		list_modified_files = []
+		removedLocalPaths = []
+		scannedDirPrefixes = []
+		self._new_rows = []
+		for path in sorted(paths):
+			if any(path.startswith(prefix) for prefix in scannedDirPrefixes):
+				continue  # already checked with a new directory
+			localPath = self.getLocalPath(path)
+			if not os.path.exists(path):
+				#removed, with everything below it
+				removedLocalPaths.append(localPath)
+				modified = True
+			elif os.path.isdir(path) and self._get_latest_stat(localPath) is None:
+				#new directory (created or moved in), check all of it
+				self._recursive_file_check(path, list_modified_files, [])
+				scannedDirPrefixes.append(path + os.sep)
+				modified = True
+			elif os.path.isdir(path):
+				statResult = os.stat(path)
+				self._new_rows.append((localPath, True, statResult.st_size,
+					statResult.st_mtime_ns, statResult.st_ctime_ns, statResult.st_ino))
+			elif self._recursive_file_check(path, list_modified_files, []):
+				modified = True
+
+		# the new cache is the latest one, updated with the checked paths
+		self._pending_changes = (self._new_rows, removedLocalPaths)
+		self._new_rows = []
+		if not modified:
+			return False, list_modified_files, []
+
+		setModifiedFiles = set(list_modified_files)
+		removedLocalPaths = set(removedLocalPaths)
+		removedPrefixes = tuple(localPath + os.sep for localPath in removedLocalPaths)
+		list_unmodified_files = []
+		for (localPath,) in self._c.execute("SELECT path FROM latest WHERE is_dir=0"):
+			if localPath in removedLocalPaths or localPath.startswith(removedPrefixes):
+				continue
+			path = self._get_abs_path(localPath)
+			if path not in setModifiedFiles:
+				list_unmodified_files.append(path)
 		return modified, list_modified_files, list_unmodified_files
 
 	def is_backup_folder_modified(self):
 		modified = False
 		list_modified_files = None
 		list_unmodified_files = None
-		if not os.path.isfile(self._root_stat):  # first time executing
+		if self._get_latest_stat(self._root_path) is None:  # first time executing
 			modified = True  # should this be modified? data might not be in cloud yet
 			# self.initialized = False
 			_, list_modified_files, list_unmodified_files = \
@@ -115,6 +199,26 @@ class StatCache(object):
 		pass
 
 	def update_new_cache(self):
-		if self.initialized:  # we only want to update the latest with the new cache if new cache is present
-			shutil.rmtree(self._latest_stat_cache_dir)
-			shutil.move(self._new_stat_cache_dir, self._latest_stat_cache_dir)
+		if not self.initialized:  # we only want to update the latest with the new cache if new cache is present
+			return
+		if self._pending_changes is not None:
+			# write the paths checked by check_paths into the latest cache
+			newRows, removedLocalPaths = self._pending_changes
+			self._c.execute("BEGIN")
+			for localPath in removedLocalPaths:
+				self._c.execute("DELETE FROM latest WHERE path=? OR substr(path, 1, ?)=?",
+					(localPath, len(localPath) + 1, localPath + os.sep))
+			self._c.executemany("INSERT OR REPLACE INTO latest VALUES (?, ?, ?, ?, ?, ?)",
+				newRows)
+			self._c.execute("COMMIT")
+		else:
+			# swap the tables by renaming them, in a single transaction
+			self._c.execute("BEGIN")
+			self._c.execute("DROP TABLE latest")
+			self._c.execute("ALTER TABLE new RENAME TO latest")
+			self._c.execute(self._sql_create_table("new"))
+			self._c.execute("COMMIT")
+		self._pending_changes = ([], [])
+
+	def __del__(self):
+		self._conn.close()
@@ -1,19 +1,120 @@
 import os
+import hashlib
 import logging
 import boto3
 import io
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
 from utils.progress_percentage import ProgressPercentageUpload
 from utils.progress_percentage import ProgressPercentageDownload
 
+from utils.metrics import inc, timer, timed
 from utils.utils import get_chunk_file_name, make_dirs
 
+# limits of S3 multipart uploads
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PARTS = 10000
+# maximum number of keys of a DeleteObjects request
+MAX_DELETE_OBJECTS = 1000
+
+DEFAULT_MULTIPART_THRESHOLD = 16 * 1024 * 1024
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+DEFAULT_PART_CONCURRENCY = 4
+
+
+class FileRegion(io.RawIOBase):
+    """
+    Read-only, seekable stream over a region of a file, so that a part of
+    a file is sent (and re-sent on retries) by botocore without copying
+    it into memory first.
+    """
+
+    def __init__(self, file_name, offset, length):
+        self._f = open(file_name, "rb")
+        self._offset = offset
+        self._length = length
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, position, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            position += self._position
+        elif whence == io.SEEK_END:
+            position += self._length
+        self._position = min(max(position, 0), self._length)
+        return self._position
+
+    def readinto(self, buffer):
+        n = min(len(buffer), self._length - self._position)
+        if n <= 0:
+            return 0
+        self._f.seek(self._offset + self._position)
+        with memoryview(buffer) as view:
+            n = self._f.readinto(view[:n])
+        self._position += n
+        return n
+
+    def close(self):
+        self._f.close()
+        super(FileRegion, self).close()
+
+
 class User(object):
     
-    def __init__(self, aws_credential_path=os.path.join("~", ".aws", "credentials")):
+    def __init__(self, aws_credential_path=os.path.join("~", ".aws", "credentials"),
+                 max_concurrency=10):
         self._aws_credential_path = aws_credential_path
-        self._client = boto3.client('s3')
+        self._max_concurrency = None
+        self._multipart_threshold = DEFAULT_MULTIPART_THRESHOLD
+        self._part_size = DEFAULT_PART_SIZE
+        self._part_concurrency = DEFAULT_PART_CONCURRENCY
+        self._client = None
+        self.set_max_concurrency(max_concurrency)
+
+    def set_max_concurrency(self, max_concurrency):
+        """
+        Set the maximum number of S3 requests in flight for concurrent
+        transfers, and recreate the client so that its connection pool
+        is shared by all of them.
+        :param max_concurrency: integer, maximum number of objects
+            transferred at a time
+        """
+        self._max_concurrency = max(1, int(max_concurrency))
+        # each object may be a multipart upload with several parts in flight
+        self._client = boto3.client('s3', config=Config(
+                max_pool_connections=self._max_concurrency * self._part_concurrency))
+
+    def set_multipart_config(self, threshold, part_size, concurrency):
+        """
+        Set how large objects are uploaded with multipart uploads, and
+        recreate the client for the new number of parts in flight.
+        :param threshold: objects of at least this many bytes are uploaded
+            in parts
+        :param part_size: size of a part in bytes, at least 5 MiB
+        :param concurrency: maximum number of parts of an object uploaded
+            at a time
+        """
+        self._multipart_threshold = max(1, int(threshold))
+        self._part_size = max(MIN_PART_SIZE, int(part_size))
+        self._part_concurrency = max(1, int(concurrency))
+        self.set_max_concurrency(self._max_concurrency)
+
+    def _get_transfer_config(self, **kwargs):
+        return TransferConfig(multipart_threshold=self._multipart_threshold,
+                              multipart_chunksize=self._part_size,
+                              max_concurrency=self._part_concurrency, **kwargs)
 
     def get_list_bucket_name(self):
         reponse = self._client.list_buckets()
@@ -36,27 +137,22 @@ class User(object):
         if object_name is None:
             object_name = file_name
 
-        # open file to chunk
-        with open(file_name, "rb") as f:
-            part_num = 0
-            all_chunks_uploaded = True
-            while True:
-                chunk = f.read(chunk_size)
-                if not chunk:
-                    break
-                chunk_stream = io.BytesIO(chunk)
-                chunk_name = get_chunk_file_name(part_num)
-                chunk_object_name = object_name + "/" + chunk_name
-                part_num = part_num + 1
-                # Upload the file
+        # stream each chunk from the file, without copying it in memory
+        file_size = os.path.getsize(file_name)
+        all_chunks_uploaded = True
+        for part_num, offset in enumerate(range(0, file_size, chunk_size)):
+            chunk_name = get_chunk_file_name(part_num)
+            chunk_object_name = object_name + "/" + chunk_name
+            # Upload the file
+            with FileRegion(file_name, offset,
+                            min(chunk_size, file_size - offset)) as chunk_stream:
                 try:
                     response = self._client.upload_fileobj(
                         chunk_stream, bucket, chunk_object_name)
                 except ClientError as e:
                     logging.error(e)
                     all_chunks_uploaded = False
-                chunk_stream.close()
-            return all_chunks_uploaded
+        return all_chunks_uploaded
 
     def download_file_from_chunks(self, bucket, object_name, file_name=None):
         """
@@ -95,6 +191,7 @@ class User(object):
         return all_chunks_downloaded
 
 
+    @timed("s3", op="PutObject")
     def upload_file(self, file_name, bucket, object_name=None):
         """Upload a file to an S3 bucket
         :param file_name: File to upload
@@ -112,12 +209,321 @@ class User(object):
         try:
             response = self._client.upload_file(
                     file_name, bucket, object_name,
-                    Callback=ProgressPercentageUpload(file_name))
+                    Callback=ProgressPercentageUpload(file_name),
+                    Config=self._get_transfer_config())
         except ClientError as e:
             logging.error(e)
             return False
         return True
 
+    def _upload_file_no_progress(self, file_name, bucket, object_name):
+        """
+        Upload a file to an S3 bucket from a worker thread of upload_files.
+        :return: True if file was uploaded, else False
+        """
+        file_size = os.path.getsize(file_name)
+        if file_size >= self._multipart_threshold:
+            return self._upload_multipart(file_name, bucket, object_name, file_size)
+        try:
+            with timer("s3", op="PutObject"):
+                with open(file_name, "rb") as f:
+                    self._client.put_object(Bucket=bucket, Key=object_name, Body=f)
+        except Exception as e:
+            logging.error("Cannot upload %s: %s", object_name, e)
+            inc("s3_errors", op="PutObject")
+            return False
+        inc("s3_bytes", file_size, direction="upload")
+        return True
+
+    def _find_multipart_upload(self, bucket, object_name):
+        """
+        Find an unfinished multipart upload of an object, e.g. interrupted
+        by a crash or a failed part.
+        :return: tuple (upload_id, dictionary with key is part number and
+            value is tuple (size, etag) of the uploaded parts), or None
+        """
+        with timer("s3", op="ListMultipartUploads"):
+            response = self._client.list_multipart_uploads(
+                    Bucket=bucket, Prefix=object_name)
+        uploads = [upload for upload in response.get("Uploads", [])
+                   if upload["Key"] == object_name]
+        if not uploads:
+            return None
+        upload_id = max(uploads, key=lambda upload: upload["Initiated"])["UploadId"]
+        parts = {}
+        paginator = self._client.get_paginator("list_parts")
+        with timer("s3", op="ListParts"):
+            for page in paginator.paginate(Bucket=bucket, Key=object_name,
+                                           UploadId=upload_id):
+                for part in page.get("Parts", []):
+                    parts[part["PartNumber"]] = (part["Size"], part["ETag"])
+        return upload_id, parts
+
+    def _upload_part(self, file_name, bucket, object_name, upload_id,
+                     part_number, offset, length, uploaded_part):
+        """
+        Upload a part of a multipart upload, from a worker thread of
+        _upload_multipart, unless the same part was already uploaded.
+        :param uploaded_part: tuple (size, etag) of the part uploaded before
+            the upload was interrupted, or None
+        :return: ETag of the part
+        """
+        with FileRegion(file_name, offset, length) as body:
+            if uploaded_part is not None and uploaded_part[0] == length:
+                md5 = hashlib.md5()
+                for block in iter(lambda: body.read(1 << 20), b""):
+                    md5.update(block)
+                if uploaded_part[1].strip('"') == md5.hexdigest():
+                    inc("s3_parts_resumed")
+                    return uploaded_part[1]
+                body.seek(0)
+            with timer("s3", op="UploadPart"):
+                response = self._client.upload_part(
+                        Bucket=bucket, Key=object_name, UploadId=upload_id,
+                        PartNumber=part_number, Body=body, ContentLength=length)
+        inc("s3_bytes", length, direction="upload")
+        return response["ETag"]
+
+    def _upload_multipart(self, file_name, bucket, object_name, file_size):
+        """
+        Upload a large file with a multipart upload, with at most
+        part_concurrency parts in flight, each part streamed from the file.
+        An unfinished multipart upload of the same object is resumed: its
+        parts which match the file are not uploaded again. A failed upload
+        is not aborted, so that it is resumed when it is retried; uploads
+        which are not retried are aborted by abort_multipart_uploads.
+        :return: True if file was uploaded, else False
+        """
+        part_size = max(self._part_size, -(-file_size // MAX_PARTS))
+        offsets = list(range(0, file_size, part_size))
+        try:
+            unfinished = self._find_multipart_upload(bucket, object_name)
+            if unfinished is None:
+                with timer("s3", op="CreateMultipartUpload"):
+                    upload_id = self._client.create_multipart_upload(
+                            Bucket=bucket, Key=object_name)["UploadId"]
+                uploaded_parts = {}
+            else:
+                upload_id, uploaded_parts = unfinished
+            with ThreadPoolExecutor(max_workers=self._part_concurrency) as pool:
+                etags = list(pool.map(
+                        lambda i: self._upload_part(
+                                file_name, bucket, object_name, upload_id, i + 1,
+                                offsets[i], min(part_size, file_size - offsets[i]),
+                                uploaded_parts.get(i + 1)),
+                        range(len(offsets))))
+            with timer("s3", op="CompleteMultipartUpload"):
+                self._client.complete_multipart_upload(
+                        Bucket=bucket, Key=object_name, UploadId=upload_id,
+                        MultipartUpload={"Parts": [
+                                {"PartNumber": i + 1, "ETag": etag}
+                                for i, etag in enumerate(etags)]})
+        except Exception as e:
+            logging.error("Cannot upload %s: %s", object_name, e)
+            inc("s3_errors", op="MultipartUpload")
+            return False
+        return True
+
+    def abort_multipart_uploads(self, bucket, keep_object_names=()):
+        """
+        Abort the unfinished multipart uploads of a bucket, whose parts are
+        billed until they are aborted, e.g. uploads of packs which were
+        dropped or collected after their upload failed. The latest upload
+        of each object of keep_object_names is kept, so that it is resumed.
+        :param bucket: Bucket of the uploads
+        :param keep_object_names: object names which will be uploaded again
+        :return: number of uploads aborted
+        """
+        paginator = self._client.get_paginator("list_multipart_uploads")
+        with timer("s3", op="ListMultipartUploads"):
+            uploads = [upload for page in paginator.paginate(Bucket=bucket)
+                       for upload in page.get("Uploads", [])]
+        # the upload resumed by _find_multipart_upload
+        resumed = {}
+        keep_object_names = set(keep_object_names)
+        for upload in uploads:
+            if upload["Key"] in keep_object_names and (
+                    upload["Key"] not in resumed or
+                    upload["Initiated"] > resumed[upload["Key"]]["Initiated"]):
+                resumed[upload["Key"]] = upload
+        aborted = 0
+        for upload in uploads:
+            if resumed.get(upload["Key"]) is upload:
+                continue
+            try:
+                with timer("s3", op="AbortMultipartUpload"):
+                    self._client.abort_multipart_upload(
+                            Bucket=bucket, Key=upload["Key"], UploadId=upload["UploadId"])
+            except Exception as e:
+                inc("s3_errors", op="AbortMultipartUpload")
+                logging.error("Cannot abort the upload of %s: %s", upload["Key"], e)
+                continue
+            aborted += 1
+        inc("s3_aborted_uploads", aborted)
+        return aborted
+
+    def upload_files(self, file_and_object_names, bucket, max_retries=3):
+        """
+        Upload many files to an S3 bucket concurrently, with at most
+        max_concurrency uploads in flight, retrying failed uploads.
+        :param file_and_object_names: list of tuples (file_name, object_name)
+        :param bucket: Bucket to upload to
+        :param max_retries: number of times failed uploads are retried
+        :return: list of tuples (file_name, object_name) which could not be
+            uploaded, empty if all files were uploaded
+        """
+        pending = list(file_and_object_names)
+        attempt = 0
+        with ThreadPoolExecutor(max_workers=self._max_concurrency) as pool:
+            while pending:
+                results = list(pool.map(
+                        lambda fo: self._upload_file_no_progress(fo[0], bucket, fo[1]),
+                        pending))
+                print("Uploaded {}/{} objects".format(
+                        results.count(True), len(pending)))
+                pending = [fo for fo, uploaded in zip(pending, results)
+                           if not uploaded]
+                if not pending or attempt == max_retries:
+                    break
+                attempt += 1
+                print("Retrying {} failed uploads".format(len(pending)))
+                time.sleep(2 ** attempt)
+        for file_name, object_name in pending:
+            logging.error("Failed to upload %s", object_name)
+        return pending
+
+    def _get_object(self, bucket, request, process, max_retries):
+        """
+        Download an object, or a byte range of an object, into memory from
+        a worker thread of download_objects or download_ranges, retrying on
+        errors, and process it.
+        :param request: S3 object name, or tuple (object_name, offset, length)
+        :return: result of process(request, data)
+        """
+        if isinstance(request, tuple):
+            object_name, offset, length = request
+            kwargs = {"Range": "bytes={}-{}".format(offset, offset + length - 1)}
+        else:
+            object_name = request
+            kwargs = {}
+        attempt = 0
+        while True:
+            try:
+                with timer("s3", op="GetObject"):
+                    response = self._client.get_object(Bucket=bucket, Key=object_name,
+                                                       **kwargs)
+                    data = response["Body"].read()
+                if kwargs and len(data) != length:
+                    raise Exception("Expected {} bytes, received {}".format(
+                            length, len(data)))
+                inc("s3_bytes", len(data), direction="download")
+                break
+            except Exception as e:
+                inc("s3_errors", op="GetObject")
+                if attempt == max_retries:
+                    raise Exception("Cannot download {}: {}".format(object_name, e))
+                attempt += 1
+                logging.error("Cannot download %s, retrying: %s", object_name, e)
+                time.sleep(2 ** attempt)
+        if process is None:
+            return data
+        return process(request, data)
+
+    def download_objects(self, bucket, object_names, process=None, max_retries=3):
+        """
+        Download many objects from an S3 bucket into memory concurrently,
+        with at most max_concurrency downloads in flight.
+        :param bucket: Bucket to download from
+        :param object_names: list of S3 object names
+        :param process: optional function called in the worker thread with
+            (object_name, data) as soon as an object is downloaded,
+            e.g. to hash and decrypt it
+        :param max_retries: number of times a failed download is retried
+        :return: generator of tuples (object_name, result) in the order
+            downloads complete, where result is the data of the object,
+            or the return value of process if given
+        """
+        return self._download_concurrently(bucket, object_names, process, max_retries)
+
+    def download_ranges(self, bucket, ranges, process=None, max_retries=3):
+        """
+        Download byte ranges of objects from an S3 bucket into memory
+        concurrently, with at most max_concurrency downloads in flight.
+        :param bucket: Bucket to download from
+        :param ranges: list of tuples (object_name, offset, length)
+        :param process: optional function called in the worker thread with
+            ((object_name, offset, length), data) as soon as a range is
+            downloaded
+        :param max_retries: number of times a failed download is retried
+        :return: generator of tuples ((object_name, offset, length), result)
+            in the order downloads complete, as download_objects
+        """
+        return self._download_concurrently(bucket, ranges, process, max_retries)
+
+    def _download_concurrently(self, bucket, requests, process, max_retries):
+        requests = iter(requests)
+        with ThreadPoolExecutor(max_workers=self._max_concurrency) as pool:
+            in_flight = {}
+            while True:
+                # keep a bounded window of requests, so that results do not
+                # pile up in memory if the consumer is slower than S3
+                while len(in_flight) < 2 * self._max_concurrency:
+                    request = next(requests, None)
+                    if request is None:
+                        break
+                    future = pool.submit(self._get_object, bucket, request,
+                                         process, max_retries)
+                    in_flight[future] = request
+                if not in_flight:
+                    break
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    request = in_flight.pop(future)
+                    yield request, future.result()
+
+    def object_exists(self, bucket, object_name):
+        """
+        :return: True if the object exists in the bucket, False otherwise
+        """
+        try:
+            with timer("s3", op="HeadObject"):
+                self._client.head_object(Bucket=bucket, Key=object_name)
+            return True
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return False
+            raise
+
+    def delete_objects(self, bucket, object_names):
+        """
+        Delete many objects from an S3 bucket, with one DeleteObjects request
+        per MAX_DELETE_OBJECTS objects. Objects which do not exist are
+        deleted successfully.
+        :param bucket: Bucket to delete from
+        :param object_names: list of S3 object names
+        :return: list of the object names which could not be deleted
+        """
+        failed = []
+        for i in range(0, len(object_names), MAX_DELETE_OBJECTS):
+            batch = object_names[i:i + MAX_DELETE_OBJECTS]
+            try:
+                with timer("s3", op="DeleteObjects"):
+                    response = self._client.delete_objects(Bucket=bucket, Delete={
+                            "Objects": [{"Key": object_name} for object_name in batch],
+                            "Quiet": True})
+            except Exception as e:
+                inc("s3_errors", op="DeleteObjects")
+                logging.error("Cannot delete %d objects: %s", len(batch), e)
+                failed += batch
+                continue
+            errors = response.get("Errors", [])
+            for error in errors:
+                logging.error("Cannot delete %s: %s", error["Key"], error.get("Message"))
+            failed += [error["Key"] for error in errors]
+            inc("s3_deleted_objects", len(batch) - len(errors))
+        return failed
+
+    @timed("s3", op="GetObject")
     def download_file(self, file_name, bucket, object_name):
         self._client.download_file(
                 bucket, object_name, file_name,
@@ -126,10 +532,18 @@ class User(object):
                 
 
     def download_folder(self, bucket_name, folder_prefix, out_dir):
-        bucket = boto3.resource('s3').Bucket(bucket_name)
-        for file_object in bucket.objects.filter(Prefix=folder_prefix):
-            object_name = file_object.key
-            print(object_name)
+        paginator = self._client.get_paginator("list_objects_v2")
+        with timer("s3", op="ListObjectsV2"):
+            object_names = [file_object["Key"]
+                            for page in paginator.paginate(Bucket=bucket_name,
+                                                           Prefix=folder_prefix)
+                            for file_object in page.get("Contents", [])]
+
+        def save(object_name, data):
             file_name = os.path.join(out_dir, object_name)
             make_dirs(os.path.dirname(file_name))
-            self.download_file(file_name, bucket_name, object_name)
+            with open(file_name, "wb") as f:
+                f.write(data)
+
+        for object_name, _ in self.download_objects(bucket_name, object_names, save):
+            print(object_name)
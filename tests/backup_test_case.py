@@ -0,0 +1,86 @@
+import contextlib
+import gc
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from benchmarks.local_s3 import LocalS3User
+from modules.backup_program.backup_program import BackupProgram
+
+BUCKET = "test-bucket"
+
+
+class BackupTestCase(unittest.TestCase):
+    """
+    Backup program backing up a temporary folder into a local stand-in of
+    an S3 bucket, anchoring its versions locally.
+    """
+
+    config = {}
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.src_dir = os.path.join(self.tmp_dir, "src")
+        self.s3_dir = os.path.join(self.tmp_dir, "s3")
+        os.makedirs(self.src_dir)
+        self.user = LocalS3User(self.s3_dir, BUCKET)
+        config = {"backup_folder": self.src_dir, "bucket": BUCKET,
+                  "time_interval": 0, "anchor": {"type": "local"}, "workers": 1,
+                  "chunking": {"min_size": 16384, "avg_size": 32768,
+                               "max_size": 65536}}
+        config.update(self.config)
+        with self.quiet():
+            self.backup_program = BackupProgram(
+                    self.user, prefix_path=os.path.join(self.tmp_dir, "prefix"))
+            self.backup_program.configure(config, "password")
+
+    def tearDown(self):
+        # saves the version before its folder is removed
+        del self.backup_program
+        gc.collect()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    @staticmethod
+    def quiet():
+        return contextlib.redirect_stdout(io.StringIO())
+
+    def write(self, path, data):
+        path = os.path.join(self.src_dir, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+
+    def backup(self):
+        with self.quiet():
+            self.backup_program.backup_once()
+            self.backup_program.drain_anchors()
+        return self.backup_program._version
+
+    def restore(self, version):
+        """
+        :return: tuple (True if restored, folder of the restored files)
+        """
+        restore_dir = os.path.join(self.tmp_dir, "restore")
+        with self.quiet():
+            restored = self.backup_program.restore_version(version, restore_dir)
+        return restored, os.path.join(restore_dir, "v{}".format(version), "data")
+
+    def read_tree(self, root_dir):
+        """
+        :return: dictionary, with key is path relative to root_dir and value
+            is content of the file
+        """
+        tree = {}
+        for dir_path, _, file_names in os.walk(root_dir):
+            for file_name in file_names:
+                path = os.path.join(dir_path, file_name)
+                with open(path, "rb") as f:
+                    tree[os.path.relpath(path, root_dir)] = f.read()
+        return tree
+
+    def assertRestored(self, version):
+        restored, data_dir = self.restore(version)
+        self.assertTrue(restored)
+        self.assertEqual(self.read_tree(data_dir), self.read_tree(self.src_dir))
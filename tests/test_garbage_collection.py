@@ -0,0 +1,110 @@
+import os
+import unittest
+
+from backup_test_case import BUCKET, BackupTestCase
+from modules.retention.retention import RetentionPolicy
+
+
+class GarbageCollectionTest(BackupTestCase):
+
+    def object_db(self):
+        return self.backup_program._object_db
+
+    def file_ids(self, path):
+        return self.backup_program._new_manifest.get(path).file_ids
+
+    def refcounts(self, file_ids):
+        return dict(self.object_db()._c.execute(
+                "SELECT rowid, refcount FROM objects WHERE rowid IN ({})".format(
+                    ",".join("?" * len(file_ids))), list(file_ids)).fetchall())
+
+    def packs(self):
+        return sorted(pack for pack, in self.object_db()._c.execute(
+                "SELECT DISTINCT pack FROM packs"))
+
+    def uploaded_packs(self):
+        return sorted("packs/" + name for name in
+                      os.listdir(os.path.join(self.s3_dir, BUCKET, "packs")))
+
+    def collect(self):
+        with self.quiet():
+            return self.backup_program.collect_garbage(RetentionPolicy(keep_last=1))
+
+    def assertLatestRestored(self, version):
+        # from the packs in S3
+        with self.quiet():
+            self.backup_program._evict_file_objects(0)
+        self.assertRestored(version)
+
+    def test_refcounts(self):
+        data = os.urandom(100000)
+        self.write("a.bin", data)
+        self.write("copy.bin", data)
+        self.write("b.bin", os.urandom(100000))
+        self.backup()
+        shared_ids = set(self.file_ids("a.bin"))
+        removed_ids = set(self.file_ids("b.bin"))
+        # one reference per entry
+        self.assertEqual(set(self.refcounts(shared_ids).values()), {2})
+        self.assertEqual(set(self.refcounts(removed_ids).values()), {1})
+        os.remove(os.path.join(self.src_dir, "copy.bin"))
+        os.remove(os.path.join(self.src_dir, "b.bin"))
+        version = self.backup()
+        self.assertEqual(self.collect(), 1)
+        self.assertEqual(set(self.refcounts(shared_ids).values()), {1})
+        self.assertEqual(self.refcounts(removed_ids), {})
+        self.assertEqual(self.object_db().queryPackEntries(sorted(removed_ids)), {})
+        self.assertLatestRestored(version)
+        restored, _ = self.restore(version - 1)
+        self.assertFalse(restored)
+
+    def test_empty_pack_deleted(self):
+        self.write("a.bin", os.urandom(100000))
+        self.backup()
+        old_packs = self.packs()
+        os.remove(os.path.join(self.src_dir, "a.bin"))
+        self.write("b.bin", os.urandom(100000))
+        version = self.backup()
+        self.assertEqual(self.collect(), 1)
+        new_packs = self.packs()
+        self.assertTrue(set(old_packs).isdisjoint(new_packs))
+        self.assertEqual(self.uploaded_packs(), new_packs)
+        self.assertLatestRestored(version)
+
+    def test_sparse_pack_rewritten(self):
+        self.write("a.bin", os.urandom(100000))
+        self.write("b.bin", os.urandom(100000))
+        self.write("c.bin", os.urandom(100000))
+        self.backup()
+        old_packs = self.packs()
+        live_ids = self.file_ids("c.bin")
+        os.remove(os.path.join(self.src_dir, "a.bin"))
+        os.remove(os.path.join(self.src_dir, "b.bin"))
+        version = self.backup()
+        self.assertEqual(self.collect(), 1)
+        # the live file objects moved into a new pack, with the same ids
+        new_packs = set(pack for pack, _, _ in
+                        self.object_db().queryPackEntries(live_ids).values())
+        self.assertEqual(len(new_packs), 1)
+        self.assertTrue(new_packs.isdisjoint(old_packs))
+        self.assertEqual(self.uploaded_packs(), self.packs())
+        self.assertEqual(set(self.refcounts(live_ids).values()), {1})
+        self.assertEqual(self.object_db().querySparsePacks(0), [])
+        self.assertLatestRestored(version)
+
+    def test_pack_below_threshold_kept(self):
+        self.write("a.bin", os.urandom(100000))
+        self.write("b.bin", os.urandom(100000))
+        self.write("c.bin", os.urandom(100000))
+        self.backup()
+        old_packs = self.packs()
+        os.remove(os.path.join(self.src_dir, "a.bin"))
+        version = self.backup()
+        self.assertEqual(self.collect(), 1)
+        self.assertEqual(self.packs(), old_packs)
+        self.assertEqual(self.object_db().querySparsePacks(0), old_packs)
+        self.assertLatestRestored(version)
+
+
+if __name__ == "__main__":
+    unittest.main()
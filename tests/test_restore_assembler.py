@@ -0,0 +1,85 @@
+import os
+import unittest
+
+from backup_test_case import BUCKET, BackupTestCase
+from utils.crypto import decryptData, encryptData
+from utils.metrics import METRICS
+
+
+class RestoreAssemblerTest(BackupTestCase):
+
+    def setUp(self):
+        super().setUp()
+        block = os.urandom(50000)
+        # repeated and shared chunks, and an empty file
+        self.write("repeated.bin", block * 4 + os.urandom(1000) + block * 2)
+        self.write("sub/shared.bin", os.urandom(3000) + block * 2)
+        self.write("big.bin", os.urandom(400000))
+        self.write("empty", b"")
+        self.version = self.backup()
+        self.objects_dir = self.backup_program._file_objects_dir
+
+    def local_object_path(self, index):
+        file_ids = sorted(os.listdir(self.objects_dir), key=int)
+        return os.path.join(self.objects_dir, file_ids[index])
+
+    def refetched_local_objects(self, snapshot):
+        return METRICS.changes_since(snapshot).get(("local_objects_refetched", ()), 0)
+
+    def test_restore(self):
+        self.assertRestored(self.version)
+
+    def test_restore_without_recorded_lengths(self):
+        self.backup_program._object_db._c.execute("UPDATE objects SET length = NULL")
+        self.assertRestored(self.version)
+
+    def test_corrupt_local_object(self):
+        path = self.local_object_path(1)
+        with open(path, "rb") as f:
+            data = bytearray(f.read())
+        data[-1] ^= 1
+        with open(path, "wb") as f:
+            f.write(data)
+        snapshot = METRICS.snapshot()
+        self.assertRestored(self.version)
+        self.assertEqual(self.refetched_local_objects(snapshot), 1)
+
+    def test_replaced_local_object(self):
+        # a local file object encrypted with its data key, whose hash and
+        # length are not recorded, is only detected by the verification of
+        # its files
+        path = self.local_object_path(2)
+        file_id = int(os.path.basename(path))
+        object_db = self.backup_program._object_db
+        data_key = object_db._c.execute("SELECT data_key FROM objects WHERE rowid = ?",
+                                        (file_id,)).fetchone()[0]
+        with open(path, "rb") as f:
+            chunk = decryptData(data_key, f.read())
+        encryptData(data_key, os.urandom(len(chunk) + 7), path)
+        object_db._c.execute("UPDATE objects SET digest = NULL, length = NULL")
+        snapshot = METRICS.snapshot()
+        self.assertRestored(self.version)
+        self.assertGreaterEqual(self.refetched_local_objects(snapshot), 1)
+
+    def test_tampered_pack(self):
+        with self.quiet():
+            self.backup_program._evict_file_objects(0)
+        packs_dir = os.path.join(self.s3_dir, BUCKET, "packs")
+        pack_paths = [os.path.join(packs_dir, name) for name in os.listdir(packs_dir)]
+        self.assertTrue(pack_paths)
+        for path in pack_paths:
+            with open(path, "r+b") as f:
+                f.seek(os.path.getsize(path) // 2)
+                byte = f.read(1)
+                f.seek(-1, os.SEEK_CUR)
+                f.write(bytes([byte[0] ^ 1]))
+        restored, data_dir = self.restore(self.version)
+        self.assertFalse(restored)
+        # nothing is left from the files written before the corrupt chunk
+        self.assertFalse(os.path.exists(data_dir))
+        self.assertFalse(os.path.exists(os.path.join(os.path.dirname(data_dir),
+                                                     ".data.partial")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,138 @@
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    # optional dependency, only needed for the "zstd" algorithm
+    zstandard = None
+
+# codec of the plaintext of an object, recorded in its header
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_ZSTD = 2
+
+ALGORITHMS = {
+    "none": COMPRESSION_NONE,
+    "zlib": COMPRESSION_ZLIB,
+    "zstd": COMPRESSION_ZSTD,
+}
+DEFAULT_LEVELS = {
+    COMPRESSION_NONE: 0,
+    COMPRESSION_ZLIB: 6,
+    COMPRESSION_ZSTD: 3,
+}
+
+# chunks smaller than this are not worth compressing
+MIN_SIZE = 512
+SAMPLE_SIZE = 16 * 1024
+# a chunk is compressed only if its sample shrinks below this ratio
+SAMPLE_RATIO = 0.9
+
+
+def _check_codec(codec):
+    if codec not in DEFAULT_LEVELS:
+        raise Exception("Unknown compression codec {}".format(codec))
+    if codec == COMPRESSION_ZSTD and zstandard is None:
+        raise Exception("zstd compression needs the zstandard package")
+
+
+class _NoDecompressor(object):
+
+    def decompress(self, data):
+        return bytes(data)
+
+    def flush(self):
+        return b""
+
+
+def decompressobj(codec):
+    """
+    :param codec: codec of the data, one of the COMPRESSION_* constants
+    :return: object with methods decompress(data) and flush(), decompressing
+        a stream piece by piece
+    """
+    _check_codec(codec)
+    if codec == COMPRESSION_ZLIB:
+        return zlib.decompressobj()
+    if codec == COMPRESSION_ZSTD:
+        return zstandard.ZstdDecompressor().decompressobj()
+    return _NoDecompressor()
+
+
+def decompress(codec, data):
+    """
+    :param codec: codec of the data, one of the COMPRESSION_* constants
+    :param data: compressed data
+    :return: decompressed data
+    """
+    decompressor = decompressobj(codec)
+    return decompressor.decompress(data) + decompressor.flush()
+
+
+class Compressor(object):
+    """
+    Optional compression of chunks before encryption. Chunks whose sample
+    does not compress, e.g. parts of JPEG files or archives, are stored
+    uncompressed without spending CPU on compressing them entirely.
+    """
+
+    def __init__(self, algorithm="none", level=None):
+        if algorithm not in ALGORITHMS:
+            raise Exception("compression algorithm must be one of {}".format(
+                    ", ".join(sorted(ALGORITHMS))))
+        self.algorithm = algorithm
+        self.codec = ALGORITHMS[algorithm]
+        _check_codec(self.codec)
+        self.level = DEFAULT_LEVELS[self.codec] if level is None else int(level)
+
+    @staticmethod
+    def from_config(config):
+        """
+        Create a compressor from the "compression" section of config.json
+        :param config: dictionary with keys algorithm and level, or None to
+            disable compression
+        :return: Compressor object
+        """
+        if not config:
+            return Compressor()
+        return Compressor(config.get("algorithm", "none"), config.get("level"))
+
+    def to_config(self):
+        return {
+            "algorithm": self.algorithm,
+            "level": self.level,
+        }
+
+    def _is_compressible(self, data):
+        """
+        Compress a sample of the beginning, the middle and the end of data
+        with the fastest zlib level.
+        :param data: bytes-like object
+        :return: True if the sample shrinks enough
+        """
+        if len(data) <= 3 * SAMPLE_SIZE:
+            sample = data
+        else:
+            middle = (len(data) - SAMPLE_SIZE) // 2
+            sample = b"".join((data[:SAMPLE_SIZE], data[middle:middle + SAMPLE_SIZE],
+                               data[-SAMPLE_SIZE:]))
+        return len(zlib.compress(sample, 1)) < len(sample) * SAMPLE_RATIO
+
+    def compress(self, data):
+        """
+        Compress a chunk if it is worth it.
+        :param data: bytes-like object, e.g. a memoryview slice of the
+            read buffer of a file
+        :return: tuple (codec, data), where codec is COMPRESSION_NONE and data
+            is the given object if the chunk was not compressed
+        """
+        if self.codec == COMPRESSION_NONE or len(data) < MIN_SIZE \
+                or not self._is_compressible(data):
+            return COMPRESSION_NONE, data
+        if self.codec == COMPRESSION_ZLIB:
+            compressed = zlib.compress(data, self.level)
+        else:
+            compressed = zstandard.ZstdCompressor(level=self.level).compress(data)
+        if len(compressed) >= len(data):
+            return COMPRESSION_NONE, data
+        return self.codec, compressed
@@ -1,10 +1,37 @@
 import base64
+import io
+import os
+import struct
 
+from cryptography.exceptions import InvalidTag
 from cryptography.fernet import Fernet
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 
+from utils.compressor import COMPRESSION_NONE, decompressobj
+
+# Encrypted objects are either Fernet tokens (objects written before this
+# format), or a header followed by AES-256-GCM segments:
+#   magic (4 bytes) | format version (1) | algorithm (1) |
+#   compression (1) | segment size (4, big endian) | nonce prefix (7)
+# The compression byte records how the plaintext was compressed before
+# encryption.
+# Each segment holds at most segment size bytes of plaintext and its
+# 16-byte tag. The nonce of a segment is the nonce prefix, its index
+# (4 bytes) and a flag set on the last segment, so that segments cannot
+# be reordered, dropped or truncated; the header is authenticated with
+# every segment.
+OBJECT_MAGIC = b"CSOB"
+OBJECT_FORMAT_VERSION = 2
+ALGORITHM_AES_256_GCM = 1
+OBJECT_PREFIX = struct.Struct(">4sB")
+OBJECT_HEADER = struct.Struct(">4sBBBI7s")
+SEGMENT_SIZE = 64 * 1024
+TAG_SIZE = 16
+
 
 def sha256(data):
     """
@@ -23,6 +50,32 @@ def sha256(data):
         my_sha256.update(bytes(str(data), "utf-8"))
     return my_sha256.finalize()
 
+def sha256Bytes(data):
+    """
+    Hash raw binary data using SHA256, without converting it to a string first
+    :param data: bytes-like object (bytes, bytearray or memoryview)
+    :return: hash of data
+    """
+    my_sha256 = hashes.Hash(hashes.SHA256(), backend=default_backend())
+    my_sha256.update(data)
+    return my_sha256.finalize()
+
+def sha256File(path, block_size=1 << 20):
+    """
+    Hash the content of a file using SHA256, reading it block by block
+    :param path: path of file
+    :param block_size: size of blocks read from the file
+    :return: hash of the content of the file
+    """
+    my_sha256 = hashes.Hash(hashes.SHA256(), backend=default_backend())
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            my_sha256.update(block)
+    return my_sha256.finalize()
+
 def setPassword(plaintext, salt):
     """
     Method to easily generate a password, using SHA256
@@ -54,6 +107,119 @@ def genSymKey():
     """
     return Fernet.generate_key()
 
+def _objectKey(key):
+    """
+    Derive the AES-256 key of encrypted objects from a Fernet key
+    :param key: Fernet key, as returned by genSymKey
+    :return: AESGCM object
+    """
+    hkdf = HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=b"cloudsec-object-v1",
+        backend=default_backend()
+    )
+    return AESGCM(hkdf.derive(base64.urlsafe_b64decode(key)))
+
+def _segmentNonce(nonce_prefix, index, last):
+    return nonce_prefix + struct.pack(">IB", index, 1 if last else 0)
+
+def _readFull(stream, size):
+    """
+    Read size bytes from a stream, or less at the end of the stream
+    """
+    parts = []
+    while size > 0:
+        part = stream.read(size)
+        if not part:
+            break
+        parts.append(part)
+        size -= len(part)
+    return b"".join(parts)
+
+def _objectHeader(compression, segment_size):
+    return OBJECT_HEADER.pack(
+            OBJECT_MAGIC, OBJECT_FORMAT_VERSION, ALGORITHM_AES_256_GCM,
+            compression, segment_size, os.urandom(7))
+
+def encryptStream(key, input_stream, output_stream, segment_size=SEGMENT_SIZE,
+                  compression=COMPRESSION_NONE):
+    """
+    Encrypt a stream into the segmented AES-GCM object format, holding at
+    most one segment in memory
+    :param key: key to use
+    :param input_stream: readable binary stream of plaintext
+    :param output_stream: writable binary stream
+    :param segment_size: number of bytes of plaintext per segment
+    :param compression: codec the plaintext was compressed with, recorded in
+        the header and undone by decryption
+    """
+    aesgcm = _objectKey(key)
+    header = _objectHeader(compression, segment_size)
+    nonce_prefix = header[-7:]
+    output_stream.write(header)
+    index = 0
+    segment = _readFull(input_stream, segment_size)
+    while True:
+        # read ahead to know whether the segment is the last one
+        next_segment = _readFull(input_stream, segment_size) \
+                if len(segment) == segment_size else b""
+        last = not next_segment
+        output_stream.write(aesgcm.encrypt(
+                _segmentNonce(nonce_prefix, index, last), segment, header))
+        if last:
+            return
+        segment = next_segment
+        index += 1
+
+def decryptStream(key, input_stream, output_stream):
+    """
+    Decrypt a stream in the segmented AES-GCM object format, holding at most
+    one segment in memory, and decompress it if it was compressed. Plaintext
+    is written as soon as its segment is authenticated, so output must be
+    discarded if an exception is raised.
+    :param key: key to use
+    :param input_stream: readable binary stream, positioned at the header
+    :param output_stream: writable binary stream
+    """
+    header = _readFull(input_stream, OBJECT_PREFIX.size)
+    if len(header) != OBJECT_PREFIX.size:
+        raise InvalidTag()
+    magic, version = OBJECT_PREFIX.unpack(header)
+    if magic != OBJECT_MAGIC or version != OBJECT_FORMAT_VERSION:
+        raise Exception("Unsupported encrypted object format")
+    header += _readFull(input_stream, OBJECT_HEADER.size - OBJECT_PREFIX.size)
+    if len(header) != OBJECT_HEADER.size:
+        raise InvalidTag()
+    _, _, algorithm, compression, segment_size, nonce_prefix = \
+            OBJECT_HEADER.unpack(header)
+    if algorithm != ALGORITHM_AES_256_GCM or segment_size == 0:
+        raise Exception("Unsupported encrypted object format")
+    decompressor = decompressobj(compression)
+    aesgcm = _objectKey(key)
+    index = 0
+    segment = _readFull(input_stream, segment_size + TAG_SIZE)
+    while True:
+        next_segment = _readFull(input_stream, segment_size + TAG_SIZE) \
+                if len(segment) == segment_size + TAG_SIZE else b""
+        last = not next_segment
+        output_stream.write(decompressor.decompress(aesgcm.decrypt(
+                _segmentNonce(nonce_prefix, index, last), segment, header)))
+        if last:
+            output_stream.write(decompressor.flush())
+            return
+        segment = next_segment
+        index += 1
+
+def isEncryptedObject(data):
+    """
+    :param data: first bytes of an encrypted object
+    :return: True if the object is in the segmented AES-GCM format, False if
+        it is a Fernet token
+    """
+    return bytes(data[:len(OBJECT_MAGIC)]) == OBJECT_MAGIC
+
 def encryptFile(key, input_path, output_path):
     """
     Encrypt a file, and write out using a symmetric key
@@ -61,11 +227,39 @@ def encryptFile(key, input_path, output_path):
     :param input_path: input file to encrypt
     :param output_path: output file
     """
-    fernet = symKey(key)
-    with open(input_path, "rb") as f:
-        encrypted = fernet.encrypt(f.read())
+    with open(input_path, "rb") as fin, open(output_path, "wb") as fout:
+        encryptStream(key, fin, fout)
+
+def encryptData(key, data, output_path, compression=COMPRESSION_NONE):
+    """
+    Encrypt binary data held in memory, and write out using a symmetric key
+    :param key: key to use
+    :param data: bytes-like object to encrypt, e.g. a memoryview slice
+        of the read buffer of a file
+    :param output_path: output file
+    :param compression: codec data was compressed with, as returned by
+        Compressor.compress, recorded in the header and undone by decryption
+    :return: tuple (digest, size), SHA256 and size of the encrypted object,
+        so that it never has to be read again to be hashed
+    """
+    aesgcm = _objectKey(key)
+    view = memoryview(data).cast("B")
+    header = _objectHeader(compression, SEGMENT_SIZE)
+    digest = hashes.Hash(hashes.SHA256(), backend=default_backend())
+    digest.update(header)
+    size = len(header)
     with open(output_path, "wb") as f:
-        f.write(encrypted)
+        f.write(header)
+        n_segments = max(1, -(-len(view) // SEGMENT_SIZE))
+        for index in range(n_segments):
+            with view[index * SEGMENT_SIZE:(index + 1) * SEGMENT_SIZE] as segment:
+                encrypted = aesgcm.encrypt(
+                        _segmentNonce(header[-7:], index, index == n_segments - 1),
+                        bytes(segment), header)
+            f.write(encrypted)
+            digest.update(encrypted)
+            size += len(encrypted)
+    return digest.finalize(), size
 
 def decryptFile(key, input_path, output_path=None):
     """
@@ -73,12 +267,32 @@ def decryptFile(key, input_path, output_path=None):
     :param key: key to use
     :param input_path: input file to decrypt
     :param output_path: output file
+    :return: decrypted data, or None if it was streamed to output_path
+    """
+    with open(input_path, "rb") as fin:
+        if not isEncryptedObject(fin.read(len(OBJECT_MAGIC))):
+            fin.seek(0)
+            decrypted = symKey(key).decrypt(fin.read())
+            if output_path != None:
+                with open(output_path, "wb") as f:
+                    f.write(decrypted)
+            return decrypted
+        fin.seek(0)
+        if output_path == None:
+            return decryptData(key, fin.read())
+        with open(output_path, "wb") as fout:
+            decryptStream(key, fin, fout)
+
+def decryptData(key, data):
+    """
+    Decrypt binary data held in memory using a symmetric key
+    :param key: key to use
+    :param data: encrypted object, in the segmented AES-GCM format or a
+        Fernet token
     :return: decrypted data
     """
-    fernet = symKey(key)
-    with open(input_path, "rb") as f:
-        decrypted = fernet.decrypt(f.read())
-    if output_path != None:
-        with open(output_path, "wb") as f:
-            f.write(decrypted)
-    return decrypted
+    if not isEncryptedObject(data):
+        return symKey(key).decrypt(bytes(data))
+    output = io.BytesIO()
+    decryptStream(key, io.BytesIO(data), output)
+    return output.getvalue()
@@ -0,0 +1,156 @@
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from utils.utils import make_dirs
+
+PROMETHEUS_PREFIX = "cloudsec_"
+
+
+def _format_key(name, labels):
+    if not labels:
+        return name
+    return "{}{{{}}}".format(name, ",".join(
+            '{}="{}"'.format(key, value) for key, value in labels))
+
+
+class Metrics(object):
+    """
+    Thread-safe counters of the backup program, e.g. seconds spent and
+    number of calls of each stage, bytes and requests. Counters only
+    increase; the values of a cycle are the differences between its start
+    and its end.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key is tuple (name, sorted tuple of labels)
+        self._counters = {}
+        self._cycle_start = {}
+        self._cycle_start_time = None
+
+    def inc(self, name, value=1, **labels):
+        """
+        Increase a counter
+        :param name: name of the counter
+        :param value: number added to the counter
+        :param labels: labels of the counter, e.g. op="PutObject"
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Count the seconds spent in the context in counter <name>_seconds,
+        and the number of times it was entered in counter <name>_calls
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.inc(name + "_seconds", time.perf_counter() - start, **labels)
+            self.inc(name + "_calls", 1, **labels)
+
+    def timed(self, name, **labels):
+        """
+        Decorator timing each call of a function with timer
+        """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def snapshot(self):
+        """
+        :return: copy of the counters, to be passed to changes_since
+        """
+        with self._lock:
+            return dict(self._counters)
+
+    def changes_since(self, snapshot):
+        """
+        :param snapshot: counters returned by snapshot
+        :return: dictionary of the increase of the counters since snapshot,
+            which can be sent to another process and added to its metrics
+            with add_changes
+        """
+        with self._lock:
+            return {key: value - snapshot.get(key, 0)
+                    for key, value in self._counters.items()
+                    if value != snapshot.get(key, 0)}
+
+    def add_changes(self, changes):
+        """
+        Add the increase of counters returned by changes_since, e.g. by
+        the worker processes of the parallel backup mode
+        """
+        with self._lock:
+            for key, value in changes.items():
+                self._counters[key] = self._counters.get(key, 0) + value
+
+    def start_cycle(self):
+        with self._lock:
+            self._cycle_start = dict(self._counters)
+            self._cycle_start_time = time.time()
+
+    def end_cycle(self, info, json_path, prometheus_path):
+        """
+        Append the counters of the cycle to a JSON-lines file, and write all
+        counters to a file in the Prometheus text format.
+        :param info: dictionary, description of the cycle, e.g. its version
+        :param json_path: path of the JSON-lines file of cycles
+        :param prometheus_path: path of the Prometheus text file
+        """
+        end_time = time.time()
+        with self._lock:
+            counters = dict(self._counters)
+            cycle_start = self._cycle_start
+            start_time = self._cycle_start_time or end_time
+        record = dict(info)
+        record["start_time"] = start_time
+        record["duration_seconds"] = end_time - start_time
+        record["metrics"] = {
+                _format_key(name, labels): value - cycle_start.get((name, labels), 0)
+                for (name, labels), value in sorted(counters.items())
+                if value != cycle_start.get((name, labels), 0)}
+        make_dirs(os.path.dirname(json_path))
+        with open(json_path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        self._write_prometheus(counters, record, prometheus_path)
+
+    def _write_prometheus(self, counters, last_cycle, prometheus_path):
+        lines = []
+        names = sorted(set(name for name, _ in counters))
+        for name in names:
+            metric = PROMETHEUS_PREFIX + name + "_total"
+            lines.append("# TYPE {} counter".format(metric))
+            for (counter_name, labels), value in sorted(counters.items()):
+                if counter_name == name:
+                    lines.append("{} {}".format(_format_key(metric, labels), value))
+        for key in ("duration_seconds", "start_time", "version"):
+            if isinstance(last_cycle.get(key), (int, float)):
+                metric = PROMETHEUS_PREFIX + "last_cycle_" + key
+                lines.append("# TYPE {} gauge".format(metric))
+                lines.append('{} {}'.format(_format_key(
+                        metric, (("kind", last_cycle.get("kind", "")),)), last_cycle[key]))
+        make_dirs(os.path.dirname(prometheus_path))
+        # written atomically, so that a scraper never reads half a file
+        tmp_path = prometheus_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, prometheus_path)
+
+
+# metrics of the process
+METRICS = Metrics()
+inc = METRICS.inc
+timer = METRICS.timer
+timed = METRICS.timed
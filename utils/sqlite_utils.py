@@ -1,6 +1,10 @@
 import sqlite3
 from sqlite3 import Error
 
+# seconds a statement waits for the lock held by another connection (e.g.
+# the anchor thread) before it fails with "database is locked"
+BUSY_TIMEOUT = 60
+
 def create_connection(db_file):
     """ create a database connection to the SQLite database
         specified by db_file
@@ -9,7 +13,7 @@ def create_connection(db_file):
     """
     conn = None
     try:
-        conn = sqlite3.connect(db_file, isolation_level=None)
+        conn = sqlite3.connect(db_file, timeout=BUSY_TIMEOUT, isolation_level=None)
         return conn
     except Error as e:
         print(e)
@@ -39,3 +43,34 @@ def create_index(c, create_index_sql):
         c.execute(create_index_sql)
     except Error as e:
         print(e)
+
+
+def set_pragmas(c):
+    """ tune a connection for many small writes: write-ahead log instead
+        of rollback journal, and fsync only at checkpoints
+    :param c: Cursor object
+    :return:
+    """
+    try:
+        c.execute("PRAGMA journal_mode=WAL")
+        c.execute("PRAGMA synchronous=NORMAL")
+        c.execute("PRAGMA temp_store=MEMORY")
+        c.execute("PRAGMA cache_size=-65536")
+    except Error as e:
+        print(e)
+
+
+def add_column(c, table, column, column_type):
+    """ add a column to an existing table, if it does not have it yet
+    :param c: Cursor object
+    :param table: name of the table
+    :param column: name of the column
+    :param column_type: type and constraints of the column
+    :return:
+    """
+    try:
+        columns = [row[1] for row in c.execute("PRAGMA table_info({})".format(table))]
+        if column not in columns:
+            c.execute("ALTER TABLE {} ADD COLUMN {} {}".format(table, column, column_type))
+    except Error as e:
+        print(e)
@@ -2,7 +2,8 @@ import os
 import json
 import pickle
 import re
-from utils.crypto import sha256
+from utils.chunker import Chunker
+from utils.crypto import sha256, sha256Bytes
 
 
 def replace_backslashes_with_forward_slashes(path):
@@ -14,8 +15,8 @@ def make_dirs(dirname):
         raise Exception("dirname cannot be None")
     if os.path.isfile(dirname):
         raise Exception("dirname cannot be a file")
-    if not os.path.isdir(dirname):
-        os.makedirs(dirname)
+    # exist_ok: directories may be created concurrently by download threads
+    os.makedirs(dirname, exist_ok=True)
 
 def load_json(filepath):
     try:
@@ -123,14 +124,15 @@ def join_chunks(chunk_dir, out_file_path):
                 output.write(chunk)
             part_num = part_num + 1
 
-def split_file_and_get_hash(file_path, out_dir, chunk_size=1000000):
+def split_file_and_get_hash(file_path, out_dir, chunker=None):
     """
-    Split a file into chunks of a specific size, save these chunks
+    Split a file into content-defined chunks, save these chunks
     to the provided directory, deleting all chunks already stored in
     the directory, and return list of hashes of all chunks.
     :param file_path: path of file to be split
     :param out_dir: directory to save file chunks
-    :param chunk_size: size of file chunks in bytes
+    :param chunker: Chunker object deciding the chunk boundaries,
+        default chunk sizes are used if not specified
     :return: dictionary, with key is path of chunk 
         and value is string of hash of this chunk.
     """
@@ -144,14 +146,14 @@ def split_file_and_get_hash(file_path, out_dir, chunk_size=1000000):
         raise Exception("out_dir must be a directory")
 
     delete_chunk_files(out_dir)
+
+    if chunker is None:
+        chunker = Chunker()
     
     hashes = {}
     with open(file_path, "rb") as f:
         part_num = 0
-        while True:
-            chunk = f.read(chunk_size)
-            if not chunk:
-                break
+        for chunk in chunker.chunks(f):
             filename = os.path.join(out_dir, get_chunk_file_name(part_num))
             with open(filename, 'wb') as p:
                 p.write(chunk)
@@ -160,6 +162,60 @@ def split_file_and_get_hash(file_path, out_dir, chunk_size=1000000):
     return hashes
 
 
+# size of the blocks read from files which are split into chunks
+READ_SIZE = 8 * 1024 * 1024
+
+
+def iter_file_chunks(file_path, chunker=None, file_hash=None):
+    """
+    Read a file block by block and iterate over its content-defined chunks
+    without writing them to disk, reading each byte of the file once.
+    Each chunk is a memoryview of the read buffer which is released when
+    the iteration moves on, so it must be consumed (hashed, encrypted...)
+    before requesting the next chunk. If the file is truncated while it is
+    read, the chunks end where the data read ends.
+    :param file_path: path of file to be split
+    :param chunker: Chunker object deciding the chunk boundaries,
+        default chunk sizes are used if not specified
+    :param file_hash: optional hash object, e.g. hashlib.sha256(), updated
+        with the whole content of the file as it is read
+    :return: generator of tuples (chunk, hash), where chunk is a memoryview
+        and hash is the hex string of SHA256 of the chunk.
+    """
+    if chunker is None:
+        chunker = Chunker()
+
+    # data of the buffer is buf[start:end]; a cut point can only be found
+    # with max_size bytes ahead, until the end of the file
+    buf = bytearray(max(READ_SIZE, 2 * chunker.max_size))
+    start = 0
+    end = 0
+    eof = False
+    with open(file_path, "rb") as f, memoryview(buf) as view:
+        while True:
+            if not eof and end - start < chunker.max_size:
+                # move the rest of the data to the beginning of the buffer,
+                # and fill the buffer from the file
+                view[:end - start] = view[start:end]
+                end -= start
+                start = 0
+                while end < len(buf):
+                    n = f.readinto(view[end:])
+                    if not n:
+                        eof = True
+                        break
+                    if file_hash is not None:
+                        file_hash.update(view[end:end + n])
+                    end += n
+                continue
+            if start == end:
+                return
+            cut = chunker.find_cut(view, start, end)
+            with view[start:cut] as chunk:
+                yield chunk, sha256Bytes(chunk).hex()
+            start = cut
+
+
 def get_hash_list_file_objects(directory, set_file_object_ids):
     """
     Compute hash of all file objects in set_file_object_ids